@@ -1,23 +1,65 @@
-import mutagen
+"""
+Sort the problems library.py recorded into a list of WAV files and a dump of
+the tags of every other file, and count them by kind of error.
+
+Reads the error sink line by line, using the tag snapshots stored in it, so
+none of the song files is opened again.
+"""
+import argparse
+import collections
 import json
+import os
+
 import progressbar
 
-file_count = len(open('problems.txt').read().split('\n'))
-progress = progressbar.ProgressBar(max_value=file_count)
-
-wav_file_errors_file = open('wav_file_errors.txt', 'w')
-mutagen_compatible_file = open('mutagen_file_errors.txt', 'w')
-with open('problems.txt') as f:
-    for i, file_path in enumerate(f, 1):
-        file_path = file_path.replace('\n', '')
-        if file_path.lower().endswith('.wav'):
-            wav_file_errors_file.write('{}\n'.format(file_path))
-        else:
-            metadata = mutagen.File(file_path, easy=True)
-            mutagen_compatible_file.write('{}\n{}\n'.format(
-                '-'*120,
-                json.dumps(dict(metadata), indent=4),
-            ))
-
-        progress.update(i)
+import config
+
+
+def analyze(error_log):
+    error_counts = collections.Counter()
+    progress = progressbar.ProgressBar(max_value=os.path.getsize(error_log))
+    bytes_read = 0
+
+    with open(error_log, 'rb') as f,\
+            open('wav_file_errors.txt', 'w') as wav_file_errors_file,\
+            open('mutagen_file_errors.txt', 'w') as mutagen_compatible_file:
+        for line in f:
+            bytes_read += len(line)
+            progress.update(bytes_read)
+            if not line.strip():
+                continue
+
+            record = json.loads(line)
+            error_counts[record['error']] += 1
+
+            file_path = record['path']
+            if file_path.lower().endswith('.wav'):
+                wav_file_errors_file.write('{}\n'.format(file_path))
+            else:
+                mutagen_compatible_file.write('{}\n{}\n{}: {}\n{}\n'.format(
+                    '-'*120,
+                    file_path,
+                    record['error'],
+                    record['message'],
+                    json.dumps(record['tags'], indent=4, ensure_ascii=False),
+                ))
+
+    progress.finish()
+    return error_counts
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Summarise the problems recorded by library.py.'
+    )
+    parser.add_argument('--errors', default=config.error_log_filename,
+                        help='JSONL error file written by library.py'
+                             ' (default: %(default)s)')
+    return parser.parse_args()
+
 
+if __name__ == '__main__':
+    args = get_arguments()
+    error_counts = analyze(args.errors)
+    for error, count in error_counts.most_common():
+        print('{:>8}  {}'.format(count, error))
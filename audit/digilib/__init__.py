@@ -19,11 +19,23 @@ class DigilibDatabase(object):
         cursor = self.connection.cursor()
         '''
         Artist(_id:int_, name:str)
-        Album(_id:int_, title:str, year:int, filesystem_path:str, artist:int)
+        Album(_id:int_, title:str, year:int, filesystem_path:str, artist:int,
+              track_count:int, duration:int, first_track_number:int,
+              last_track_number:int, has_track_gaps:bool)
         Song(_id:int_, title:str, duration:int, track_number:int, album:int, filesystem_path:int, artist:int)
         '''
 
-        cursor.execute('SELECT * FROM Album')
+        # The track counts and durations come with the album, kept up to date
+        # by library.py, so that the songs are only loaded for the albums
+        # whose tracks are looked at.
+        cursor.execute(
+            '''
+                SELECT id, title, year, filesystem_path, artist,
+                       track_count, duration, first_track_number,
+                       last_track_number, has_track_gaps
+                FROM   Album
+            '''
+        )
         for t in cursor:
             yield models.DigilibAlbum(self, *t)
 
@@ -65,7 +77,8 @@ class DigilibDatabase(object):
 
         cursor.execute(
             '''
-                SELECT * 
+                SELECT id, title, duration, track_number, album,
+                       filesystem_path, artist
                 FROM   Song
                 WHERE  album=:album_id
             ''',
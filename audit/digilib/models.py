@@ -4,6 +4,8 @@ from unidecode import unidecode
 
 class DigilibArtist(object):
     # Artist(_id:int_, name:str)
+    __slots__ = ('db', 'id', 'name')
+
     def __init__(self, db, id, name):
         self.db = db
         self.id = id
@@ -14,7 +16,14 @@ class DigilibArtist(object):
 
 
 class DigilibAlbum(object):
-    # Album(_id:int_, title:str, year:int, filesystem_path:str, artist:int)
+    # Album(_id:int_, title:str, year:int, filesystem_path:str, artist:int,
+    #       track_count:int, duration:int, first_track_number:int,
+    #       last_track_number:int, has_track_gaps:bool)
+    # The audit holds on to every album, so instances carry no __dict__.
+    __slots__ = ('db', 'id', 'title', 'year', 'path', 'artist_id',
+                 'track_count', 'duration', 'first_track_number',
+                 'last_track_number', 'has_track_gaps', '_artist', '_tracks')
+
     fieldnames = [
         'library_code',
         'klap3id',
@@ -24,7 +33,9 @@ class DigilibAlbum(object):
         'digilib_path'
     ]
 
-    def __init__(self, db, id, title, year, path, artist_id):
+    def __init__(self, db, id, title, year, path, artist_id, track_count,
+                 duration, first_track_number, last_track_number,
+                 has_track_gaps):
         self.db = db
         self.id = id
         self.title = title
@@ -32,6 +43,11 @@ class DigilibAlbum(object):
         self.path = os.path.dirname(
             path.replace('/media/kp/bobcat/digilib/',''))
         self.artist_id = artist_id
+        self.track_count = track_count
+        self.duration = duration
+        self.first_track_number = first_track_number
+        self.last_track_number = last_track_number
+        self.has_track_gaps = bool(has_track_gaps)
 
         self._artist = None
         self._tracks = None
@@ -42,10 +58,6 @@ class DigilibAlbum(object):
             self._artist = self.db.artist_of(self.id)
         return str(self._artist)
 
-    @property
-    def track_count(self):
-        return len(self.tracks)
-
     @property
     def tracks(self):
         if self._tracks is None:
@@ -70,6 +82,9 @@ class DigilibAlbum(object):
 class DigilibSong(object):
     # Song(_id:int_, title:str, duration:int, track_number:int,
     #      album:int, filesystem_path:int, artist:int)
+    __slots__ = ('db', 'id', 'title', 'duration', 'track_number', 'album_id',
+                 'path', 'artist_id')
+
     def __init__(self, db, id, title, duration, track_number, album_id,
                  path, artist_id):
         self.db = db
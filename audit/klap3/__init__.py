@@ -1,4 +1,5 @@
 import MySQLdb
+import collections
 import logging
 from audit.klap3 import models
 from unidecode import unidecode
@@ -10,10 +11,23 @@ def load(credentials):
     return KLAP3(*credentials)
 
 
+def match_key(name):
+    # Titles and artist names are matched the way MySQL compares them in
+    # KLAP3's case-insensitive collation, which also ignores trailing spaces
+    # and most accents.
+    return unidecode(name).lower().rstrip(' ')
+
+
 class KLAP3(object):
     def __init__(self, username, password):
         self.db = MySQLdb.connect("localhost", username, password, "klap3")
 
+        # Indexes of KLAP3AlbumSummary, filled in by build_index() before
+        # the first album is looked up.
+        self._ids_by_title_and_artist = None
+        self._albums_by_artist_and_track_count = None
+        self._albums_by_title_and_track_count = None
+
     def create_view(self):
         # Create a table consisting of data we'll be using. This will speed
         # up the execution of this script instead of performing a bunch of
@@ -64,6 +78,39 @@ class KLAP3(object):
         self.db.commit()
         cursor.close()
 
+        # The summary was made anew; so will be its indexes.
+        self._ids_by_title_and_artist = None
+
+    def build_index(self):
+        # Look albums up from memory rather than with a query per album:
+        # none of the lookups below could use an index in MySQL, since the
+        # columns are compared through LOWER(). The summary is read once,
+        # in the order MySQL scans it, so that the ids under every key are
+        # in the order the queries returned them.
+        logger.info('Indexing KLAP3 albums by title, artist and track count')
+        self._ids_by_title_and_artist = collections.defaultdict(list)
+        self._albums_by_artist_and_track_count = collections.defaultdict(list)
+        self._albums_by_title_and_track_count = collections.defaultdict(list)
+
+        cursor = self.db.cursor()
+        cursor.execute('SELECT id, album, artist, track_count'
+                       ' FROM KLAP3AlbumSummary')
+        for id, title, artist, track_count in cursor.fetchall():
+            # A NULL never equals anything in SQL, so albums missing a
+            # title or an artist name can't be matched.
+            if title is None or artist is None:
+                continue
+            title_key = match_key(title)
+            artist_key = match_key(artist)
+            self._ids_by_title_and_artist[title_key, artist_key].append(id)
+            self._albums_by_artist_and_track_count[
+                artist_key, track_count
+            ].append((id, title))
+            self._albums_by_title_and_track_count[
+                title_key, track_count
+            ].append((id, artist))
+        cursor.close()
+
     def albums(self):
         cursor = self.db.cursor()
         cursor.execute('SELECT * FROM KLAP3AlbumSummary')
@@ -80,25 +127,13 @@ class KLAP3(object):
 
     def find(self, album):
         logger.debug('Searching KLAP3 for {}'.format(album))
-        
-        cursor = self.db.cursor()
+        if self._ids_by_title_and_artist is None:
+            self.build_index()
 
-        # Find album by matching album title, artist name, and track count.
-        cursor.execute(
-            """
-                SELECT id
-                FROM   KLAP3AlbumSummary A
-                WHERE  LOWER(A.album)=%s
-                   AND LOWER(A.artist)=%s
-            """,
-            (
-                unidecode(album.title).lower(),
-                unidecode(album.artist).lower(),
-            )
-        )
-
-        matching_album_ids = [id for id, in cursor.fetchall()]
-        cursor.close()
+        # Find album by matching album title and artist name.
+        matching_album_ids = list(self._ids_by_title_and_artist.get(
+            (match_key(album.title), match_key(album.artist)), []
+        ))
 
         logger.debug('{} KLAP3 albums found'.format(len(matching_album_ids)))
 
@@ -116,32 +151,19 @@ class KLAP3(object):
         return matching_album_ids
 
     def find_by_matching_album_and_id(self, album):
+        if self._ids_by_title_and_artist is None:
+            self.build_index()
+
         logger.debug('Finding albums by {} with {} songs'.format(
             album.title, album.track_count
         ))
 
-        cursor = self.db.cursor()
-
-        # Grab the names and ids of albums performed by an artist
-        #  with a given number of songs.
-
-        cursor.execute(
-            '''
-                SELECT id
-                ,      artist
-                FROM   KLAP3AlbumSummary
-                WHERE  LOWER(album)=%s
-                  AND  track_count=%s
-            ''',
-            (
-                unidecode(album.title).lower(),
-                album.track_count
-            )
+        # Grab the artists and ids of albums with a given title and number
+        #  of songs.
+        matching_albums = self._albums_by_title_and_track_count.get(
+            (match_key(album.title), album.track_count), []
         )
 
-        matching_albums = cursor.fetchall()
-        cursor.close()
-
         logger.debug('{} albums found'.format(len(matching_albums)))
         if 0==len(matching_albums):
             return None
@@ -193,32 +215,19 @@ class KLAP3(object):
             return most_closely_matched_album[0]
 
     def find_by_artist_and_track_count(self, album):
+        if self._ids_by_title_and_artist is None:
+            self.build_index()
+
         logger.debug('Finding albums by {} with {} songs'.format(
             album.artist, album.track_count
         ))
 
-        cursor = self.db.cursor()
-
         # Grab the names and ids of albums performed by an artist
         #  with a given number of songs.
-
-        cursor.execute(
-            '''
-                SELECT id
-                ,      album
-                FROM   KLAP3AlbumSummary
-                WHERE  LOWER(artist)=%s
-                  AND  track_count=%s
-            ''',
-            (
-                unidecode(album.artist).lower(),
-                album.track_count
-            )
+        matching_albums = self._albums_by_artist_and_track_count.get(
+            (match_key(album.artist), album.track_count), []
         )
 
-        matching_albums = cursor.fetchall()
-        cursor.close()
-
         logger.debug('{} albums found'.format(len(matching_albums)))
         if 0==len(matching_albums):
             return None
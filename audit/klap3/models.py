@@ -24,6 +24,11 @@ import termcolor
 +---------------+--------------+------+-----+---------+----------------+
 '''
 class KLAP3Album(object):
+    # perform_audit keeps every KLAP3 album in memory, so instances carry no
+    # __dict__.
+    __slots__ = ('db', 'id', 'title', 'artist', 'track_count', 'library_code',
+                 'is_missing', 'mediums', 'digilib_album', 'match_status')
+
     color_coding = {
         'Exact': 'grey',
         'Multiple Matches': 'red',
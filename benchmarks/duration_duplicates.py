@@ -0,0 +1,114 @@
+"""
+Time the search for albums with matching track durations on a large
+synthetic database, with re-encoded copies of some of its albums planted in
+it, and count how many of those are found.
+
+Run from the root of the repository:
+
+    python -m benchmarks.duration_duplicates [--albums 20000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import config
+import db
+import duplicates
+
+# Track counts of the albums, in proportion.
+TRACK_COUNTS = (8, 9, 10, 10, 11, 12, 12, 12, 13, 14, 15, 16, 18, 20)
+
+
+def populate(loader, album_count, copy_every, jitter):
+    # Fill the tables directly with albums of random track durations. Every
+    # copy_every-th album gets a copy whose tracks are up to jitter seconds
+    # longer or shorter, as a different encode of it would be. Returns the
+    # (album id, copy id) pairs planted.
+    artists = []
+    albums = []
+    songs = []
+    copies = []
+    album_id = 0
+    for number in range(album_count):
+        album_id += 1
+        artists.append({'id': album_id, 'name': 'Artist {}'.format(number)})
+        durations = [random.randint(90, 480)
+                     for _ in range(random.choice(TRACK_COUNTS))]
+
+        encodes = [(album_id, durations, 'mp3')]
+        if number % copy_every == 0:
+            copies.append((album_id, album_id + 1))
+            album_id += 1
+            encodes.append((album_id,
+                            [duration + random.uniform(-jitter, jitter)
+                             for duration in durations],
+                            'flac'))
+
+        for id, track_durations, extension in encodes:
+            path = '/digilib/Artist {0}/Album {0} {1}'.format(number,
+                                                              extension)
+            albums.append({'id': id, 'title': 'Album {}'.format(number),
+                           'path': path, 'artist': artists[-1]['id']})
+            for track, duration in enumerate(track_durations, 1):
+                songs.append({'title': 'Song {}'.format(track),
+                              'duration': duration, 'track_number': track,
+                              'album': id,
+                              'path': '{}/{:02d}.{}'.format(path, track,
+                                                            extension),
+                              'artist': artists[-1]['id']})
+
+    cursor = loader.connection.cursor()
+    cursor.executemany('INSERT INTO Artist VALUES (:id, :name)', artists)
+    cursor.executemany(
+        'INSERT INTO Album (id, title, year, filesystem_path, artist)'
+        ' VALUES (:id, :title, NULL, :path, :artist)',
+        albums
+    )
+    cursor.executemany(
+        'INSERT INTO Song (title, duration, track_number, album,'
+        '                  filesystem_path, artist)'
+        ' VALUES (:title, :duration, :track_number, :album, :path, :artist)',
+        songs
+    )
+    loader.connection.commit()
+    cursor.close()
+    return copies
+
+
+def main(args):
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as directory:
+        db_file_path = os.path.join(directory, 'benchmark.db')
+        loader = db.DatabaseLoader(db_file_path=db_file_path)
+        loader.initialize_empty_tables()
+        copies = populate(loader, args.albums, args.copy_every, args.jitter)
+
+        start = time.perf_counter()
+        report = duplicates.find_duration_duplicates(
+            loader.connection, tolerance=config.duplicate_track_tolerance,
+            min_similarity=config.duplicate_min_similarity
+        )
+        elapsed = time.perf_counter() - start
+
+    found = set((row['album_id'], row['other_album_id']) for row in report)
+    print('{} albums and {} planted copies'.format(args.albums, len(copies)))
+    print('{:.2f} s, {} pairs reported, {} of the copies found'.format(
+        elapsed, len(report), len(found.intersection(copies))
+    ))
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--albums', type=int, default=20000)
+    parser.add_argument('--copy-every', type=int, default=20,
+                        help='plant a copy of every Nth album')
+    parser.add_argument('--jitter', type=float, default=1.0,
+                        help='seconds the tracks of a copy are off by, at'
+                             ' most')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(get_arguments())
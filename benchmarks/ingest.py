@@ -0,0 +1,209 @@
+"""
+Benchmark the ingest path and report the results as JSON.
+
+Runs three stages over a library, each in a fresh interpreter so that its
+peak memory is its own:
+
+- walk:  finding the song files, as library.find_song_files() does.
+- parse: loading every song file, without a database.
+- build: library.build_db() into a new database, which is the whole ingest.
+
+For each, the wall clock time, files per second and peak RSS of the process
+(and of its worker processes, with --workers) are reported. The library is
+either generated with benchmarks.synthetic or given with --directory.
+
+    python -m benchmarks.ingest --albums 1000 --workers 4 > run.json
+"""
+import argparse
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+
+def run_stage(stage, directory, options, results):
+    # Runs in a child process. Having been spawned, it would spawn its own
+    # worker processes too; use the platform's default start method, the
+    # one library.py runs with.
+    multiprocessing.set_start_method(None, force=True)
+    logging.basicConfig(level=logging.ERROR)
+
+    import library
+
+    start = time.perf_counter()
+
+    if stage == 'walk':
+        file_count = sum(len(song_files) for _, song_files
+                         in library.find_song_files(directory))
+
+    elif stage == 'parse':
+        file_count = 0
+        for loaded_files in library.load_songs_from_directory(
+                directory,
+                workers=options['workers'],
+                hash_content=options['hash'],
+                prefetch_depth=options['prefetch']):
+            file_count += len(loaded_files)
+
+    else:
+        # The database and the error log are written to the working
+        # directory, a temporary one.
+        library.build_db(directory,
+                         workers=options['workers'],
+                         batch_size=options['batch_size'],
+                         hash_content=options['hash'],
+                         prefetch_depth=options['prefetch'])
+        file_count = sum(len(song_files) for _, song_files
+                         in library.find_song_files(directory))
+
+    elapsed = time.perf_counter() - start
+    results.put({
+        'seconds': round(elapsed, 3),
+        'files': file_count,
+        'files_per_second': round(file_count / elapsed, 1),
+        # ru_maxrss is in kilobytes on Linux.
+        'peak_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+        ),
+        'peak_worker_rss_mb': round(
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1
+        ),
+    })
+
+
+def measure(stage, directory, options):
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    with tempfile.TemporaryDirectory() as working_directory:
+        current_directory = os.getcwd()
+        os.chdir(working_directory)
+        try:
+            process = context.Process(target=run_stage,
+                                      args=(stage, directory, options,
+                                            results))
+            process.start()
+            result = results.get()
+            process.join()
+        finally:
+            os.chdir(current_directory)
+
+        if stage == 'build':
+            import config
+            result['database_mb'] = round(os.path.getsize(os.path.join(
+                working_directory, config.database_filename
+            )) / 2**20, 1)
+    return result
+
+
+def library_size(directory):
+    file_count = 0
+    byte_count = 0
+    for parent, _, filenames in os.walk(directory):
+        for filename in filenames:
+            file_count += 1
+            byte_count += os.path.getsize(os.path.join(parent, filename))
+    return file_count, byte_count
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+            stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark(directory, args, generated=None):
+    options = {
+        'workers': args.workers,
+        'batch_size': args.batch_size,
+        'hash': args.hash,
+        'prefetch': args.prefetch,
+    }
+    file_count, byte_count = library_size(directory)
+    report = {
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'library': {
+            'directory': directory,
+            'files': file_count,
+            'mb': round(byte_count / 2**20, 1),
+            'generated': generated,
+        },
+        'options': options,
+        'stages': {},
+    }
+    for stage in args.stages:
+        report['stages'][stage] = measure(stage, directory, options)
+        print('{}: {}'.format(stage, report['stages'][stage]),
+              file=sys.stderr)
+    return report
+
+
+def get_arguments():
+    import config
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--directory',
+                        help='library to ingest, instead of generating one')
+    parser.add_argument('--albums', type=int, default=100,
+                        help='albums to generate (default: %(default)s)')
+    parser.add_argument('--tracks', type=int, default=12,
+                        help='tracks per generated album (default:'
+                             ' %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-w', '--workers', type=int, default=1)
+    parser.add_argument('-b', '--batch-size', type=int,
+                        default=config.ingest_batch_size)
+    parser.add_argument('--prefetch', type=int, default=0)
+    parser.add_argument('--hash', action='store_true', default=False)
+    parser.add_argument('--stages', nargs='+', default=['walk', 'parse',
+                                                          'build'],
+                        choices=['walk', 'parse', 'build'])
+    parser.add_argument('-o', '--output',
+                        help='file to write the JSON report to (default:'
+                             ' standard output)')
+    return parser.parse_args()
+
+
+def main(args):
+    if args.directory:
+        report = benchmark(os.path.abspath(args.directory), args)
+    else:
+        from benchmarks import synthetic
+
+        with tempfile.TemporaryDirectory() as root:
+            start = time.perf_counter()
+            synthetic.build_library(root, albums=args.albums,
+                                    tracks_per_album=args.tracks,
+                                    seed=args.seed)
+            generated = {
+                'albums': args.albums,
+                'tracks_per_album': args.tracks,
+                'seed': args.seed,
+                'seconds': round(time.perf_counter() - start, 3),
+            }
+            report = benchmark(root, args, generated=generated)
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main(get_arguments())
@@ -0,0 +1,132 @@
+"""
+Measure the memory taken by the song and album models, slotted as they are
+now, against equivalent classes that keep their attributes in a __dict__.
+Only the instances are measured, not the strings and numbers they refer to,
+which cost the same either way.
+
+Run from the root of the repository:
+
+    python -m benchmarks.model_memory [--albums 100000] [--songs 1000000]
+"""
+import argparse
+import datetime
+import gc
+import tracemalloc
+
+import models
+from audit.digilib.models import DigilibAlbum, DigilibSong
+from audit.klap3.models import KLAP3Album
+
+
+def dict_backed(cls):
+    # Rebuild a slotted class, methods and all, as a plain class whose
+    # instances have a __dict__, the way the models used to be.
+    namespace = {}
+    for klass in reversed(cls.__mro__[:-1]):
+        for name, value in vars(klass).items():
+            if name in ('__slots__', '__dict__', '__weakref__')\
+                    or name in getattr(klass, '__slots__', ()):
+                continue
+            namespace[name] = value
+    return type('DictBacked' + cls.__name__, (object,), namespace)
+
+
+def song_file_values(count):
+    return [('/media/kp/bobcat/digilib/Artist {}/Album {}/{:02d} Song'
+             ' {}.mp3'.format(i // 120, i // 12, i % 12 + 1, i),
+             i % 12 + 1,
+             'Song {}'.format(i),
+             datetime.timedelta(seconds=180 + i % 120),
+             'Artist {}'.format(i // 120),
+             'Album {}'.format(i // 12),
+             1960 + i % 60)
+            for i in range(count)]
+
+
+def make_song_file(cls, values):
+    # Song files are built by parsing a file; fill in what parsing would.
+    path, tracknumber, title, length, artist, album, year = values
+    song = cls.__new__(cls)
+    models.SongFile.__init__(song, path)
+    song.tracknumber = tracknumber
+    song.title = title
+    song.length = length
+    song.artist = artist
+    song.album = album
+    song.year = year
+    return song
+
+
+def digilib_song_values(count):
+    return [(None, i, 'Song {}'.format(i), 180 + i % 120, i % 12 + 1, i // 12,
+             '/digilib/Album {}/{:02d}.mp3'.format(i // 12, i % 12), i // 120)
+            for i in range(count)]
+
+
+def digilib_album_values(count):
+    return [(None, i, 'Album {}'.format(i), 1960 + i % 60,
+             '/media/kp/bobcat/digilib/Artist {}/Album {}/01.mp3'.format(
+                 i // 10, i),
+             i // 10)
+            for i in range(count)]
+
+
+def klap3_album_values(count):
+    return [(None, i, 'Album {}'.format(i), 'Artist {}'.format(i // 10),
+             12, 'RO', i // 10, 'A', 'CD', 0)
+            for i in range(count)]
+
+
+def make_model(cls, values):
+    return cls(*values)
+
+
+def measure(make, cls, values):
+    # Trace only the allocations made while building the instances. The
+    # attribute values passed in are allocated beforehand, so what is
+    # measured is the instances themselves plus anything their constructor
+    # derives, such as KLAP3Album's library code.
+    gc.collect()
+    tracemalloc.start()
+    objects = [make(cls, v) for v in values]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del objects
+    gc.collect()
+    return size
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--albums', type=int, default=100000)
+    parser.add_argument('--songs', type=int, default=1000000)
+    return parser.parse_args()
+
+
+def main(args):
+    cases = [
+        ('models.SongFile', make_song_file, song_file_values,
+         models.MutagenCompatibleSongFile, args.songs),
+        ('DigilibSong', make_model, digilib_song_values,
+         DigilibSong, args.songs),
+        ('DigilibAlbum', make_model, digilib_album_values,
+         DigilibAlbum, args.albums),
+        ('KLAP3Album', make_model, klap3_album_values,
+         KLAP3Album, args.albums),
+    ]
+
+    print('{:<18} {:>9} {:>14} {:>14} {:>10}'.format(
+        'model', 'count', '__dict__ (MB)', 'slots (MB)', 'reduction'
+    ))
+    for name, make, make_values, cls, count in cases:
+        values = make_values(count)
+        before = measure(make, dict_backed(cls), values)
+        after = measure(make, cls, values)
+        print('{:<18} {:>9} {:>14.1f} {:>14.1f} {:>9.0%}'.format(
+            name, count, before / 2**20, after / 2**20, 1 - after / before
+        ))
+        del values
+
+
+if __name__ == '__main__':
+    main(get_arguments())
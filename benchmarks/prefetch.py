@@ -0,0 +1,167 @@
+"""
+Measure how much read-ahead speeds up loading song files from a slow mount.
+
+The synthetic library lives on local disk, so the latency of a network or
+USB mount is injected: open() is wrapped so that reads of song files go
+through a model of the page cache, in blocks. Reading a block that isn't
+cached yet costs one round trip of --latency plus its transfer time at
+--bandwidth; cached blocks are free. Requests from different threads wait
+concurrently, as they do on NFS or SMB with several requests in flight.
+
+Song files are loaded serially, as library.py does without --workers: the
+model's page cache lives in this process, so worker processes wouldn't see
+what the prefetcher read.
+
+    python -m benchmarks.prefetch [--albums 50] [--latency 0.005]
+"""
+import argparse
+import builtins
+import os
+import tempfile
+import threading
+import time
+
+import library
+from benchmarks import synthetic
+
+real_open = builtins.open
+
+
+class SlowMount(object):
+    def __init__(self, root, latency, bandwidth, block_size=64 * 1024):
+        self.root = os.path.join(root, '')
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.block_size = block_size
+        self.cached_blocks = set()
+        self.lock = threading.Lock()
+        self.waited = {}
+
+    def open(self, file, mode='r', *args, **kwargs):
+        f = real_open(file, mode, *args, **kwargs)
+        if isinstance(file, str) and file.startswith(self.root)\
+                and 'r' in mode and 'b' in mode:
+            return SlowFile(f, self)
+        return f
+
+    def read(self, path, offset, size):
+        # Account for reading size bytes at offset, sleeping for whatever
+        # isn't cached yet.
+        if size <= 0:
+            return
+        first_block = offset // self.block_size
+        last_block = (offset + size - 1) // self.block_size
+        with self.lock:
+            missing = [(path, block)
+                       for block in range(first_block, last_block + 1)
+                       if (path, block) not in self.cached_blocks]
+            self.cached_blocks.update(missing)
+
+        if missing:
+            delay = self.latency\
+                    + len(missing) * self.block_size / self.bandwidth
+            time.sleep(delay)
+            thread = 'prefetch' if threading.current_thread().name\
+                                             .startswith('prefetch')\
+                                else 'parser'
+            with self.lock:
+                self.waited[thread] = self.waited.get(thread, 0) + delay
+
+    def drop_caches(self):
+        self.cached_blocks = set()
+        self.waited = {}
+
+
+class SlowFile(object):
+    def __init__(self, file, mount):
+        self._file = file
+        self._mount = mount
+
+    def read(self, size=-1):
+        offset = self._file.tell()
+        data = self._file.read(size)
+        self._mount.read(self._file.name, offset, len(data))
+        return data
+
+    def readinto(self, buffer):
+        offset = self._file.tell()
+        count = self._file.readinto(buffer)
+        self._mount.read(self._file.name, offset, count or 0)
+        return count
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+
+def load_all(directory, prefetch_depth):
+    start = time.perf_counter()
+    file_count = 0
+    for loaded_files in library.load_songs_from_directory(
+            directory, prefetch_depth=prefetch_depth):
+        file_count += len(loaded_files)
+    return file_count, time.perf_counter() - start
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--albums', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='seconds per uncached read (default: 5 ms)')
+    parser.add_argument('--bandwidth', type=float, default=40e6,
+                        help='bytes per second (default: 40 MB/s)')
+    parser.add_argument('--depths', type=int, nargs='+',
+                        default=[0, 4, 16, 64])
+    return parser.parse_args()
+
+
+def main(args):
+    with tempfile.TemporaryDirectory() as root:
+        # Full length songs with covers, so that files span several blocks
+        # and tags sit some way into them, and nothing for the loader to
+        # skip.
+        synthetic.build_library(root, albums=args.albums, seconds=30,
+                                cover_bytes=64 * 1024,
+                                formats=('mp3',) * 9 + ('wav',),
+                                broken_album_fraction=0,
+                                unreadable_file_fraction=0)
+        mount = SlowMount(root, latency=args.latency,
+                          bandwidth=args.bandwidth)
+
+        # Parse everything once without injected latency, for the CPU cost.
+        file_count, cpu_bound = load_all(root, prefetch_depth=0)
+
+        print('{} files; {:.1f} ms latency, {:.0f} MB/s; no latency:'
+              ' {:.0f} files/s'.format(file_count, args.latency * 1000,
+                                       args.bandwidth / 1e6,
+                                       file_count / cpu_bound))
+        print('{:>6} {:>10} {:>9} {:>16}'.format(
+            'depth', 'files/s', 'speedup', 'parser waited'
+        ))
+
+        builtins.open = mount.open
+        try:
+            baseline = None
+            for depth in args.depths:
+                mount.drop_caches()
+                file_count, elapsed = load_all(root, prefetch_depth=depth)
+                if baseline is None:
+                    baseline = elapsed
+                print('{:>6} {:>10.0f} {:>8.2f}x {:>15.1f}s'.format(
+                    depth, file_count / elapsed, baseline / elapsed,
+                    mount.waited.get('parser', 0)
+                ))
+        finally:
+            builtins.open = real_open
+
+
+if __name__ == '__main__':
+    main(get_arguments())
@@ -0,0 +1,146 @@
+"""
+Time the read queries used by the audit and the web pages on a large
+synthetic database, before and after the secondary indexes of schema
+migration 1 are applied.
+
+Run from the root of the repository:
+
+    python -m benchmarks.query_indexes [--albums 20000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import db
+from audit import digilib
+
+
+def populate(loader, artist_count, album_count, tracks_per_album):
+    # Fill the tables directly rather than through insert_song(), which
+    # would take far longer than the queries being measured.
+    cursor = loader.connection.cursor()
+    cursor.executemany(
+        'INSERT INTO Artist VALUES (:id, :name)',
+        ({'id': i, 'name': 'Artist {}'.format(i)}
+         for i in range(1, artist_count + 1))
+    )
+    # The aggregates are those of the songs inserted below.
+    cursor.executemany(
+        'INSERT INTO Album (id, title, year, filesystem_path, artist,'
+        '                   track_count, duration, first_track_number,'
+        '                   last_track_number)'
+        ' VALUES (:id, :title, :year, :path, :artist, :track_count,'
+        '         :duration, 1, :track_count)',
+        ({'id': i,
+          'title': 'Album {}'.format(i),
+          'year': 1960 + i % 60,
+          'path': '/digilib/{0}/Album {0}'.format(i),
+          'artist': 1 + i % artist_count,
+          'track_count': tracks_per_album,
+          'duration': sum(180 + track
+                          for track in range(1, tracks_per_album + 1))}
+         for i in range(1, album_count + 1))
+    )
+    cursor.executemany(
+        'INSERT INTO Song (title, duration, track_number, album,'
+        '                  filesystem_path, artist)'
+        ' VALUES (:title, :duration, :track_number, :album, :path, :artist)',
+        ({'title': 'Song {}'.format(track),
+          'duration': 180 + track,
+          'track_number': track,
+          'album': album,
+          'path': '/digilib/{0}/Album {0}/{1:02d}.mp3'.format(album, track),
+          'artist': 1 + album % artist_count}
+         for album in range(1, album_count + 1)
+         for track in range(1, tracks_per_album + 1))
+    )
+    loader.connection.commit()
+    cursor.close()
+
+
+def drop_indexes(connection):
+    # Make the database look like one created before migration 1.
+    names = connection.execute(
+        "SELECT name FROM sqlite_master"
+        " WHERE type='index' AND sql IS NOT NULL"
+    ).fetchall()
+    for name, in names:
+        connection.execute('DROP INDEX {}'.format(name))
+    connection.commit()
+
+
+def create_indexes(connection):
+    for statement in db.SCHEMA_MIGRATIONS[0]:
+        connection.execute(statement)
+    connection.commit()
+
+
+def time_queries(db_file_path, album_ids, artist_ids):
+    audit_db = digilib.load(db_file_path=db_file_path)
+    api = db.DatabaseAPI(db_file_path=db_file_path)
+    artists = [{'id': id} for id in artist_ids]
+
+    timings = {}
+
+    start = time.perf_counter()
+    for album_id in album_ids:
+        audit_db.tracks_of(album_id)
+    timings['tracks_of'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for album_id in album_ids:
+        audit_db.artist_of(album_id)
+    timings['artist_of'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    api.get_albums_by_artists(artists)
+    timings['get_albums_by_artists'] = time.perf_counter() - start
+
+    return timings
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--artists', type=int, default=8000)
+    parser.add_argument('--albums', type=int, default=20000)
+    parser.add_argument('--tracks', type=int, default=12,
+                        help='tracks per album')
+    parser.add_argument('--samples', type=int, default=1000,
+                        help='number of albums and artists queried')
+    return parser.parse_args()
+
+
+def main(args):
+    random.seed(0)
+    album_ids = random.sample(range(1, args.albums + 1),
+                              min(args.samples, args.albums))
+    artist_ids = random.sample(range(1, args.artists + 1),
+                               min(args.samples, args.artists))
+
+    with tempfile.TemporaryDirectory() as directory:
+        db_file_path = os.path.join(directory, 'benchmark.db')
+        loader = db.DatabaseLoader(db_file_path=db_file_path)
+        loader.initialize_empty_tables()
+        drop_indexes(loader.connection)
+        populate(loader, args.artists, args.albums, args.tracks)
+
+        before = time_queries(db_file_path, album_ids, artist_ids)
+        create_indexes(loader.connection)
+        after = time_queries(db_file_path, album_ids, artist_ids)
+
+    print('{} artists, {} albums, {} songs; {} lookups per query'.format(
+        args.artists, args.albums, args.albums * args.tracks, len(album_ids)
+    ))
+    print('{:<24} {:>12} {:>12} {:>9}'.format('query', 'before (s)',
+                                              'after (s)', 'speedup'))
+    for query in before:
+        print('{:<24} {:>12.4f} {:>12.4f} {:>8.0f}x'.format(
+            query, before[query], after[query],
+            before[query] / max(after[query], 1e-9)
+        ))
+
+
+if __name__ == '__main__':
+    main(get_arguments())
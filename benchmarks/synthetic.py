@@ -0,0 +1,259 @@
+"""
+Build a synthetic music library to benchmark ingest against.
+
+Lays out ARTIST/ALBUM/NN Title.ext directories of song files put together
+byte by byte, so that a million of them can be written in minutes:
+
+- MP3: an ID3v2.4 tag, optionally with a cover, in front of silent MPEG-1
+  Layer III frames.
+- FLAC: STREAMINFO and VORBIS_COMMENT metadata blocks, then a few bytes
+  standing in for the frames.
+- M4A: 'ftyp', a 'moov' atom with one sound track and an iTunes-style
+  'ilst' tag list, and the 'mdat' atom.
+- WAV: RIFF headers and PCM silence.
+
+Only their structure matters to the loader, so they are tiny. A fraction of
+the albums have the kinds of broken tags found in the real digilib (dates
+in odd formats, track numbers without numbers, missing tags, filenames
+without a track number), and a fraction of the files are not song files at
+all, for the loader to quarantine. The library is the same for the same
+arguments.
+
+    python -m benchmarks.synthetic /tmp/library [--albums 100] [--tracks 12]
+"""
+import argparse
+import math
+import os
+import random
+import struct
+
+# An MPEG-1 Layer III frame header: 128 kbit/s, 44.1 kHz, stereo, no CRC and
+# no padding, which makes every frame 144 * 128000 // 44100 = 417 bytes.
+MP3_FRAME = b'\xff\xfb\x90\x00' + bytes(417 - 4)
+MP3_FRAMES_PER_SECOND = 44100 / 1152
+
+# Album formats, in turn; most of the digilib is MP3.
+DEFAULT_FORMATS = ('mp3', 'mp3', 'mp3', 'flac', 'mp3', 'm4a', 'mp3', 'wav')
+
+# Tags seen in the wild that the loader has to cope with.
+BROKEN_DATES = ('bogus', '2001-13-31', '0000', '1999-00-00', '0',
+                'March 4, 1999', '[1999]', '1999/2000')
+BROKEN_TRACK_NUMBERS = ('/', 'x', '/12', 'A1', '')
+
+
+def syncsafe(size):
+    # ID3v2 sizes are stored in 7 bits per byte.
+    return bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F,
+                  (size >> 7) & 0x7F, size & 0x7F])
+
+
+def id3v2_tag(tags, cover_bytes=0):
+    frame_ids = {'title': b'TIT2', 'artist': b'TPE1', 'album': b'TALB',
+                 'date': b'TDRC', 'tracknumber': b'TRCK',
+                 'albumartist': b'TPE2'}
+    frames = []
+    for key, value in tags.items():
+        # Text encoding 3 is UTF-8.
+        data = b'\x03' + value.encode('utf-8')
+        frames.append(frame_ids[key] + syncsafe(len(data)) + b'\x00\x00'
+                      + data)
+    if cover_bytes:
+        data = b'\x00image/jpeg\x00\x03Cover\x00' + bytes(cover_bytes)
+        frames.append(b'APIC' + syncsafe(len(data)) + b'\x00\x00' + data)
+
+    body = b''.join(frames)
+    return b'ID3\x04\x00\x00' + syncsafe(len(body)) + body
+
+
+def mp3_bytes(seconds, tags=None, cover_bytes=0):
+    frames = MP3_FRAME * math.ceil(seconds * MP3_FRAMES_PER_SECOND)
+    if tags is None:
+        return frames
+    return id3v2_tag(tags, cover_bytes=cover_bytes) + frames
+
+
+def flac_bytes(seconds, tags, samplerate=44100):
+    # STREAMINFO: block sizes, unknown frame sizes, then sample rate (20
+    # bits), channels - 1 (3), bits per sample - 1 (5) and the number of
+    # samples (36), and an all-zero MD5.
+    samples = int(seconds * samplerate)
+    packed = (samplerate << 44) | (1 << 41) | (15 << 36) | samples
+    streaminfo = struct.pack('>HH3s3s', 4096, 4096, bytes(3), bytes(3))\
+                 + packed.to_bytes(8, 'big') + bytes(16)
+
+    vendor = b'synthetic'
+    comments = [
+        '{}={}'.format(key.upper(), value).encode('utf-8')
+        for key, value in tags.items()
+    ]
+    vorbis_comment = struct.pack('<I', len(vendor)) + vendor\
+                     + struct.pack('<I', len(comments))\
+                     + b''.join(struct.pack('<I', len(comment)) + comment
+                                for comment in comments)
+
+    def block(block_type, data, is_last=False):
+        return bytes([block_type | (0x80 if is_last else 0)])\
+               + len(data).to_bytes(3, 'big') + data
+
+    return (b'fLaC' + block(0, streaminfo)
+            + block(4, vorbis_comment, is_last=True)
+            + b'\xff\xf8' + bytes(1022))
+
+
+def atom(name, *children):
+    data = b''.join(children)
+    return struct.pack('>I4s', 8 + len(data), name) + data
+
+
+def m4a_bytes(seconds, tags, timescale=44100):
+    def text(name, value):
+        return atom(name, atom(b'data', struct.pack('>II', 1, 0),
+                               value.encode('utf-8')))
+
+    names = {'title': b'\xa9nam', 'artist': b'\xa9ART', 'album': b'\xa9alb',
+             'date': b'\xa9day', 'albumartist': b'aART'}
+    items = []
+    for key, value in tags.items():
+        if key == 'tracknumber':
+            number, _, total = value.partition('/')
+            if not number.isdigit():
+                continue
+            items.append(atom(b'trkn', atom(
+                b'data', struct.pack('>II', 0, 0),
+                struct.pack('>HHHH', 0, int(number),
+                            int(total) if total.isdigit() else 0, 0)
+            )))
+        else:
+            items.append(text(names[key], value))
+
+    mdhd = atom(b'mdhd', struct.pack('>IIIIIHH', 0, 0, 0, timescale,
+                                     int(seconds * timescale), 0, 0))
+    hdlr = atom(b'hdlr', struct.pack('>II4s12s', 0, 0, b'soun', bytes(12)),
+                b'\x00')
+    meta = atom(b'meta', struct.pack('>I', 0),
+                atom(b'hdlr', struct.pack('>II4s12s', 0, 0, b'mdir',
+                                          b'appl' + bytes(8)), b'\x00'),
+                atom(b'ilst', *items))
+    return (atom(b'ftyp', b'M4A ', struct.pack('>I', 0), b'M4A mp42isom')
+            + atom(b'moov', atom(b'trak', atom(b'mdia', mdhd, hdlr)),
+                   atom(b'udta', meta))
+            + atom(b'mdat', bytes(1024)))
+
+
+def wav_bytes(seconds, samplerate=8000, channels=1, sample_width=2):
+    data_size = int(seconds * samplerate) * channels * sample_width
+    block_align = channels * sample_width
+    return (
+        struct.pack('<4sI4s', b'RIFF', 36 + data_size, b'WAVE')
+        + struct.pack('<4sIHHIIHH', b'fmt ', 16, 1, channels, samplerate,
+                      samplerate * block_align, block_align,
+                      sample_width * 8)
+        + struct.pack('<4sI', b'data', data_size)
+        + bytes(data_size)
+    )
+
+
+def song_bytes(extension, seconds, tags, cover_bytes=0):
+    if extension == 'mp3':
+        return mp3_bytes(seconds, tags, cover_bytes=cover_bytes)
+    elif extension == 'flac':
+        return flac_bytes(seconds, tags)
+    elif extension == 'm4a':
+        return m4a_bytes(seconds, tags)
+    else:
+        return wav_bytes(seconds)
+
+
+def album_tracks(rng, album, artist, title, tracks_per_album, is_broken):
+    # Yield (filename stem, tags) for every track of an album.
+    year = str(1960 + album % 60)
+    for track in range(1, tracks_per_album + 1):
+        song_title = 'Song {:d}'.format(track)
+        tags = {
+            'title': song_title,
+            'artist': artist,
+            'album': title,
+            'date': year,
+            'tracknumber': '{:d}/{:d}'.format(track, tracks_per_album),
+        }
+        stem = '{:02d} {}'.format(track, song_title)
+
+        if is_broken:
+            damage = rng.randrange(5)
+            if damage == 0:
+                tags['date'] = rng.choice(BROKEN_DATES)
+            elif damage == 1:
+                tags['tracknumber'] = rng.choice(BROKEN_TRACK_NUMBERS)
+            elif damage == 2:
+                del tags['title']
+                del tags['tracknumber']
+            elif damage == 3:
+                stem = song_title
+                del tags['tracknumber']
+            else:
+                tags['artist'] = 'Guest {:d}'.format(rng.randrange(100))
+
+        yield stem, tags
+
+
+def build_library(root, albums=100, tracks_per_album=12, seconds=1,
+                  cover_bytes=0, formats=DEFAULT_FORMATS,
+                  broken_album_fraction=0.05, unreadable_file_fraction=0.001,
+                  seed=0):
+    # Write the library under root and return the paths of the files
+    # written, song files or not.
+    rng = random.Random(seed)
+    paths = []
+    for album in range(albums):
+        artist = 'Artist {:d}'.format(album // 4)
+        title = 'Album {:d}'.format(album)
+        directory = os.path.join(root, artist, title)
+        os.makedirs(directory, exist_ok=True)
+
+        extension = formats[album % len(formats)]
+        is_broken = rng.random() < broken_album_fraction
+        for stem, tags in album_tracks(rng, album, artist, title,
+                                       tracks_per_album, is_broken):
+            path = os.path.join(directory, '{}.{}'.format(stem, extension))
+            if rng.random() < unreadable_file_fraction:
+                # Junk with a song file extension: a failed download, or a
+                # file truncated to nothing.
+                data = rng.choice([b'', b'<html>Not Found</html>' * 20])
+            else:
+                data = song_bytes(extension, seconds, tags,
+                                  cover_bytes=cover_bytes)
+
+            with open(path, 'wb') as f:
+                f.write(data)
+            paths.append(path)
+
+    return paths
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('directory')
+    parser.add_argument('--albums', type=int, default=100)
+    parser.add_argument('--tracks', type=int, default=12,
+                        help='tracks per album')
+    parser.add_argument('--seconds', type=float, default=1,
+                        help='length of every song')
+    parser.add_argument('--cover-bytes', type=int, default=0,
+                        help='size of the cover embedded in MP3 tags')
+    parser.add_argument('--broken-albums', type=float, default=0.05,
+                        help='fraction of albums with broken tags')
+    parser.add_argument('--unreadable-files', type=float, default=0.001,
+                        help='fraction of files that are not song files')
+    parser.add_argument('--seed', type=int, default=0)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    paths = build_library(args.directory, albums=args.albums,
+                          tracks_per_album=args.tracks, seconds=args.seconds,
+                          cover_bytes=args.cover_bytes,
+                          broken_album_fraction=args.broken_albums,
+                          unreadable_file_fraction=args.unreadable_files,
+                          seed=args.seed)
+    print('{} files written under {}'.format(len(paths), args.directory))
@@ -14,3 +14,83 @@ valid_extensions = (
 )
 database_filename = 'music_library.db'
 klap3_credentials = ('klap3', 'kmnr<3buttstuff')
+# Number of song files handed to a worker process at a time when parsing
+# with library.py --workers.
+ingest_chunk_size = 16
+# Number of songs DatabaseLoader writes per transaction when building the
+# database. Batches are only cut between album directories.
+ingest_batch_size = 500
+# JSONL file library.py appends the problems it finds with song files to,
+# for analyze_errors.py.
+error_log_filename = 'ingest_errors.jsonl'
+# Directories library.py never walks into: the resource forks macOS archive
+# tools leave behind hold "._" files with song file extensions that aren't
+# songs at all.
+skipped_directory_names = ('__MACOSX',)
+# Read-ahead for library.py --prefetch: how many song files ahead of the
+# parser to read, by how many threads, and how much of the start and the end
+# of each file. Tags sit at either end; a large embedded cover can push an
+# ID3v2 tag past the head, and is then read by the parser itself. With
+# --workers, the depth also bounds the files queued up for the workers, so
+# it should be a few times workers * ingest_chunk_size.
+prefetch_depth = 64
+prefetch_threads = 8
+prefetch_head_bytes = 128 * 1024
+prefetch_tail_bytes = 64 * 1024
+# Profiling with library.py --profile: how many of the slowest song files to
+# list, and where --profile-stage writes the cProfile statistics of a stage,
+# for python -m pstats.
+profile_slowest_count = 20
+profile_stats_filename = 'ingest_profile.pstats'
+# Throttling library.py and weed_out_bad_files.py with --max-files-per-second,
+# --max-bytes-per-second or --max-latency, so that a scan doesn't starve the
+# playout reading from the same disks. The latency is that of reading the
+# first throttle_probe_bytes of each file, smoothed over files; while it is
+# above the target, the budget is halved every throttle_adapt_interval
+# seconds, down to throttle_min_scale of it, and below the target it grows
+# by throttle_scale_step. The rates reported in the status file are those of
+# the last throttle_rate_window seconds, written every
+# throttle_status_interval seconds.
+throttle_probe_bytes = 4096
+throttle_latency_smoothing = 0.2
+throttle_adapt_interval = 1.0
+throttle_min_scale = 1 / 64
+throttle_scale_step = 0.05
+throttle_rate_window = 10
+throttle_status_interval = 5
+throttle_status_filename = 'ingest_throttle.json'
+# Album directories each lane of library.py may load ahead of the database
+# writer, when the roots it is given live on several drives.
+lane_queue_depth = 4
+# Keeping the database up to date with watch.py: an album directory is
+# loaded once no file in it has changed for watch_debounce_seconds. Without
+# inotify, directories are polled every watch_poll_interval seconds instead,
+# and the song files of watch_poll_sweep_directories of them are looked at
+# with every poll, in turn, for files rewritten in place.
+watch_debounce_seconds = 5
+watch_poll_interval = 10
+watch_poll_sweep_directories = 100
+# Decoding every song file with verify.py: song files are decoded
+# verify_block_frames frames at a time, by worker processes running at
+# verify_niceness, and their verdicts committed every verify_commit_interval
+# files. A file decoding to fewer frames than its header promises, by more
+# than verify_frame_tolerance of them, is taken to be cut short. The files
+# found failing are listed in verify_failures_filename.
+verify_block_frames = 64 * 1024
+verify_niceness = 10
+verify_commit_interval = 100
+verify_frame_tolerance = 0.01
+verify_failures_filename = 'verify_failures.txt'
+# Finding albums that are copies of one another by the durations of their
+# tracks, with duplicates.py: two tracks match when their durations are no
+# more than duplicate_track_tolerance seconds apart, and two albums are
+# reported when at least duplicate_min_similarity of their tracks match.
+# Only albums with as many tracks, of at least duplicate_min_tracks, and
+# runtimes in the same or neighbouring buckets of duplicate_runtime_bucket
+# seconds are compared, up to duplicate_comparison_block track durations at
+# a time.
+duplicate_track_tolerance = 2.0
+duplicate_min_similarity = 0.9
+duplicate_min_tracks = 3
+duplicate_runtime_bucket = 30
+duplicate_comparison_block = 2**22
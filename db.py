@@ -1,6 +1,152 @@
 import os
 import sqlite3
 import datetime
+import collections
+import logging
+
+import profiling
+
+logger = logging.getLogger(__name__)
+
+
+# What the manifest remembers about a song file in order to tell whether it
+# changed since it was last parsed: its size, modification time in
+# nanoseconds, inode and device numbers.
+FileSignature = collections.namedtuple('FileSignature',
+                                       'size mtime inode device')
+
+
+def file_signature(stat_result):
+    return FileSignature(size=stat_result.st_size,
+                         mtime=stat_result.st_mtime_ns,
+                         inode=stat_result.st_ino,
+                         device=stat_result.st_dev)
+
+
+# Brings the aggregates kept with an album up to date with its songs: how
+# many there are, how long they run altogether, their lowest and highest
+# track number, and whether any track number between 1 and the highest is
+# missing. Songs without a track number are counted but leave the track
+# numbers alone.
+UPDATE_ALBUM_AGGREGATES = (
+    'UPDATE Album'
+    ' SET (track_count, duration, first_track_number, last_track_number,'
+    '      has_track_gaps) = ('
+    '     SELECT COUNT(*), COALESCE(SUM(duration), 0),'
+    '            MIN(track_number), MAX(track_number),'
+    '            COALESCE(COUNT(DISTINCT CASE WHEN track_number > 0'
+    '                                         THEN track_number END)'
+    '                     < MAX(track_number), 0)'
+    '     FROM Song WHERE Song.album=Album.id'
+    ' )'
+)
+
+# Schema changes applied on top of the tables created by
+# DatabaseLoader.initialize_empty_tables(). Migration number N (counting from
+# 1) brings a database to schema version N, which SQLite keeps for us in the
+# user_version pragma. Never edit a migration that has shipped; append a new
+# one instead.
+SCHEMA_MIGRATIONS = [
+    # 1: Secondary indexes. Ingest looks artists up by name and albums by
+    #    title and year; the audit and the web pages look up the songs of an
+    #    album and the albums of an artist, newest first.
+    (
+        'CREATE INDEX IF NOT EXISTS ArtistByName ON Artist(name)',
+        'CREATE INDEX IF NOT EXISTS AlbumByTitleAndYear'
+        '    ON Album(title, year)',
+        'CREATE INDEX IF NOT EXISTS AlbumByArtistAndYear'
+        '    ON Album(artist, year)',
+        'CREATE INDEX IF NOT EXISTS SongByAlbum ON Song(album)',
+    ),
+
+    # 2: Hash of each song's audio payload, for finding duplicate files.
+    (
+        'ALTER TABLE Song ADD COLUMN content_hash CHAR(32)',
+        'CREATE INDEX IF NOT EXISTS SongByContentHash ON Song(content_hash)',
+    ),
+
+    # 3: Song files that could not be read, with the signature they had at
+    #    the time, so that a rescan only tries them again once they change.
+    (
+        'CREATE TABLE IF NOT EXISTS Quarantine ('
+        '    filesystem_path VARCHAR(500) PRIMARY KEY,'
+        '    error VARCHAR(120) NOT NULL,'
+        '    message TEXT,'
+        '    size INTEGER NOT NULL,'
+        '    mtime INTEGER NOT NULL,'
+        '    inode INTEGER NOT NULL,'
+        '    device INTEGER NOT NULL'
+        ')',
+    ),
+
+    # 4: The last album directory whose songs were committed, per library
+    #    root, so that an interrupted build can be resumed where it stopped.
+    (
+        'CREATE TABLE IF NOT EXISTS Checkpoint ('
+        '    root VARCHAR(500) PRIMARY KEY,'
+        '    directory VARCHAR(500) NOT NULL'
+        ')',
+    ),
+
+    # 5: Aggregates of the songs of each album, kept up to date by
+    #    DatabaseLoader, so that the audit and the web pages don't have to
+    #    go through the songs to count them or add up their durations.
+    (
+        'ALTER TABLE Album ADD COLUMN track_count INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE Album ADD COLUMN duration INTEGER NOT NULL DEFAULT 0',
+        'ALTER TABLE Album ADD COLUMN first_track_number INTEGER',
+        'ALTER TABLE Album ADD COLUMN last_track_number INTEGER',
+        'ALTER TABLE Album'
+        '    ADD COLUMN has_track_gaps INTEGER NOT NULL DEFAULT 0',
+        UPDATE_ALBUM_AGGREGATES,
+    ),
+
+    # 6: Verdicts of verify.py on fully decoding song files, kept with the
+    #    size and modification time the file had, so that a file is only
+    #    decoded again once it changes.
+    (
+        'CREATE TABLE IF NOT EXISTS Verification ('
+        '    filesystem_path VARCHAR(500) PRIMARY KEY,'
+        '    size INTEGER NOT NULL,'
+        '    mtime INTEGER NOT NULL,'
+        '    verdict VARCHAR(20) NOT NULL,'
+        '    message TEXT'
+        ')',
+    ),
+]
+
+
+def path_range(root):
+    # Bounds for selecting the paths under root with an indexed range query
+    # rather than a scan: every such path starts with root and a separator,
+    # and sorts before root followed by the character after the separator.
+    prefix = os.path.join(root, '')
+    return {'first_path': prefix,
+            'past_last_path': prefix[:-1] + chr(ord(prefix[-1]) + 1)}
+
+
+def schema_version(connection):
+    version, = connection.execute('PRAGMA user_version').fetchone()
+    return version
+
+
+def migrate_schema(connection):
+    # Bring the database up to the latest schema version, in place. Each
+    # migration runs in its own transaction together with the version bump,
+    # so an interrupted migration is simply applied again next time.
+    version = schema_version(connection)
+    for new_version in range(version + 1, len(SCHEMA_MIGRATIONS) + 1):
+        connection.execute('BEGIN')
+        try:
+            for statement in SCHEMA_MIGRATIONS[new_version - 1]:
+                connection.execute(statement)
+            connection.execute('PRAGMA user_version = {:d}'.format(new_version))
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+    return version, schema_version(connection)
 
 
 class BaseDatabaseManager(object):
@@ -41,8 +187,13 @@ class DatabaseAPI(BaseDatabaseManager):
 
     def get_library_runtime(self):
         cursor = self.connection.cursor()
-        duration_in_seconds, = cursor.execute('SELECT SUM(duration) FROM Song')\
-                                     .fetchone()
+        # Add up the durations kept with the albums, and those of the few
+        # songs that have no album.
+        duration_in_seconds, = cursor.execute(
+            'SELECT (SELECT COALESCE(SUM(duration), 0) FROM Album)'
+            '     + (SELECT COALESCE(SUM(duration), 0) FROM Song'
+            '        WHERE album IS NULL)'
+        ).fetchone()
         cursor.close()
         duration = datetime.timedelta(seconds=duration_in_seconds)
         return duration
@@ -173,18 +324,50 @@ class DatabaseAPI(BaseDatabaseManager):
 
 
 class DatabaseLoader(BaseDatabaseManager):
-    def __init__(self, db_file_path):
+    insert_song_query = (
+        'INSERT INTO Song (title, duration, track_number, album,'
+        '                  filesystem_path, artist, content_hash)'
+        ' VALUES (:title, :duration, :track_number, :album, :path, :artist,'
+        '         :content_hash)'
+    )
+    insert_manifest_query = (
+        'INSERT OR REPLACE INTO Manifest'
+        ' VALUES (:path, :size, :mtime, :inode, :device)'
+    )
+
+    def __init__(self, db_file_path, batch_size=None):
         super(DatabaseLoader, self).__init__(db_file_path=db_file_path)
 
-    def initialize_empty_tables(self):
-        print('Initializing empty tables: ', end='')
+        # Without a batch size, every insert is committed on its own. With
+        # one, songs are buffered and written with executemany() in a single
+        # transaction once at least batch_size rows have accumulated at the
+        # end of an album directory. A batch size of 1 therefore commits once
+        # per album directory.
+        self.batch_size = batch_size
+        self._pending_songs = []
+        self._pending_manifest = []
+
+        # Albums that lost songs during a rescan. Those left without any
+        # songs are removed by prune_empty_albums().
+        self._emptied_album_candidates = set()
+
+        # Albums that gained or lost songs since the last commit, whose
+        # aggregates are brought up to date as part of it.
+        self._changed_album_ids = set()
+
+        # Identity map of artist and album primary keys, filled in by
+        # warm_identity_map() before the first song is inserted.
+        self._artist_ids = None
+        self._identity_map_changes = []
 
+    def initialize_empty_tables(self):
+        # Tables that already exist are left alone, so this is safe to call
+        # on a database that is being updated by a rescan.
         cursor = self.connection.cursor()
 
         # Create Artist table
-        print('Artist', end='')
         cursor.execute(
-            'CREATE TABLE Artist ('
+            'CREATE TABLE IF NOT EXISTS Artist ('
             '    id INTEGER PRIMARY KEY,'
             '    name VARCHAR(120)'
             ')'
@@ -194,9 +377,8 @@ class DatabaseLoader(BaseDatabaseManager):
         self.connection.commit()
 
         # Create Album table
-        print(', Album', end='')
         cursor.execute(
-            'CREATE TABLE Album ('
+            'CREATE TABLE IF NOT EXISTS Album ('
             '    id INTEGER PRIMARY KEY,'
             '    title VARCHAR(120) NOT NULL,'
             '    year INTEGER,'     # The year attribute is allowed to be null.
@@ -207,10 +389,9 @@ class DatabaseLoader(BaseDatabaseManager):
         )
         self.connection.commit()
 
-        print(', Song', end='')
         # Create the Song table
         cursor.execute(
-            'CREATE TABLE Song ('
+            'CREATE TABLE IF NOT EXISTS Song ('
             '    id INTEGER PRIMARY KEY,'
             '    title VARCHAR(120) NOT NULL,'
             '    duration INTEGER,'
@@ -224,43 +405,467 @@ class DatabaseLoader(BaseDatabaseManager):
         )
         self.connection.commit()
 
-        # Close the cursor before exiting.
-        print('... empty table created at {}!'.format(self.path))
+        # The manifest records the file signature of every song as it was
+        # when the song was parsed, so that a rescan can skip files that
+        # haven't changed since.
+        cursor.execute(
+            'CREATE TABLE IF NOT EXISTS Manifest ('
+            '    filesystem_path VARCHAR(500) PRIMARY KEY,'
+            '    size INTEGER NOT NULL,'
+            '    mtime INTEGER NOT NULL,'
+            '    inode INTEGER NOT NULL,'
+            '    device INTEGER NOT NULL'
+            ')'
+        )
+        self.connection.commit()
+        cursor.close()
+
+        old_version, new_version = migrate_schema(self.connection)
+        if old_version != new_version:
+            logger.info('Migrated {} from schema version {} to {}'.format(
+                self.path, old_version, new_version
+            ))
+
+        logger.info('Tables ready at {}'.format(self.path))
+
+    def clear_library(self):
+        # Empty the tables a build fills, to build the database again from
+        # scratch. With the tables empty, SQLite hands out primary keys from
+        # 1 again. The verdicts of verify.py are about files rather than
+        # songs, and are kept.
+        for table in ('Song', 'Album', 'Artist', 'Manifest', 'Quarantine',
+                      'Checkpoint'):
+            self.connection.execute('DELETE FROM {}'.format(table))
+        self._emptied_album_candidates = set()
+        self._changed_album_ids = set()
+        self._artist_ids = None
+        self._commit()
+
+    def load_manifest(self, root):
+        # Map the path of every song under the given root to the signature
+        # its file had when it was parsed. Songs loaded before the manifest
+        # existed map to None, so they will be parsed again.
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT Song.filesystem_path, Manifest.size, Manifest.mtime,'
+            '       Manifest.inode, Manifest.device'
+            ' FROM Song LEFT JOIN Manifest'
+            '   ON Manifest.filesystem_path=Song.filesystem_path'
+            ' WHERE Song.filesystem_path >= :first_path'
+            '   AND Song.filesystem_path < :past_last_path',
+            path_range(root)
+        )
+
+        manifest = {}
+        for path, size, mtime, inode, device in cursor:
+            if size is None:
+                manifest[path] = None
+            else:
+                manifest[path] = FileSignature(size, mtime, inode, device)
+
+        cursor.close()
+        return manifest
+
+    def load_quarantine(self, root):
+        # Map the path of every quarantined file under the given root to the
+        # signature it had when it failed to load.
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT filesystem_path, size, mtime, inode, device'
+                       ' FROM Quarantine'
+                       ' WHERE filesystem_path >= :first_path'
+                       '   AND filesystem_path < :past_last_path',
+                       path_range(root))
+        quarantine = {
+            path: FileSignature(size, mtime, inode, device)
+            for path, size, mtime, inode, device in cursor
+        }
+        cursor.close()
+        return quarantine
+
+    def quarantine_file(self, path, signature, error, message):
+        # Set aside a song file that could not be read.
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'INSERT OR REPLACE INTO Quarantine'
+            ' VALUES (:path, :error, :message, :size, :mtime, :inode, :device)',
+            dict(signature._asdict(), path=path, error=error, message=message)
+        )
+        self._commit()
+        cursor.close()
+
+    def release_from_quarantine(self, path):
+        # Forget a quarantined file, because it has been read successfully
+        # after all or because it is gone.
+        cursor = self.connection.cursor()
+        cursor.execute('DELETE FROM Quarantine WHERE filesystem_path=:path',
+                       {'path': path})
+        self._commit()
+        cursor.close()
+
+    def load_checkpoint(self, root):
+        # Return the last album directory committed under the given root, or
+        # None if the last build of it ran to completion.
+        row = self.connection.execute(
+            'SELECT directory FROM Checkpoint WHERE root=:root',
+            {'root': root}
+        ).fetchone()
+        return row[0] if row is not None else None
+
+    def clear_checkpoint(self, root):
+        self.connection.execute('DELETE FROM Checkpoint WHERE root=:root',
+                                {'root': root})
+        self._commit()
+
+    def load_verdicts(self, root):
+        # Map the path of every song file verified under the given root to
+        # the (size, mtime, verdict, message) it was verified with.
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT filesystem_path, size, mtime, verdict, message'
+                       ' FROM Verification'
+                       ' WHERE filesystem_path >= :first_path'
+                       '   AND filesystem_path < :past_last_path',
+                       path_range(root))
+        verdicts = {path: (size, mtime, verdict, message)
+                    for path, size, mtime, verdict, message in cursor}
         cursor.close()
+        return verdicts
+
+    def record_verdict(self, path, signature, verdict, message=None):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO Verification'
+            ' VALUES (:path, :size, :mtime, :verdict, :message)',
+            {'path': path, 'size': signature.size, 'mtime': signature.mtime,
+             'verdict': verdict, 'message': message}
+        )
+        self._commit()
 
-    def insert_song(self, song):
-        print('Inserting new song: {}'.format(song))
+    def forget_verdict(self, path):
+        # The file is gone.
+        self.connection.execute(
+            'DELETE FROM Verification WHERE filesystem_path=:path',
+            {'path': path}
+        )
+        self._commit()
+
+    def paths_without_content_hash(self, root):
+        # The unary + keeps SQLite from walking the index on content_hash,
+        # whose NULLs span every root, instead of the range of paths.
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'SELECT filesystem_path FROM Song'
+            ' WHERE filesystem_path >= :first_path'
+            '   AND filesystem_path < :past_last_path'
+            '   AND +content_hash IS NULL',
+            path_range(root)
+        )
+        paths = set(path for path, in cursor)
+        cursor.close()
+        return paths
+
+    def set_content_hash(self, path, content_hash):
+        cursor = self.connection.cursor()
+        cursor.execute(
+            'UPDATE Song SET content_hash=:content_hash'
+            ' WHERE filesystem_path=:path',
+            {'path': path, 'content_hash': content_hash}
+        )
+        self._commit()
+        cursor.close()
+
+    def insert_song(self, song, signature=None):
+        logger.debug('Inserting new song: {}'.format(song))
+
+        if self._artist_ids is None:
+            self.warm_identity_map()
 
         # Grab a cursor to use for inserts and queries
         cursor = self.connection.cursor()
 
-        # Determine if the song's artist already exists in the Artist table.
-        # If not, add a new artist.
-        # If the artist already exists in the database, query for its
-        # primary key.
-        artist_id = self.find_artist_id(song.artist, cursor)
+        with profiling.stage('resolve'):
+            # Determine if the song's artist already exists in the Artist
+            # table. If not, add a new artist.
+            # If the artist already exists in the database, query for its
+            # primary key.
+            artist_id = self.find_artist_id(song.artist, cursor)
 
-        # Determine if the song's album already exists in the Album table.
-        # If not, add a new album.
-        # If the album already exists, query for its primary key.
-        album_id = self.find_album_id(song, cursor)
+            # Determine if the song's album already exists in the Album
+            # table. If not, add a new album.
+            # If the album already exists, query for its primary key.
+            album_id = self.find_album_id(song, cursor)
 
         # Finally, insert the song into the database.
+        song_row = {
+            'title': song.title,
+            'duration': song.length.total_seconds(),
+            'track_number': song.tracknumber,
+            'album': album_id,
+            'path': song.path,
+            'artist': artist_id,
+            'content_hash': song.content_hash,
+        }
+        if signature is not None:
+            manifest_row = dict(signature._asdict(), path=song.path)
+        if album_id is not None:
+            self._changed_album_ids.add(album_id)
+
+        if self.batch_size:
+            # Bulk-load mode: hold on to the row until the batch is flushed.
+            self._pending_songs.append(song_row)
+            if signature is not None:
+                self._pending_manifest.append(manifest_row)
+            cursor.close()
+            return None
+
+        with profiling.stage('insert'):
+            cursor.execute(self.insert_song_query, song_row)
+            song_id = cursor.lastrowid
+            if signature is not None:
+                cursor.execute(self.insert_manifest_query, manifest_row)
+        self._commit_transaction()
+        return song_id
+
+    def insert_album_songs(self, songs, signatures=None, checkpoint=None):
+        # Insert every song found in one album directory. In bulk-load mode
+        # the album's songs join the current batch, which is flushed once it
+        # holds at least batch_size rows, so an album is never split across
+        # two transactions.
+        #
+        # checkpoint, a (root, directory) pair, records the album directory
+        # as done. It is committed together with the album's songs, so after
+        # a crash the checkpoint never claims more than what made it into
+        # the database.
+        if signatures is None:
+            signatures = [None] * len(songs)
+
+        try:
+            for song, signature in zip(songs, signatures):
+                self.insert_song(song, signature=signature)
+
+            if checkpoint is not None:
+                root, directory = checkpoint
+                self.connection.execute(
+                    'INSERT OR REPLACE INTO Checkpoint'
+                    ' VALUES (:root, :directory)',
+                    {'root': root, 'directory': directory}
+                )
+                self._commit()
+
+            if self.batch_size and len(self._pending_songs) >= self.batch_size:
+                self.flush()
+
+        except:
+            self.rollback()
+            raise
+
+    def flush(self):
+        # Write all buffered songs and commit them, together with the
+        # artists and albums they introduced, as one transaction.
+        cursor = self.connection.cursor()
+        try:
+            self._write_pending(cursor)
+            self._commit_transaction()
+
+        except:
+            self.rollback()
+            raise
+
+        finally:
+            cursor.close()
+
+    def _write_pending(self, cursor):
+        with profiling.stage('insert'):
+            if self._pending_songs:
+                cursor.executemany(self.insert_song_query,
+                                   self._pending_songs)
+            if self._pending_manifest:
+                cursor.executemany(self.insert_manifest_query,
+                                   self._pending_manifest)
+        self._pending_songs = []
+        self._pending_manifest = []
+
+    def delete_song(self, path):
+        # Remove a song whose file is gone or is about to be parsed again.
+        # Its album is removed later by prune_empty_albums() if nothing else
+        # is left in it.
+        cursor = self.connection.cursor()
+        album = cursor.execute(
+            'SELECT album FROM Song WHERE filesystem_path=:path',
+            {'path': path}
+        ).fetchone()
+        if album is not None and album[0] is not None:
+            self._emptied_album_candidates.add(album[0])
+            self._changed_album_ids.add(album[0])
+
+        cursor.execute('DELETE FROM Song WHERE filesystem_path=:path',
+                       {'path': path})
+        cursor.execute('DELETE FROM Manifest WHERE filesystem_path=:path',
+                       {'path': path})
+        self._commit()
+        cursor.close()
+
+    def move_song(self, old_path, new_path, signature):
+        # A file was renamed or moved without changing its contents: keep
+        # the parsed song and only point it, and its manifest entry, at the
+        # new path.
+        cursor = self.connection.cursor()
         cursor.execute(
-            'INSERT INTO Song'
-            ' VALUES (NULL, :title, :duration, :track_number,'
-            ' :album, :path, :artist)',
-            {
-                'title': song.title,
-                'duration': song.length.total_seconds(),
-                'track_number': song.tracknumber,
-                'album': album_id,
-                'path': song.path,
-                'artist': artist_id,
-            }
+            'UPDATE Song SET filesystem_path=:new_path'
+            ' WHERE filesystem_path=:old_path',
+            {'old_path': old_path, 'new_path': new_path}
         )
-        self.connection.commit()
-        return cursor.lastrowid
+        cursor.execute('DELETE FROM Manifest WHERE filesystem_path=:path',
+                       {'path': old_path})
+        cursor.execute(self.insert_manifest_query,
+                       dict(signature._asdict(), path=new_path))
+
+        # Albums are recorded under the path of their first song or under
+        # the directory holding it. Follow the move in both cases, unless
+        # another album already claims the new path.
+        cursor.execute(
+            'UPDATE OR IGNORE Album SET filesystem_path=:new_path'
+            ' WHERE filesystem_path=:old_path',
+            {'old_path': old_path, 'new_path': new_path}
+        )
+        old_directory = os.path.dirname(old_path)
+        if not os.path.isdir(old_directory):
+            cursor.execute(
+                'UPDATE OR IGNORE Album SET filesystem_path=:new_path'
+                ' WHERE filesystem_path=:old_path',
+                {'old_path': old_directory,
+                 'new_path': os.path.dirname(new_path)}
+            )
+
+        self._commit()
+        cursor.close()
+
+    def prune_empty_albums(self):
+        # Delete the albums emptied by delete_song(). Buffered songs are
+        # written first, since they may still belong to one of them.
+        cursor = self.connection.cursor()
+        self._write_pending(cursor)
+
+        pruned_album_ids = set()
+        for album_id in sorted(self._emptied_album_candidates):
+            cursor.execute(
+                'DELETE FROM Album WHERE id=:id AND NOT EXISTS ('
+                '    SELECT 1 FROM Song WHERE album=:id'
+                ')',
+                {'id': album_id}
+            )
+            if cursor.rowcount:
+                pruned_album_ids.add(album_id)
+        self._emptied_album_candidates = set()
+
+        if pruned_album_ids and self._artist_ids is not None:
+            for mapping in (self._album_ids_by_year,
+                            self._album_ids_by_artist):
+                for key, album_id in list(mapping.items()):
+                    if album_id in pruned_album_ids:
+                        self._remember_id(mapping, key, None)
+
+        self._commit()
+        cursor.close()
+        return len(pruned_album_ids)
+
+    def rollback(self):
+        # Discard the current batch: buffered songs as well as any artist or
+        # album rows inserted since the last commit. Identifiers handed out
+        # for those rows are dropped from the identity map too, since SQLite
+        # will hand them out again.
+        self.connection.rollback()
+        self._pending_songs = []
+        self._pending_manifest = []
+        self._changed_album_ids = set()
+        self._emptied_album_candidates = set()
+
+        for mapping, key, previous_id in reversed(self._identity_map_changes):
+            self._map_id(mapping, key, previous_id)
+        self._identity_map_changes = []
+
+    def _commit(self):
+        # Artists and albums are committed immediately, unless they are part
+        # of a batch that will be committed by flush().
+        if not self.batch_size:
+            self._commit_transaction()
+
+    def _commit_transaction(self):
+        self._update_album_aggregates()
+        with profiling.stage('commit'):
+            self.connection.commit()
+        self._identity_map_changes = []
+
+    def _update_album_aggregates(self):
+        # Recount the albums whose songs changed in this transaction. Songs
+        # still buffered are counted once they are written, by the commit
+        # that writes them.
+        if not self._changed_album_ids or self._pending_songs:
+            return
+        with profiling.stage('insert'):
+            self.connection.executemany(
+                UPDATE_ALBUM_AGGREGATES + ' WHERE id=:id',
+                ({'id': album_id}
+                 for album_id in sorted(self._changed_album_ids))
+            )
+        self._changed_album_ids = set()
+
+    def warm_identity_map(self):
+        # Artist and album primary keys are kept in dictionaries so that the
+        # songs of an album, which all share the same artist and album, are
+        # resolved from memory rather than with a handful of SELECTs each.
+        # When appending to an existing database, the dictionaries are first
+        # filled from the tables already in it. Where a name matches several
+        # rows, the oldest row wins, just as the original queries picked it.
+        cursor = self.connection.cursor()
+
+        self._artist_ids = {}
+        self._artist_names = {}
+        for id, name in cursor.execute('SELECT id, name FROM Artist'
+                                       ' ORDER BY id'):
+            self._artist_ids.setdefault(name, id)
+            self._artist_names[id] = name
+
+        # Albums are found either by (title, year) or, when a song has no
+        # release year, by (title, artist name).
+        self._album_ids_by_year = {}
+        for id, title, year in cursor.execute('SELECT id, title, year'
+                                              ' FROM Album ORDER BY id'):
+            # Albums without a year have the string 'NULL' stored instead.
+            if isinstance(year, int):
+                self._album_ids_by_year.setdefault((title, year), id)
+
+        # The keys an album is found under by artist name are indexed by the
+        # album's id as well, for when its artist changes.
+        self._album_ids_by_artist = {}
+        self._artist_keys_by_album_id = collections.defaultdict(set)
+        for id, title, name in cursor.execute(
+                'SELECT Album.id, Album.title, Artist.name FROM Album'
+                ' JOIN Artist ON Album.artist=Artist.id'
+                ' ORDER BY Album.id'):
+            if (title, name) not in self._album_ids_by_artist:
+                self._map_id(self._album_ids_by_artist, (title, name), id)
+
+        cursor.close()
+        self._identity_map_changes = []
+
+    def _remember_id(self, mapping, key, id):
+        # Record an identifier in the identity map, keeping track of the
+        # change until it is committed so a rollback can undo it.
+        self._identity_map_changes.append((mapping, key, mapping.get(key)))
+        self._map_id(mapping, key, id)
+
+    def _map_id(self, mapping, key, id):
+        # Set or, with an id of None, remove a key of the identity map.
+        previous_id = mapping.get(key)
+        if id is None:
+            mapping.pop(key, None)
+        else:
+            mapping[key] = id
+
+        if mapping is self._album_ids_by_artist:
+            if previous_id is not None:
+                self._artist_keys_by_album_id[previous_id].discard(key)
+            if id is not None:
+                self._artist_keys_by_album_id[id].add(key)
 
     def find_artist_id(self, artist_name, cursor):
         if artist_name is None:
@@ -273,41 +878,14 @@ class DatabaseLoader(BaseDatabaseManager):
         else:
             # The song does specify its artist. First, let's see if this
             # particular artist already exists in the database.
-            artist_tuples = cursor.execute(
-                'SELECT * FROM Artist WHERE name=:artist',
-                {
-                    'artist': artist_name
-                }
-            )
-            first_artist_tuple = artist_tuples.fetchone()
-
-            # If no results were returned, the provided artist name does not
-            # exist in the database. We'll now insert it, and grab the
-            # primary key of that newly inserted artist.
-            if first_artist_tuple is None:
-                # Insert the artist.
-                # If there's an album artist and a song artist, also insert
-                # the album artist.
-                self.insert_artist(artist_name=artist_name, cursor=cursor)
-
-                # Now extract that artist's unique ID.
-                # Here's one way to do so: simply query the database again.
-                artist_id_tuples = cursor.execute(
-                    'SELECT id FROM Artist WHERE name=:artist',
-                    {
-                        'artist': artist_name
-                    }
-                )
-                first_artist_tuple = artist_id_tuples.fetchone()
-                # Since we only queried for one attribute on the Artist table
-                #  - the id attribute - it'll be the first attribute value in
-                #  the returned tuple.
-                return first_artist_tuple[0]
+            artist_id = self._artist_ids.get(artist_name)
 
-            else:
-                # There exists an artist with the given artist name.
-                # Capture it's primary key and save for later.
-                return first_artist_tuple[0]
+            # If it doesn't, insert it and grab the primary key of that
+            # newly inserted artist.
+            if artist_id is None:
+                artist_id = self.insert_artist(artist_name=artist_name,
+                                               cursor=cursor)
+            return artist_id
 
     def insert_artist(self, artist_name, cursor):
         # Add a new artist into the database.
@@ -320,15 +898,19 @@ class DatabaseLoader(BaseDatabaseManager):
             'INSERT INTO Artist VALUES (NULL, :artist_name)',
             {'artist_name': artist_name}
         )
-        self.connection.commit()
+        artist_id = cursor.lastrowid
+        self._remember_id(self._artist_ids, artist_name, artist_id)
+        self._artist_names[artist_id] = artist_name
+        self._commit()
+        return artist_id
 
     def find_album_id(self, song, cursor):
         # Get the album's path from the directory containing this song.
         album_path = os.path.dirname(song.path)
         # We could use this parameter to search for albums as it qualifies as
         #  a candidate key, but instead I'll use the following methods:
-        #       1. query by album, year
-        #       2. query by album, artist
+        #       1. look up by album, year
+        #       2. look up by album, artist
 
         if song.album_artist is not None:
             artist_id = self.find_artist_id(song.album_artist, cursor)
@@ -338,7 +920,7 @@ class DatabaseLoader(BaseDatabaseManager):
         if song.album is None:
             # The song does not have an album name associated to it.
             # Skip the search for album and return None.
-            print('{path} does not have an album associated to it'.format(
+            logger.debug('{path} does not have an album associated to it'.format(
                 path=song.path
             ))
             return None
@@ -347,98 +929,38 @@ class DatabaseLoader(BaseDatabaseManager):
             # The song specifies both its album name and the release year of
             # the album. We'll use both of these attributes to perform our
             # pre-existing album search.
-            # We'll structure our query using another approach to building
-            # SQL queries: using the ? placeholder.
-            print('Finding album by title ({}) and year ({})'.format(song.album,
-                                                                     song.year))
-            album_tuples = cursor.execute(
-                'SELECT COUNT(*) FROM Album'
-                ' WHERE title=? AND year=?',
-                (song.album, song.year)
-            )
-            album_count_tuple = album_tuples.fetchone()
-
-            # We can unroll the tuple like so. Note that singleton tuples
-            # require the lonesome comma.
-            (album_count,) = album_count_tuple
-            # We could also have just selected the first element of the
-            # album_count_tuple like so, but I'm showing you a lot of ways
-            # to do things in Python
-            # album_count = album_count_tuple[0]
-
-            # If the album count is 0, then the provided album name does not
-            # exist in the database. We'll now insert it, and grab the
-            # primary key of that newly inserted album.
-            if album_count == 0:
-                # Insert the album.
-                # Take a look at how the new album ID is being extracted in the
-                # insert_album() method. It's another way of getting the
-                # primary key of a newly-inserted tuple.
-                new_album_id = self.insert_album(album_name=song.album,
-                                                 album_year=song.year,
-                                                 path=song.path,
-                                                 artist_id=artist_id,
-                                                 cursor=cursor)
-
-                return new_album_id
-
-            else:
-                # There exists an album with the given title and year.
-                # Capture it's primary key and save for later.
-                # Now extract that artist's unique ID.
-                album_id_tuples = cursor.execute(
-                    'SELECT id FROM Album WHERE title=:album AND year=:year',
-                    {
-                        'album': song.album,
-                        'year': song.year,
-                    }
-                )
-                album_id = album_id_tuples.fetchone()[0]
-                return album_id
+            logger.debug('Finding album by title ({}) and year ({})'.format(
+                song.album, song.year
+            ))
+            album_id = self._album_ids_by_year.get((song.album, song.year))
+
+            # If there's no such album yet, insert it and grab the primary
+            # key of that newly inserted album.
+            if album_id is None:
+                album_id = self.insert_album(album_name=song.album,
+                                             album_year=song.year,
+                                             path=song.path,
+                                             artist_id=artist_id,
+                                             cursor=cursor)
+            return album_id
 
         else:
             # The song does specify its album, but not its year. Let's see if
-            #  this particular album already exists in the database where it's
-            #  made by the song's specified artist - multiple artists may create
-            #  an album with the same title, so we want to avoid selecting
-            # the wrong album. To accomplish this, we need a conditional join.
+            #  this particular album already exists where it's made by the
+            #  song's specified artist - multiple artists may create an album
+            #  with the same title, so we want to avoid selecting the wrong
+            #  album.
             artist_name = song.album_artist if song.album_artist\
                                             else song.artist
-            album_tuples = cursor.execute(
-                'SELECT Album.id as album_id FROM Album'
-                ' JOIN Artist ON Album.artist=Artist.id'
-                ' WHERE Artist.name=:artist'
-                ' AND Album.title=:album',
-                {'artist': artist_name,
-                 'album' : song.album}
-            )
-            # In this example, I used Python's string formatting
-            #  functionality to construct the query. However, be careful with
-            #  this! It may lead to a security vulnerability known as SQL
-            #  injection. Don't use this method if you do not trust the source
-            #  of the values being queried on - e.g. if they come from user
-            #  input or data values created by someone other than yourself.
-
-            album_id_tuple = album_tuples.fetchone()
-            if album_id_tuple is None:
-                # No album exists in the table. Insert it now.
-                new_album_id = self.insert_album(album_name=song.album,
-                                                 artist_id=artist_id,
-                                                 path=album_path,
-                                                 cursor=cursor)
-                return new_album_id
+            album_id = self._album_ids_by_artist.get((song.album, artist_name))
 
-            else:
-                # The album-artist pairing exists in the database.
-                # We can extract the album id using it's attribute name.
-                # Notice that we renamed the attribute in the above select
-                # query.
-                album_id = album_id_tuple[0]
-                # We could also have just selected the first element of the
-                # album_count_tuple like so, but I'm showing you a lot of ways
-                # to do things in Python
-                #album_id = album_id_tuple[0]
-                return album_id
+            if album_id is None:
+                # No album exists in the table. Insert it now.
+                album_id = self.insert_album(album_name=song.album,
+                                             artist_id=artist_id,
+                                             path=album_path,
+                                             cursor=cursor)
+            return album_id
 
     def insert_album(self, album_name, artist_id, path, cursor,
                      album_year=None):
@@ -449,50 +971,67 @@ class DatabaseLoader(BaseDatabaseManager):
             #  parameter in the method signature, then its value will default to
             #  None. Optional parameters must go after all non-default parameters.
             cursor.execute(
-                'INSERT INTO Album'
-                ' VALUES (NULL, :title, :year, :path, :artist_foreign_key)',
+                'INSERT INTO Album (title, year, filesystem_path, artist)'
+                ' VALUES (:title, :year, :path, :artist_foreign_key)',
                 {'title': album_name,
                  'year': album_year if album_year is not None else 'NULL',
                  'path': path,
                  'artist_foreign_key': artist_id}
             )
+
+            # We can grab the primary key of this newly-inserted album like
+            # so, without having to execute another query.
+            album_id = cursor.lastrowid
+
+            if album_year is not None:
+                self._remember_id(self._album_ids_by_year,
+                                  (album_name, album_year), album_id)
+            if artist_id is not None:
+                self._remember_id(self._album_ids_by_artist,
+                                  (album_name, self._artist_names[artist_id]),
+                                  album_id)
+
         except sqlite3.IntegrityError:
             # An album already exists according to its path.
             # Determine which attribute is different and update the existing
             # album accordingly.
             album = cursor.execute(
-                'SELECT * FROM Album WHERE filesystem_path=:path',
+                'SELECT id, title, year, filesystem_path, artist FROM Album'
+                ' WHERE filesystem_path=:path',
                 {'path': path}
             ).fetchone()
 
             # Unroll the album tuple into its constituent attributes
             id, title, year, path, pre_existing_artist_id = album
+
+            # The failed insert left cursor.lastrowid pointing at whatever
+            # row was inserted before it, so hang on to the existing album's
+            # primary key instead.
+            album_id = id
             if title != album_name:
-                print('Pre-existing album ({}) is named differently than new '
-                      'album ({}) at the same path ({})'.format(title,
-                                                                album_name,
-                                                                path))
+                logger.debug('Pre-existing album ({}) is named differently'
+                             ' than new album ({}) at the same path'
+                             ' ({})'.format(title, album_name, path))
             if year != album_year:
-                print('Pre-existing album has a different year ({}) than new '
-                      'album ({}) at the same path ({})'.format(year,
-                                                                album_year,
-                                                                path))
+                logger.debug('Pre-existing album has a different year ({})'
+                             ' than new album ({}) at the same path'
+                             ' ({})'.format(year, album_year, path))
             if pre_existing_artist_id != artist_id:
-                print('Pre-existing album has a different artist ({}) than new '
-                      'album ({}) at the same path ({})'.format(
-                            pre_existing_artist_id,
-                            album_year,
-                            path
-                ))
+                logger.debug('Pre-existing album has a different artist ({})'
+                             ' than new album ({}) at the same path'
+                             ' ({})'.format(pre_existing_artist_id,
+                                            album_year,
+                                            path))
                 if artist_id is not None:
                     various_artist_id = self.find_artist_id(
                         artist_name='Various Artists',
                         cursor=cursor
                     )
                     if various_artist_id is None:
-                        self.insert_artist(artist_name='Various Artists',
-                                           cursor=cursor)
-                        various_artist_id = cursor.lastrowid
+                        various_artist_id = self.insert_artist(
+                            artist_name='Various Artists',
+                            cursor=cursor
+                        )
 
                     cursor.execute(
                         'UPDATE Album'
@@ -502,14 +1041,24 @@ class DatabaseLoader(BaseDatabaseManager):
                          'artist_foreign_key': various_artist_id}
                     )
 
-        self.connection.commit()
+                    # The album can no longer be found under its previous
+                    # artist's name, only under 'Various Artists'.
+                    for key in list(self._artist_keys_by_album_id[id]):
+                        if key[0] == title:
+                            self._remember_id(self._album_ids_by_artist, key,
+                                              None)
+                    if (title, 'Various Artists') not in \
+                            self._album_ids_by_artist:
+                        self._remember_id(self._album_ids_by_artist,
+                                          (title, 'Various Artists'), id)
 
-        # We can grab the primary key of this newly-inserted album like so,
-        # without having to execute another query.
-        return cursor.lastrowid
+        self._commit()
+        return album_id
 
 
 if __name__ == '__main__':
-    db = DatabaseLoader('music.db')
+    # Create the tables, or bring an existing database up to date:
+    #    python db.py music_library.db
+    import sys
+    db = DatabaseLoader(sys.argv[1] if len(sys.argv) > 1 else 'music.db')
     db.initialize_empty_tables()
-
@@ -0,0 +1,341 @@
+"""
+Report song files, and albums, whose audio is identical.
+
+Uses the content hashes stored by `python library.py --hash`. Two files
+with the same hash hold the same audio, however differently they are tagged
+or named. Two albums sharing hashes are copies of the same rip, or overlap
+partly, as a compilation does with the albums it draws from.
+
+Copies that aren't identical, such as FLAC and MP3 rips of the same CD,
+are found by the durations of their tracks instead. Albums with as many
+tracks and about the same runtime are compared track by track, and ranked
+by the share of tracks whose durations agree.
+
+Writes duplicate_files.csv, duplicate_albums.csv and
+duplicate_albums_by_duration.csv.
+"""
+import argparse
+import collections
+import csv
+import itertools
+import logging
+import sqlite3
+
+import numpy
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def find_duplicate_files(connection):
+    # Map each content hash shared by several songs to their (song id,
+    # album id, path) tuples.
+    cursor = connection.cursor()
+    cursor.execute(
+        'SELECT content_hash, id, album, filesystem_path FROM Song'
+        ' WHERE content_hash IN ('
+        '    SELECT content_hash FROM Song'
+        '    WHERE content_hash IS NOT NULL'
+        '    GROUP BY content_hash HAVING COUNT(*) > 1'
+        ' )'
+        ' ORDER BY content_hash, filesystem_path'
+    )
+
+    duplicates = collections.OrderedDict()
+    for content_hash, song_id, album_id, path in cursor:
+        duplicates.setdefault(content_hash, []).append(
+            (song_id, album_id, path)
+        )
+
+    cursor.close()
+    return duplicates
+
+
+def find_duplicate_albums(connection, duplicate_files):
+    # Count, for every pair of albums, how many of their tracks share a
+    # content hash. Only hashes found in more than one file matter, so this
+    # never looks at the bulk of the library.
+    shared_track_counts = collections.Counter()
+    for songs in duplicate_files.values():
+        album_ids = sorted(set(album_id for _, album_id, _ in songs
+                               if album_id is not None))
+        for pair in itertools.combinations(album_ids, 2):
+            shared_track_counts[pair] += 1
+
+    if not shared_track_counts:
+        return []
+
+    cursor = connection.cursor()
+    track_counts = dict(cursor.execute(
+        'SELECT id, track_count FROM Album'
+    ).fetchall())
+    albums = {
+        id: (title, artist, path)
+        for id, title, artist, path in cursor.execute(
+            'SELECT Album.id, Album.title, Artist.name, Album.filesystem_path'
+            ' FROM Album LEFT JOIN Artist ON Album.artist=Artist.id'
+        )
+    }
+    cursor.close()
+
+    report = []
+    for (first, second), shared in shared_track_counts.items():
+        smaller_album_size = min(track_counts[first], track_counts[second])
+        report.append({
+            'overlap': round(shared / smaller_album_size, 3),
+            'shared_tracks': shared,
+            'exact': shared == track_counts[first] == track_counts[second],
+            'album_id': first,
+            'title': albums[first][0],
+            'artist': albums[first][1],
+            'tracks': track_counts[first],
+            'path': albums[first][2],
+            'other_album_id': second,
+            'other_title': albums[second][0],
+            'other_artist': albums[second][1],
+            'other_tracks': track_counts[second],
+            'other_path': albums[second][2],
+        })
+
+    report.sort(key=lambda row: (-row['overlap'], -row['shared_tracks'],
+                                 row['album_id'], row['other_album_id']))
+    return report
+
+
+def load_duration_signatures(connection):
+    # Map every track count to the ids of the albums with that many tracks
+    # and a matrix of their track durations, one row per album, in track
+    # number order.
+    rows = connection.execute(
+        'SELECT album, duration FROM Song WHERE album IS NOT NULL'
+        ' ORDER BY album, track_number IS NULL, track_number,'
+        '          filesystem_path'
+    ).fetchall()
+    if not rows:
+        return {}
+
+    album_ids = numpy.fromiter((album_id for album_id, _ in rows),
+                               dtype=numpy.int64, count=len(rows))
+    durations = numpy.fromiter(
+        (duration if duration is not None else numpy.nan
+         for _, duration in rows),
+        dtype=numpy.float64, count=len(rows)
+    )
+
+    # The songs of an album are next to one another: where each album
+    # starts, and how many tracks it has.
+    unique_album_ids, starts, track_counts = numpy.unique(
+        album_ids, return_index=True, return_counts=True
+    )
+
+    signatures = {}
+    for track_count in numpy.unique(track_counts):
+        if track_count < config.duplicate_min_tracks:
+            continue
+        selected = track_counts == track_count
+        indexes = starts[selected][:, numpy.newaxis]\
+                  + numpy.arange(track_count)
+        matrix = durations[indexes]
+
+        # Albums with a track of unknown duration can't be compared.
+        complete = ~numpy.isnan(matrix).any(axis=1)
+        signatures[int(track_count)] = (unique_album_ids[selected][complete],
+                                        matrix[complete])
+    return signatures
+
+
+def compare_signatures(first, second, tolerance, same_group):
+    # Compare every album of one group of duration rows with every album of
+    # another, in blocks small enough to keep memory in check. Yields the
+    # row indexes of the pairs, the number of their tracks within tolerance
+    # seconds of one another, and the mean difference between their tracks.
+    # Within a single group, only the pairs above the diagonal are compared.
+    track_count = first.shape[1]
+    block_rows = max(1, config.duplicate_comparison_block
+                        // max(1, len(second) * track_count))
+    for block_start in range(0, len(first), block_rows):
+        block = first[block_start:block_start + block_rows]
+        differences = numpy.abs(block[:, numpy.newaxis, :]
+                                - second[numpy.newaxis, :, :])
+        matching = numpy.sum(differences <= tolerance, axis=2)
+        mean_differences = differences.mean(axis=2)
+        if same_group:
+            rows = numpy.arange(block_start, block_start + len(block))
+            matching[rows[:, numpy.newaxis] >= numpy.arange(len(second))] = -1
+        yield block_start, matching, mean_differences
+
+
+def find_duration_duplicates(connection, tolerance, min_similarity):
+    # Pairs of albums whose track durations agree, within tolerance seconds,
+    # for at least min_similarity of their tracks. Only albums with as many
+    # tracks, and runtimes in the same or neighbouring buckets of
+    # config.duplicate_runtime_bucket seconds, are compared.
+    signatures = load_duration_signatures(connection)
+
+    pairs = []
+    for track_count, (album_ids, durations) in sorted(signatures.items()):
+        runtimes = durations.sum(axis=1)
+        buckets = numpy.floor(
+            runtimes / config.duplicate_runtime_bucket
+        ).astype(numpy.int64)
+        order = numpy.argsort(buckets, kind='stable')
+        album_ids = album_ids[order]
+        durations = durations[order]
+        buckets = buckets[order]
+
+        bucket_numbers, bucket_starts = numpy.unique(buckets,
+                                                     return_index=True)
+        bucket_ends = numpy.append(bucket_starts[1:], len(buckets))
+        bucket_ranges = dict(zip(bucket_numbers.tolist(),
+                                 zip(bucket_starts.tolist(),
+                                     bucket_ends.tolist())))
+
+        # Albums within a bucket's width of one another are in the same
+        # bucket or in neighbouring ones: compare each bucket with itself
+        # and with the next.
+        for bucket, (start, end) in bucket_ranges.items():
+            comparisons = [(start, end, True)]
+            if bucket + 1 in bucket_ranges:
+                comparisons.append(bucket_ranges[bucket + 1] + (False,))
+            for other_start, other_end, same_group in comparisons:
+                for block_start, matching, mean_differences\
+                        in compare_signatures(
+                            durations[start:end],
+                            durations[other_start:other_end],
+                            tolerance, same_group):
+                    rows, columns = numpy.nonzero(
+                        matching >= min_similarity * track_count
+                    )
+                    for row, column in zip(rows.tolist(), columns.tolist()):
+                        pairs.append((
+                            int(matching[row, column]) / track_count,
+                            float(mean_differences[row, column]),
+                            int(album_ids[start + block_start + row]),
+                            int(album_ids[other_start + column]),
+                            int(matching[row, column]),
+                            track_count
+                        ))
+
+    if not pairs:
+        return []
+
+    albums = {
+        id: (title, artist, path)
+        for id, title, artist, path in connection.execute(
+            'SELECT Album.id, Album.title, Artist.name, Album.filesystem_path'
+            ' FROM Album LEFT JOIN Artist ON Album.artist=Artist.id'
+        )
+    }
+
+    report = []
+    for similarity, mean_difference, first, second, matching, track_count\
+            in pairs:
+        first, second = min(first, second), max(first, second)
+        report.append({
+            'similarity': round(similarity, 3),
+            'matching_tracks': matching,
+            'tracks': track_count,
+            'mean_difference': round(mean_difference, 2),
+            'album_id': first,
+            'title': albums[first][0],
+            'artist': albums[first][1],
+            'path': albums[first][2],
+            'other_album_id': second,
+            'other_title': albums[second][0],
+            'other_artist': albums[second][1],
+            'other_path': albums[second][2],
+        })
+
+    report.sort(key=lambda row: (-row['similarity'], row['mean_difference'],
+                                 row['album_id'], row['other_album_id']))
+    return report
+
+
+def write_reports(duplicate_files, duplicate_albums):
+    with open('duplicate_files.csv', 'w') as f:
+        spreadsheet = csv.writer(f)
+        spreadsheet.writerow(['content_hash', 'song_id', 'album_id', 'path'])
+        for content_hash, songs in duplicate_files.items():
+            for song_id, album_id, path in songs:
+                spreadsheet.writerow([content_hash, song_id, album_id, path])
+
+    fieldnames = ['overlap', 'shared_tracks', 'exact',
+                  'album_id', 'title', 'artist', 'tracks', 'path',
+                  'other_album_id', 'other_title', 'other_artist',
+                  'other_tracks', 'other_path']
+    with open('duplicate_albums.csv', 'w') as f:
+        spreadsheet = csv.DictWriter(f, fieldnames=fieldnames)
+        spreadsheet.writeheader()
+        for row in duplicate_albums:
+            spreadsheet.writerow(row)
+
+
+def write_duration_report(duration_duplicates):
+    fieldnames = ['similarity', 'matching_tracks', 'tracks',
+                  'mean_difference',
+                  'album_id', 'title', 'artist', 'path',
+                  'other_album_id', 'other_title', 'other_artist',
+                  'other_path']
+    with open('duplicate_albums_by_duration.csv', 'w') as f:
+        spreadsheet = csv.DictWriter(f, fieldnames=fieldnames)
+        spreadsheet.writeheader()
+        for row in duration_duplicates:
+            spreadsheet.writerow(row)
+
+
+def main(args):
+    connection = sqlite3.connect(args.database)
+
+    unhashed_count, = connection.execute(
+        'SELECT COUNT(*) FROM Song WHERE content_hash IS NULL'
+    ).fetchone()
+    if unhashed_count:
+        logger.warning('{} songs have no content hash yet; run library.py'
+                       ' --hash to include them'.format(unhashed_count))
+
+    duplicate_files = find_duplicate_files(connection)
+    duplicate_albums = find_duplicate_albums(connection, duplicate_files)
+    write_reports(duplicate_files, duplicate_albums)
+
+    logger.info('{} sets of identical files, {} pairs of overlapping albums'
+                ' ({} exact copies)'.format(
+        len(duplicate_files),
+        len(duplicate_albums),
+        sum(1 for row in duplicate_albums if row['exact'])
+    ))
+
+    duration_duplicates = find_duration_duplicates(
+        connection, tolerance=args.tolerance,
+        min_similarity=args.min_similarity
+    )
+    write_duration_report(duration_duplicates)
+    logger.info('{} pairs of albums with matching track durations'.format(
+        len(duration_duplicates)
+    ))
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Report duplicate song files and albums in the digilib'
+                    ' database.'
+    )
+    parser.add_argument('--database', default=config.database_filename,
+                        help='digilib database (default: %(default)s)')
+    parser.add_argument('--tolerance', type=float,
+                        default=config.duplicate_track_tolerance,
+                        metavar='SECONDS',
+                        help='how far apart the durations of two tracks may'
+                             ' be for them to match (default: %(default)s)')
+    parser.add_argument('--min-similarity', type=float,
+                        default=config.duplicate_min_similarity,
+                        help='share of the tracks of two albums that have to'
+                             ' match for them to be reported'
+                             ' (default: %(default)s)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO,
+                        format='%(levelname)s [%(name)s] %(message)s')
+    main(get_arguments())
@@ -0,0 +1,69 @@
+"""
+Record the problems found while loading song files, one JSON object per line.
+
+Each record holds the path of the file, the kind of error, its message and,
+for files whose tags could be read, a snapshot of the raw tags, so that
+analyze_errors.py never has to open the audio files again.
+"""
+import datetime
+import json
+
+# Size of the write buffer; records are only written out once it fills up.
+BUFFER_SIZE = 1024 * 1024
+
+
+def problem(error, message, tags=None):
+    # A problem with a song file, as collected by the song models. error is
+    # the name of the error class, or of the kind of problem.
+    return {
+        'error': error,
+        'message': message,
+        'tags': tags,
+    }
+
+
+def tag_snapshot(metadata):
+    # Copy the raw tags out of a mutagen file into plain lists of strings.
+    if metadata is None or metadata.tags is None:
+        return None
+    return {key: [str(value) for value in values]
+            for key, values in metadata.items()}
+
+
+class ErrorSink(object):
+    # A buffered, append-only JSONL file shared by a whole ingest run. Only
+    # the process writing to the database writes to it; songs parsed in
+    # worker processes carry their problems back with them.
+
+    def __init__(self, file_path):
+        self.file_path = file_path
+        self.file = open(file_path, 'a', buffering=BUFFER_SIZE,
+                         encoding='utf-8')
+        self.run_started = datetime.datetime.now().isoformat(
+            timespec='seconds'
+        )
+        self.count = 0
+
+    def record(self, path, error, message, tags=None):
+        self.file.write(json.dumps({
+            'run': self.run_started,
+            'path': path,
+            'error': error,
+            'message': message,
+            'tags': tags,
+        }, ensure_ascii=False, sort_keys=True) + '\n')
+        self.count += 1
+
+    def record_song_problems(self, song):
+        for song_problem in song.problems:
+            self.record(song.path, **song_problem)
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
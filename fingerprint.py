@@ -0,0 +1,171 @@
+"""
+Hash the audio payload of a song file, leaving out its tags.
+
+Two copies of the same rip that were tagged differently differ in their
+ID3, Vorbis comment or APE blocks but not in their audio, so only the bytes
+between those blocks are hashed:
+
+- MP3 and other raw streams: everything between the leading ID3v2 tags and
+  the trailing APEv2, Lyrics3v2 and ID3v1 tags.
+- FLAC: the frames following the last metadata block.
+- MP4/M4A: the contents of the 'mdat' atoms.
+- WAV: the contents of the 'data' chunk.
+
+Files whose layout can't be made sense of are hashed whole.
+"""
+import hashlib
+import logging
+import os
+import struct
+
+import riff
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def content_hash(path):
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        try:
+            ranges = payload_ranges(f, file_size, path.lower())
+        except (ValueError, struct.error) as e:
+            logger.debug('Hashing all of {}: {}'.format(path, e))
+            ranges = [(0, file_size)]
+
+        digest = hashlib.blake2b(digest_size=16)
+        buffer = bytearray(CHUNK_SIZE)
+        view = memoryview(buffer)
+        for start, end in ranges:
+            f.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                count = f.readinto(view[:min(remaining, CHUNK_SIZE)])
+                if not count:
+                    break
+                digest.update(view[:count])
+                remaining -= count
+
+        return digest.hexdigest()
+
+
+def payload_ranges(f, file_size, lowercase_path):
+    # Return the list of (start, end) byte ranges holding audio.
+    if lowercase_path.endswith('.wav'):
+        fmt, data_offset, data_size = riff.find_wav_chunks(f, file_size)
+        return [(data_offset, data_offset + data_size)]
+
+    if lowercase_path.endswith(('.m4a', '.mp4')):
+        return _mdat_ranges(f, file_size)
+
+    start = _skip_id3v2(f, 0)
+    if lowercase_path.endswith('.flac'):
+        start = _skip_flac_metadata(f, start)
+    end = _strip_trailing_tags(f, start, file_size)
+    return [(start, end)]
+
+
+def _skip_id3v2(f, offset):
+    # Skip any ID3v2 tags at the given offset; some files carry several.
+    while True:
+        f.seek(offset)
+        header = f.read(10)
+        if len(header) < 10 or header[:3] != b'ID3':
+            return offset
+
+        flags = header[5]
+        size = _syncsafe(header[6:10])
+        offset += 10 + size + (10 if flags & 0x10 else 0)
+
+
+def _syncsafe(data):
+    # ID3v2 sizes are stored in 7 bits per byte.
+    size = 0
+    for byte in data:
+        size = (size << 7) | (byte & 0x7F)
+    return size
+
+
+def _skip_flac_metadata(f, offset):
+    f.seek(offset)
+    if f.read(4) != b'fLaC':
+        raise ValueError('no FLAC stream marker')
+    offset += 4
+
+    while True:
+        header = f.read(4)
+        if len(header) < 4:
+            raise ValueError('truncated FLAC metadata')
+        is_last = header[0] & 0x80
+        length = int.from_bytes(header[1:4], 'big')
+        offset += 4 + length
+        if is_last:
+            return offset
+        f.seek(offset)
+
+
+def _strip_trailing_tags(f, start, end):
+    # Peel ID3v1, APEv2 and Lyrics3v2 tags off the end of the file until
+    # none is left. Taggers don't agree on their order, and files that went
+    # through several of them can carry more than one ID3v1 tag.
+    while True:
+        if end - start >= 128:
+            f.seek(end - 128)
+            if f.read(3) == b'TAG':
+                end -= 128
+                continue
+
+        if end - start >= 32:
+            f.seek(end - 32)
+            footer = f.read(32)
+            if footer[:8] == b'APETAGEX':
+                size, _, flags = struct.unpack('<III', footer[12:24])
+                has_header = flags & 0x80000000
+                # The size counts the footer but not the header. A tag
+                # smaller than its own footer, or larger than the file, is
+                # damaged; trusting it could leave end where it is forever.
+                tag_size = size + (32 if has_header else 0)
+                if size < 32 or tag_size > end - start:
+                    raise ValueError('bad APEv2 tag size {}'.format(size))
+                end -= tag_size
+                continue
+
+            if footer[-9:] == b'LYRICS200':
+                # The size counts the LYRICSBEGIN marker that opens the tag,
+                # but not the size field and LYRICS200 closing it.
+                size = int(footer[-15:-9])
+                tag_size = size + 15
+                if size < len(b'LYRICSBEGIN') or tag_size > end - start:
+                    raise ValueError('bad Lyrics3v2 tag size {}'.format(size))
+                end -= tag_size
+                continue
+
+        if end < start:
+            raise ValueError('trailing tags overlap the audio')
+        return end
+
+
+def _mdat_ranges(f, file_size):
+    ranges = []
+    offset = 0
+    while offset + 8 <= file_size:
+        f.seek(offset)
+        size, atom_type = struct.unpack('>I4s', f.read(8))
+        header_size = 8
+        if size == 1:
+            size, = struct.unpack('>Q', f.read(8))
+            header_size = 16
+        elif size == 0:
+            size = file_size - offset
+        if size < header_size:
+            raise ValueError('invalid atom size')
+
+        if atom_type == b'mdat':
+            ranges.append((offset + header_size,
+                           min(offset + size, file_size)))
+        offset += size
+
+    if not ranges:
+        raise ValueError('no mdat atom')
+    return ranges
@@ -0,0 +1,118 @@
+"""
+Scan library roots on different drives at the same time.
+
+When the library is split over several drives, walking and reading them one
+after the other keeps one drive busy at a time. Roots are grouped by the
+device they live on, and every device gets a lane of its own: a thread that
+works through the roots on that device in turn, with as many worker
+processes as a single root would get. Two lanes never read from the same
+drive, so they don't compete for its heads, and the run takes about as long
+as the largest drive does on its own.
+
+What the lanes load is merged into a single stream for the one thread that
+writes the database, in whatever order the lanes get there. Within a lane
+the order is that of a run on its own.
+"""
+import logging
+import os
+import queue
+import threading
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def group_by_device(items, path=lambda item: item):
+    # Lists of the items whose directories, picked out by path, live on the
+    # same device, in the order the devices first appear in.
+    lanes = {}
+    for item in items:
+        device = os.stat(path(item)).st_dev
+        lanes.setdefault(device, []).append(item)
+    return list(lanes.values())
+
+
+def check_disjoint(directories):
+    # Roots inside one another, or given twice, would have their song files
+    # loaded twice.
+    prefixes = [os.path.join(os.path.abspath(directory), '')
+                for directory in directories]
+    for index, directory in enumerate(directories):
+        for other_index, other_directory in enumerate(directories):
+            if other_index != index and\
+                    prefixes[other_index].startswith(prefixes[index]):
+                raise IOError('"{}" is inside "{}"; give one or the'
+                              ' other'.format(other_directory, directory))
+
+
+class _LaneFailed(object):
+    # Put on the queue in place of a result when a lane raised.
+    def __init__(self, exception):
+        self.exception = exception
+
+
+_LANE_DONE = object()
+
+
+def merge(iterables, depth=config.lane_queue_depth):
+    # Run every iterable in a thread of its own and yield their items as
+    # they come. No lane gets more than depth items ahead of the consumer.
+    # An exception in a lane is raised here; when the consumer stops early
+    # or fails, the lanes are stopped and their iterables closed.
+    if len(iterables) == 1:
+        # Nothing to run alongside: the order stays deterministic.
+        yield from iterables[0]
+        return
+
+    results = queue.Queue(maxsize=depth * len(iterables))
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                results.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def run(iterable):
+        try:
+            for item in iterable:
+                if not put(item):
+                    break
+        except BaseException as e:
+            put(_LaneFailed(e))
+        finally:
+            # Closing the iterable here, in its own thread, runs its
+            # cleanup: a generator's pool is torn down where it was made.
+            close = getattr(iterable, 'close', None)
+            if close is not None:
+                close()
+            put(_LANE_DONE)
+
+    threads = [threading.Thread(target=run, args=(iterable,),
+                                name='lane-{}'.format(number), daemon=True)
+               for number, iterable in enumerate(iterables)]
+    for thread in threads:
+        thread.start()
+
+    try:
+        running = len(threads)
+        while running:
+            item = results.get()
+            if item is _LANE_DONE:
+                running -= 1
+            elif isinstance(item, _LaneFailed):
+                raise item.exception
+            else:
+                yield item
+    finally:
+        stopped.set()
+        for thread in threads:
+            # A lane stops once it has its next item. One waiting on worker
+            # processes interrupted along with us never gets it, and is
+            # left behind: it is a daemon thread, and the pool is torn down
+            # on exit.
+            thread.join(timeout=5)
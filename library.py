@@ -1,41 +1,816 @@
+import argparse
+import collections
+import datetime
+import functools
+import itertools
+import logging
+import multiprocessing
 import os
+import shutil
+import sys
+import time
 import config
 import db
+import errors
+import fingerprint
+import lanes
 import models
+import prefetch
+import profiling
+import throttle
 
+logger = logging.getLogger(__name__)
 
-def load_songs_from_directory(directory):
-    for directory, subdirectories, files in os.walk(directory):
-        songs = []
-        for file in files:
-            if file.lower().endswith(config.valid_extensions):
-                path = os.path.join(directory, file)
-                print(path)
-                if file.lower()\
-                       .endswith(config.mutagen_compliant_extensions):
-                    song = models.MutagenCompatibleSongFile(file_path=path)
-                else:
-                    song = models.SongWavFile(file_path=path)
-                songs.append(song)
-        yield songs
 
+# A song file that needs attention from the loader. Its status is 'new' for
+# files the database doesn't know yet, 'modified' for files that changed since
+# they were parsed, 'moved' for known files that now live at a different
+# path, given as previous_path, and 'unhashed' for unchanged files that only
+# lack a content hash.
+ScannedFile = collections.namedtuple('ScannedFile',
+                                     'path signature status previous_path')
 
-def build_db(directory):
-    if not os.path.isdir(directory):
-        raise IOError('"{}" is not a directory'.format(directory))
+# Returned in place of a song for a file that could not be read.
+UnreadableFile = collections.namedtuple('UnreadableFile', 'error message')
 
-    database = db.DatabaseLoader(db_file_path=config.database_filename)
+# One root directory of the library being built, with what is known about it
+# from previous runs.
+RootScan = collections.namedtuple('RootScan', 'directory diff resume_after')
+
+
+def walk_position(root, directory):
+    # The position of a directory in the walk below: directories are walked
+    # depth-first with siblings in sorted order, which is the order of their
+    # paths split into components. A directory comes after its parent and
+    # before its parent's next sibling.
+    relative_path = os.path.relpath(directory, root)
+    if relative_path == os.curdir:
+        return ()
+    return tuple(relative_path.split(os.sep))
+
+
+def find_song_files(directory, delete_skipped=False, resume_after=None,
+                    recursive=True, skipped_directories=None):
+    # Walk the directory tree depth-first, yielding each directory together
+    # with the song files directly inside it. Entries are visited in sorted
+    # order so that every run, serial or parallel, sees the song files in
+    # the same sequence: the order of insertion decides the primary keys
+    # handed out by the database, so it has to be deterministic.
+    #
+    # os.scandir() tells us which entries are directories without a stat()
+    # per entry, and the one stat() a song file needs is reused for its
+    # manifest signature.
+    #
+    # Directories named in config.skipped_directory_names are passed over,
+    # or deleted along with everything in them if delete_skipped is set.
+    #
+    # Given the album directory an interrupted run got to last, the walk
+    # resumes right after it. Directories up to that one in walk order were
+    # done; the subtrees wholly before it aren't even listed.
+    #
+    # Unless recursive, only the song files directly inside the directory
+    # are yielded.
+    #
+    # Directories that can't be listed are passed over, and added to
+    # skipped_directories if given: what was in them is unknown, not gone.
+    root = directory
+    if resume_after is not None:
+        resume_position = walk_position(root, resume_after)
+
+    pending_directories = [directory]
+    while pending_directories:
+        directory = pending_directories.pop()
+        is_done = False
+        if resume_after is not None:
+            position = walk_position(root, directory)
+            is_done = position <= resume_position
+
+        try:
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError as e:
+            logger.warning('Skipping unreadable directory {}: {}'.format(
+                directory, e
+            ))
+            if skipped_directories is not None:
+                skipped_directories.add(directory)
+            continue
+
+        subdirectories = []
+        song_files = []
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name in config.skipped_directory_names:
+                    if delete_skipped:
+                        logger.info('Deleting {}'.format(entry.path))
+                        shutil.rmtree(entry.path)
+                    else:
+                        logger.debug('Skipping {}'.format(entry.path))
+                    continue
+                if is_done:
+                    # Walk into the remaining subdirectories and those on
+                    # the way to the last one done, but not into any that
+                    # were done completely.
+                    subdirectory_position = position + (entry.name,)
+                    if subdirectory_position < resume_position and\
+                            resume_position[:len(subdirectory_position)]\
+                            != subdirectory_position:
+                        continue
+                subdirectories.append(entry.path)
+            elif is_done:
+                continue
+            elif entry.name.lower().endswith(config.valid_extensions):
+                # A dangling symlink, or a file deleted since the directory
+                # was listed, can't be stat()ed.
+                try:
+                    signature = db.file_signature(entry.stat())
+                except OSError as e:
+                    logger.warning('Skipping unreadable file {}: {}'.format(
+                        entry.path, e
+                    ))
+                    continue
+                song_files.append((entry.path, signature))
+
+        yield directory, song_files
+
+        # Push subdirectories in reverse so that they are popped, and
+        # therefore walked, in sorted order.
+        if recursive:
+            pending_directories.extend(reversed(subdirectories))
+
+
+def list_song_files(directory, skipped_directories=None):
+    # The song files directly inside a directory, as find_song_files() finds
+    # them, without walking any further.
+    for directory, song_files in find_song_files(
+            directory, recursive=False,
+            skipped_directories=skipped_directories):
+        return song_files
+    return []
+
+
+class ProgressLine(object):
+    # A single status line, rewritten in place on a terminal, summarising
+    # how far the ingest has come. When the output isn't a terminal, a
+    # plain line is written every so often instead.
+
+    def __init__(self, stream=sys.stderr, interval=0.5,
+                 non_interactive_interval=30):
+        self.stream = stream
+        self.interactive = stream.isatty()
+        self.interval = interval if self.interactive\
+                                 else non_interactive_interval
+        self.start_time = time.monotonic()
+        self.last_update = 0
+        self.file_count = 0
+        self.album_count = 0
+
+    def update(self, file_count, album_count=1):
+        self.file_count += file_count
+        self.album_count += album_count
+
+        now = time.monotonic()
+        if now - self.last_update >= self.interval:
+            self.last_update = now
+            self._write()
+
+    def finish(self):
+        self._write()
+        if self.interactive:
+            self.stream.write('\n')
+            self.stream.flush()
+
+    def _write(self):
+        elapsed = time.monotonic() - self.start_time
+        line = '{files} files in {albums} album directories loaded,' \
+               ' {rate:.1f} files/s, {elapsed} elapsed'.format(
+            files=self.file_count,
+            albums=self.album_count,
+            rate=self.file_count / elapsed if elapsed else 0,
+            elapsed=datetime.timedelta(seconds=int(elapsed))
+        )
+        if self.interactive:
+            self.stream.write('\r\033[K' + line)
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+class ManifestDiff(object):
+    # Compares the song files found on disk against the manifest of a
+    # previous run, so that only new and modified files are parsed again.
+    # Quarantined files, which failed to load before, are only tried again
+    # once they have changed.
+
+    def __init__(self, manifest, unhashed_paths=frozenset(), quarantine=None,
+                 root=None, resume_after=None, skipped_directories=None):
+        self.manifest = manifest
+        self.unhashed_paths = unhashed_paths
+        self.quarantine = {} if quarantine is None else quarantine
+
+        # When resuming, the files of the directories that were done aren't
+        # looked at again, so their absence says nothing. Neither does that
+        # of the files below directories the walk couldn't read, which it
+        # adds to skipped_directories.
+        self.root = root
+        self.resume_after = resume_after
+        self.skipped_directories = set() if skipped_directories is None\
+                                   else skipped_directories
+        self.seen = set()
+        self.counts = collections.Counter()
+
+        # Index the known files by inode, to recognise files that were moved
+        # or renamed since the last run.
+        self.paths_by_inode = {
+            (signature.device, signature.inode): path
+            for path, signature in manifest.items()
+            if signature is not None
+        }
+
+    def scan(self, found_files):
+        for directory, song_files in found_files:
+            scanned_files = []
+            for path, signature in song_files:
+                scanned_file = self.classify(path, signature)
+                if scanned_file is not None:
+                    scanned_files.append(scanned_file)
+            yield directory, scanned_files
+
+    def classify(self, path, signature):
+        self.seen.add(path)
+
+        if self.quarantine.get(path) == signature:
+            self.counts['quarantined'] += 1
+            return None
+
+        if path in self.manifest:
+            if self.manifest[path] == signature:
+                if path in self.unhashed_paths:
+                    self.counts['unhashed'] += 1
+                    return ScannedFile(path, signature, 'unhashed', None)
+
+                self.counts['unchanged'] += 1
+                return None
+
+            self.counts['modified'] += 1
+            return ScannedFile(path, signature, 'modified', None)
+
+        # A file we haven't seen under this name. If its inode belongs to a
+        # known file whose path no longer exists, and its size and mtime are
+        # unchanged, the file was moved rather than added.
+        previous_path = self.paths_by_inode.get((signature.device,
+                                                 signature.inode))
+        if previous_path is not None:
+            previous_signature = self.manifest[previous_path]
+            if previous_signature.size == signature.size\
+                    and previous_signature.mtime == signature.mtime\
+                    and not os.path.lexists(previous_path):
+                del self.paths_by_inode[(signature.device, signature.inode)]
+                self.seen.add(previous_path)
+                self.counts['moved'] += 1
+                return ScannedFile(path, signature, 'moved', previous_path)
+
+        self.counts['new'] += 1
+        return ScannedFile(path, signature, 'new', None)
+
+    def vanished_paths(self):
+        # Known files that were neither found again nor found moved. Only
+        # meaningful once the scan has been consumed.
+        return self._unseen(self.manifest)
+
+    def vanished_quarantined_paths(self):
+        return self._unseen(self.quarantine)
+
+    def _unseen(self, paths):
+        unseen_paths = set(paths) - self.seen
+        if self.skipped_directories:
+            skipped_prefixes = tuple(os.path.join(directory, '')
+                                     for directory in self.skipped_directories)
+            unseen_paths = set(path for path in unseen_paths
+                               if not path.startswith(skipped_prefixes))
+        if self.resume_after is not None:
+            resume_position = walk_position(self.root, self.resume_after)
+            unseen_paths = set(
+                path for path in unseen_paths
+                if walk_position(self.root, os.path.dirname(path))
+                   > resume_position
+            )
+        return sorted(unseen_paths)
+
+
+def load_song(path):
+    logger.debug('Loading {}'.format(path))
+    if path.lower().endswith(config.mutagen_compliant_extensions):
+        return models.MutagenCompatibleSongFile(file_path=path)
+    else:
+        return models.SongWavFile(file_path=path)
+
+
+def load_scanned_file(scanned_file, hash_content=False):
+    # Moved files keep the song parsed from them before, so there is nothing
+    # to read for them. Unhashed files only need their hash, which is
+    # returned in place of a song.
+    if scanned_file.status == 'moved':
+        return scanned_file, None
+
+    # Whatever goes wrong reading one file is reported for that file alone,
+    # as an UnreadableFile, instead of stopping the whole ingest. Each file
+    # is opened only this once: loading it is what validates it.
     try:
-        database.initialize_empty_tables()
+        with profiling.song_file(scanned_file.path):
+            if scanned_file.status == 'unhashed':
+                with profiling.stage('hash'):
+                    content_hash = fingerprint.content_hash(scanned_file.path)
+                return scanned_file, content_hash
+
+            song = load_song(scanned_file.path)
+            if hash_content:
+                with profiling.stage('hash'):
+                    song.content_hash = fingerprint.content_hash(
+                        scanned_file.path
+                    )
+
+    except Exception as e:
+        logger.warning('Could not read {}: {}: {}'.format(
+            scanned_file.path, type(e).__name__, e
+        ))
+        return scanned_file, UnreadableFile(error=type(e).__name__,
+                                            message=str(e))
+
+    return scanned_file, song
+
+
+def load_profiled_file(scanned_file, hash_content=False):
+    # Load a file in a worker process, handing back what the worker's
+    # profiler measured doing so along with it.
+    loaded_file = load_scanned_file(scanned_file, hash_content=hash_content)
+    return loaded_file, profiling.active().take()
+
+
+def expected_read_bytes(scanned_file, hash_content=False):
+    # How much of a song file loading it reads: all of it to hash it, or
+    # else not more than the head and tail the prefetcher reads, which is
+    # where the tags are.
+    size = scanned_file.signature.size
+    if hash_content or scanned_file.status == 'unhashed':
+        return size
+    return min(size, config.prefetch_head_bytes + config.prefetch_tail_bytes)
+
+
+def load_songs_from_directory(directory, workers=1, diff=None,
+                              hash_content=False, delete_skipped=False,
+                              prefetch_depth=0, resume_after=None,
+                              throttle=None, recursive=True):
+    # Yield, for every album directory with files to load, a list of
+    # (scanned file, song) pairs. Without a manifest diff every song file is
+    # treated as new. With a prefetch depth, that many files ahead of the
+    # parser are read into the page cache in the background. With a
+    # throttle, files are held back before anything is read from them.
+    if diff is None:
+        diff = ManifestDiff(manifest={})
+    scanned_albums = profiling.iterate('walk', diff.scan(find_song_files(
+        directory, delete_skipped=delete_skipped, resume_after=resume_after,
+        recursive=recursive, skipped_directories=diff.skipped_directories
+    )))
+    load = functools.partial(load_scanned_file, hash_content=hash_content)
+
+    if prefetch_depth and workers > 1:
+        # The pool's task feeder only hands out whole chunks, so a smaller
+        # depth than a chunk per worker would leave workers idle, or stall
+        # the feeder altogether.
+        prefetcher = prefetch.Prefetcher(
+            depth=max(prefetch_depth, workers * config.ingest_chunk_size)
+        )
+    elif prefetch_depth:
+        prefetcher = prefetch.Prefetcher(depth=prefetch_depth)
+    else:
+        prefetcher = None
+
+    # Moved files aren't read, so there is nothing to prefetch or throttle
+    # for them.
+    def read_path(scanned_file):
+        return None if scanned_file.status == 'moved' else scanned_file.path
+
+    def gate(scanned_files):
+        if throttle is None:
+            return scanned_files
+        return throttle.gate(scanned_files, path=read_path,
+                             byte_count=functools.partial(
+                                 expected_read_bytes, hash_content=hash_content
+                             ))
+
+    if workers <= 1:
+        if prefetcher is None:
+            for album_directory, scanned_files in scanned_albums:
+                if scanned_files:
+                    yield [load(f) for f in gate(scanned_files)]
+            return
+
+        scanned_files = prefetcher.readahead(
+            gate(scanned_file
+                 for album_directory, scanned_files in scanned_albums
+                 for scanned_file in scanned_files),
+            path=read_path
+        )
+        try:
+            grouped = itertools.groupby(
+                scanned_files,
+                key=lambda scanned_file: os.path.dirname(scanned_file.path)
+            )
+            for album_directory, album_files in grouped:
+                yield [load(f) for f in album_files]
+        finally:
+            prefetcher.close()
+        return
+
+    # Tag parsing and duration extraction are handed off to a pool of worker
+    # processes. Pool.imap() returns the parsed songs in the same order the
+    # paths were submitted, so the single writer consuming this generator
+    # sees exactly the sequence a serial run would produce.
+    scanned_files = gate(
+        scanned_file
+        for album_directory, scanned_files in scanned_albums
+        for scanned_file in scanned_files
+    )
+
+    if prefetcher is not None:
+        # The pool's task feeder takes files as fast as it is given them, so
+        # the prefetcher holds it back to prefetch_depth files beyond those
+        # whose results came back.
+        scanned_files = prefetcher.feed(scanned_files, path=read_path)
+
+    profiler = profiling.active()
+    if profiler is not None:
+        # Every worker profiles the files it loads, and the measurements
+        # come back with the songs to be merged here.
+        load = functools.partial(load_profiled_file,
+                                 hash_content=hash_content)
+        pool = multiprocessing.Pool(processes=workers,
+                                    initializer=profiling.enable_worker,
+                                    initargs=(profiler.slowest_count,))
+    else:
+        pool = multiprocessing.Pool(processes=workers)
+    try:
+        loaded_files = pool.imap(load, scanned_files,
+                                 chunksize=config.ingest_chunk_size)
+        if profiler is not None:
+            loaded_files = _merge_measurements(loaded_files, profiler)
+        if prefetcher is not None:
+            loaded_files = _report_done(loaded_files, prefetcher)
+        grouped = itertools.groupby(
+            loaded_files,
+            key=lambda pair: os.path.dirname(pair[0].path)
+        )
+        for album_directory, pairs in grouped:
+            yield list(pairs)
+
+        pool.close()
+    finally:
+        if prefetcher is not None:
+            prefetcher.close()
+        pool.terminate()
+        pool.join()
+
+
+def _report_done(loaded_files, prefetcher):
+    for loaded_file in loaded_files:
+        prefetcher.done()
+        yield loaded_file
+
+
+def _merge_measurements(profiled_files, profiler):
+    for loaded_file, measured in profiled_files:
+        profiler.merge(measured)
+        yield loaded_file
+
+
+def load_lane(scans, **options):
+    # Load the roots on one device, one after the other, yielding every
+    # album directory's files along with the root they are from.
+    for scan in scans:
+        for loaded_files in load_songs_from_directory(
+                directory=scan.directory,
+                diff=scan.diff,
+                resume_after=scan.resume_after,
+                **options):
+            yield scan, loaded_files
+
+
+def store_album(database, loaded_files, quarantine, error_sink,
+                 checkpoint=None):
+    # Write what was loaded from the files of one album directory to the
+    # database: moves, hashes, quarantined files and songs. quarantine maps
+    # the files that were quarantined before. Returns how many files were
+    # quarantined now.
+    songs = []
+    signatures = []
+    quarantined_count = 0
+    for scanned_file, song in loaded_files:
+        if scanned_file.status == 'moved':
+            database.move_song(old_path=scanned_file.previous_path,
+                               new_path=scanned_file.path,
+                               signature=scanned_file.signature)
+            continue
+
+        if isinstance(song, UnreadableFile):
+            error_sink.record(scanned_file.path, song.error, song.message)
+            if scanned_file.status == 'unhashed':
+                # The song was loaded before; only hashing failed.
+                continue
+
+            if scanned_file.status == 'modified':
+                database.delete_song(scanned_file.path)
+            database.quarantine_file(scanned_file.path,
+                                     signature=scanned_file.signature,
+                                     error=song.error,
+                                     message=song.message)
+            quarantined_count += 1
+            continue
+
+        if scanned_file.status == 'unhashed':
+            # Nothing was parsed; all we got back is the hash.
+            content_hash = song
+            database.set_content_hash(scanned_file.path, content_hash)
+            continue
+
+        if scanned_file.status == 'modified':
+            database.delete_song(scanned_file.path)
+        if scanned_file.path in quarantine:
+            database.release_from_quarantine(scanned_file.path)
+
+        songs.append(song)
+        signatures.append(scanned_file.signature)
+        error_sink.record_song_problems(song)
+
+    database.insert_album_songs(songs, signatures=signatures,
+                                checkpoint=checkpoint)
+    return quarantined_count
+
+
+def build_db(directories, workers=1, batch_size=config.ingest_batch_size,
+             hash_content=False, error_log=config.error_log_filename,
+             delete_skipped=False, prefetch_depth=0, resume=False,
+             profiler=None, throttle=None):
+    # directories is the root of the library, or a list of roots. Roots on
+    # separate drives are scanned at the same time, each drive with workers
+    # processes of its own; songs from different drives are then inserted
+    # in the order they come in, so their ids differ from run to run.
+    if isinstance(directories, str):
+        directories = [directories]
+    # The manifest and the checkpoints are keyed on the paths of the song
+    # files, so the same library has to be found under the same root
+    # whichever way it was named.
+    directories = [os.path.abspath(directory) for directory in directories]
+    for directory in directories:
+        if not os.path.isdir(directory):
+            raise IOError('"{}" is not a directory'.format(directory))
+    lanes.check_disjoint(directories)
+
+    database = db.DatabaseLoader(db_file_path=config.database_filename,
+                                 batch_size=batch_size)
+    database.initialize_empty_tables()
+
+    scans = []
+    for directory in directories:
+        # Only files that are new or changed since the last run are parsed.
+        # When hashing, songs loaded without a hash get one as well.
+        if hash_content:
+            unhashed_paths = database.paths_without_content_hash(directory)
+        else:
+            unhashed_paths = frozenset()
+
+        # Every album directory committed is recorded as a checkpoint of its
+        # root, in the same transaction. Resuming skips everything up to the
+        # last one.
+        resume_after = database.load_checkpoint(directory) if resume else None
+        if resume_after is not None:
+            logger.info('Resuming after {}'.format(resume_after))
+        elif resume:
+            logger.info('No interrupted build of {} to resume'.format(
+                directory
+            ))
+
+        diff = ManifestDiff(manifest=database.load_manifest(directory),
+                            unhashed_paths=unhashed_paths,
+                            quarantine=database.load_quarantine(directory),
+                            root=directory,
+                            resume_after=resume_after)
+        scans.append(RootScan(directory, diff, resume_after))
+
+    device_lanes = lanes.group_by_device(scans,
+                                         path=lambda scan: scan.directory)
+    if len(device_lanes) > 1:
+        logger.info('Scanning {} drives at the same time'.format(
+            len(device_lanes)
+        ))
+    loaded_albums = lanes.merge([
+        load_lane(lane_scans,
+                  workers=workers,
+                  hash_content=hash_content,
+                  delete_skipped=delete_skipped,
+                  prefetch_depth=prefetch_depth,
+                  throttle=throttle)
+        for lane_scans in device_lanes
+    ])
+
+    progress = ProgressLine()
+    error_sink = errors.ErrorSink(error_log)
+    quarantined_count = 0
+    if profiler is not None:
+        profiling.enable(profiler)
+    if throttle is not None:
+        throttle.install_signal_handlers()
+        logger.info('Throttling the ingest; send SIGUSR1 to process {} to'
+                    ' pause it, SIGUSR2 to resume, and see {} for the'
+                    ' current rates'.format(os.getpid(), throttle.status_file))
+
+    try:
+        # Walk through the given directories and find song files.
+        for scan, loaded_files in loaded_albums:
+            quarantined_count += store_album(
+                database, loaded_files,
+                quarantine=scan.diff.quarantine,
+                error_sink=error_sink,
+                checkpoint=(scan.directory,
+                            os.path.dirname(loaded_files[0][0].path))
+            )
+            progress.update(file_count=len(loaded_files))
+
+        # Forget the songs whose files are gone, along with any album that
+        # is left empty.
+        vanished_count = 0
+        for scan in scans:
+            for path in scan.diff.vanished_paths():
+                database.delete_song(path)
+                vanished_count += 1
+            for path in scan.diff.vanished_quarantined_paths():
+                database.release_from_quarantine(path)
+            database.clear_checkpoint(scan.directory)
+        pruned_album_count = database.prune_empty_albums()
+
+        # Commit whatever is left in the final, partially filled batch.
+        database.flush()
+
     except:
-        pass
+        database.rollback()
+        raise
+
+    finally:
+        # Stops the lanes still running, if we got here by an exception.
+        loaded_albums.close()
+        progress.finish()
+        error_sink.close()
+        if throttle is not None:
+            throttle.close()
+        if profiler is not None:
+            profiling.disable()
+            report_profile(profiler, workers)
+
+    counts = sum((scan.diff.counts for scan in scans), collections.Counter())
+    logger.info('{new} new, {modified} modified, {moved} moved, {unchanged}'
+                ' unchanged and {deleted} deleted song files; {hashed}'
+                ' previously loaded files hashed; {pruned} empty albums'
+                ' removed'.format(new=counts['new'],
+                                  modified=counts['modified'],
+                                  moved=counts['moved'],
+                                  unchanged=counts['unchanged'],
+                                  deleted=vanished_count,
+                                  hashed=counts['unhashed'],
+                                  pruned=pruned_album_count))
+    if quarantined_count or counts['quarantined']:
+        logger.info('{} unreadable song files quarantined, {} previously'
+                    ' quarantined files unchanged'.format(
+            quarantined_count, counts['quarantined']
+        ))
+    if error_sink.count:
+        logger.info('{} problems with song files recorded in {}'.format(
+            error_sink.count, error_log
+        ))
+
+
+def report_profile(profiler, workers):
+    logger.info('Time spent per stage:\n{}'.format(profiler.summary()))
+    if workers > 1:
+        logger.info('Times of the {} stages are summed over {} worker'
+                    ' processes'.format(', '.join(profiling.WORKER_STAGES),
+                                        workers))
+
+    if profiler.profiled_stage is not None:
+        profiler.dump_stats(config.profile_stats_filename)
+        logger.info('cProfile statistics of the {} stage written to {}'.format(
+            profiler.profiled_stage, config.profile_stats_filename
+        ))
+        return
+
+    hottest_stage = profiler.hottest_stage()
+    if hottest_stage is not None:
+        logger.info('Run again with --profile-stage "{}"{} for the cProfile'
+                    ' statistics of the slowest stage'.format(
+            hottest_stage,
+            ' --workers 1' if workers > 1
+                              and hottest_stage in profiling.WORKER_STAGES
+                           else ''
+        ))
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Build the digilib database from a directory of music.'
+                    ' Run again on the same directory to pick up new,'
+                    ' changed, moved and deleted files.'
+    )
+    parser.add_argument('directories', nargs='+', metavar='directory',
+                        help='root of the digital library; roots on separate'
+                             ' drives are scanned at the same time')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes used to parse song files,'
+                             ' per drive (default: 1, i.e. no process pool)')
+    parser.add_argument('-b', '--batch-size', type=int,
+                        default=config.ingest_batch_size,
+                        help='number of songs written per transaction, rounded'
+                             ' up to whole album directories; 0 commits every'
+                             ' row on its own (default: %(default)s)')
+    parser.add_argument('--shards', type=int, metavar='N',
+                        help='rebuild the database from scratch with N'
+                             ' processes, each loading whole directories at'
+                             ' the top of the library')
+    parser.add_argument('--resume', action='store_true', default=False,
+                        help='pick up an interrupted build of the same'
+                             ' directory where it stopped, without looking at'
+                             ' the album directories it had finished')
+    parser.add_argument('--prefetch', type=int, default=0, metavar='DEPTH',
+                        help='read the tags of the next DEPTH song files into'
+                             ' the page cache ahead of the parser, for slow'
+                             ' network or USB mounts; {} is a good start'
+                             ' (default: 0, no read-ahead)'.format(
+                                 config.prefetch_depth))
+    parser.add_argument('--hash', action='store_true', default=False,
+                        help='also hash the audio payload of every song, for'
+                             ' duplicates.py')
+    parser.add_argument('--errors', default=config.error_log_filename,
+                        help='JSONL file the problems found with song files'
+                             ' are appended to (default: %(default)s)')
+    parser.add_argument('--delete-skipped', action='store_true',
+                        default=False,
+                        help='delete the directories that are never walked'
+                             ' into ({}) instead of just skipping'
+                             ' them'.format(', '.join(
+                                 config.skipped_directory_names)))
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='time every stage of the ingest and list the'
+                             ' slowest song files at the end')
+    parser.add_argument('--profile-stage', choices=profiling.STAGES,
+                        metavar='STAGE',
+                        help='also run one stage ({}) under cProfile and'
+                             ' write its statistics to {}; implies'
+                             ' --profile'.format(
+                                 ', '.join(profiling.STAGES),
+                                 config.profile_stats_filename))
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False, help='log every file and song loaded')
+    throttle.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.shards is not None:
+        if args.shards < 1:
+            parser.error('--shards needs at least one process')
+        if args.workers > 1 or args.resume or args.profile or\
+                args.profile_stage or throttle.from_arguments(args):
+            parser.error('--shards rebuilds with processes of its own, and'
+                         ' takes neither --workers, --resume, profiling nor'
+                         ' throttling')
+    if args.profile_stage in profiling.WORKER_STAGES and args.workers > 1:
+        parser.error('the {} stage runs in the worker processes, out of'
+                     ' reach of cProfile; profile it with --workers'
+                     ' 1'.format(args.profile_stage))
+    return args
+
 
-    # Walk through the given directory and find song files.
-    for album_songs in load_songs_from_directory(directory=directory):
-        for song in album_songs:
-            database.insert_song(song)
+def setup_logging(args):
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(levelname)s [%(name)s] %(message)s'
+    )
 
 
 if __name__ == '__main__':
-    import sys
-    build_db(sys.argv[-1])
+    args = get_arguments()
+    setup_logging(args)
+    if args.shards is not None:
+        # Imported here, since shards.py builds on this module.
+        import shards
+        shards.build_db(args.directories, shard_processes=args.shards,
+                        batch_size=args.batch_size, hash_content=args.hash,
+                        error_log=args.errors,
+                        delete_skipped=args.delete_skipped,
+                        prefetch_depth=args.prefetch)
+        sys.exit()
+    if args.profile or args.profile_stage:
+        profiler = profiling.StageProfiler(profiled_stage=args.profile_stage)
+    else:
+        profiler = None
+    build_db(args.directories, workers=args.workers,
+             batch_size=args.batch_size, hash_content=args.hash,
+             error_log=args.errors, delete_skipped=args.delete_skipped,
+             prefetch_depth=args.prefetch, resume=args.resume,
+             profiler=profiler, throttle=throttle.from_arguments(args))
@@ -1,15 +1,38 @@
 import datetime
-import json
-import traceback
+import logging
 
 import mutagen
 import os
 import soundfile
-import dateutil.parser
 import re
 
+import errors
+import normalize
+import profiling
+import riff
+import tagreader
+
+logger = logging.getLogger(__name__)
+
 
 class SongFile(object):
+    # Ingest creates one of these per file in the library, so they are kept
+    # compact: no per-instance __dict__.
+    __slots__ = (
+        'path',
+        'filename',
+        'tracknumber',
+        'title',
+        'length',
+        'artist',
+        'album_artist',
+        'album',
+        'release_date',
+        'year',
+        'content_hash',
+        'problems',
+    )
+
     filename_regex = re.compile(
         r'(?P<number>\d+)[ \.\-_](?P<title>.+)\.[\w]{3,4}'
     )
@@ -27,6 +50,13 @@ class SongFile(object):
         self.release_date = None
         self.year = None
 
+        # Hash of the audio payload, filled in when ingest is asked to hash.
+        self.content_hash = None
+
+        # Problems found while loading the file, as errors.problem() dicts,
+        # for the ingest run to record in its error sink.
+        self.problems = []
+
     def get_album_info_from_path(self):
         matches = self.filename_regex.search(self.filename)
         if matches:
@@ -36,7 +66,6 @@ class SongFile(object):
         else:
             tracknumber = None
             title = os.path.splitext(self.filename)[0]
-            open('no_track_numbers.txt', 'a').write('{}\n'.format(self.path))
 
         # filename, extension = os.path.splitext(self.filename)
         #
@@ -96,10 +125,26 @@ class SongFile(object):
 
 
 class MutagenCompatibleSongFile(SongFile):
+    __slots__ = ()
+
     def __init__(self, file_path):
         super(MutagenCompatibleSongFile, self).__init__(file_path=file_path)
 
-        metadata = mutagen.File(self.path, easy=True)
+        with profiling.stage('open'):
+            f = open(self.path, 'rb')
+        with f, profiling.stage('tag parse'):
+            # Only the tags needed are read, leaving out cover art and the
+            # like, for the formats tagreader knows its way around.
+            try:
+                metadata = tagreader.read(f)
+            except (tagreader.TagReaderError, mutagen.MutagenError) as e:
+                logger.debug('Falling back to mutagen for {}: {}'.format(
+                    self.path, e
+                ))
+                f.seek(0)
+                metadata = mutagen.File(f, easy=True)
+        if metadata is None:
+            raise ValueError('Not in a format mutagen recognises')
         tnumber, title, artist, album = self.get_album_info_from_path()
 
         self.title = metadata.get('title', [title])[0]
@@ -111,85 +156,74 @@ class MutagenCompatibleSongFile(SongFile):
             self.release_date = self.get_release_date(metadata)
             if self.release_date:
                 self.year = int(self.release_date.year)
-        except ValueError as e:
-            with open('problems.txt', 'a') as f:
-                f.write(traceback.format_exc())
-                f.write('{}\n'.format(e))
-                f.write('{}\n'.format(self.path))
-                f.write(json.dumps(dict(metadata), indent=4))
-                f.write('-' * 120 + '\n')
-
-            traceback.print_exc()
-            print(e)
-        except TypeError as e:
-            with open('problems.txt', 'a') as f:
-                f.write(traceback.format_exc())
-                f.write('{}\n'.format(e))
-                f.write('{}\n'.format(self.path))
-                f.write(json.dumps(dict(metadata), indent=4))
-                f.write('-' * 120 + '\n')
-
-            traceback.print_exc()
-            print(e)
+        except (ValueError, TypeError) as e:
+            self.problems.append(errors.problem(
+                error=type(e).__name__,
+                message='Unusable release date: {}'.format(e),
+                tags=errors.tag_snapshot(metadata)
+            ))
+            logger.warning('Unusable release date in {}: {}'.format(self.path,
+                                                                     e))
 
         duration_in_seconds = int(metadata.info.length)
         self.length = datetime.timedelta(seconds=duration_in_seconds)
 
         # Track number could be a simple number, or XX/NN, where XX is the
-        # track number and NN is the total number of tracks.
-        tracknumber_string = metadata.get('tracknumber', [None])[0]
-        if tracknumber_string:
-            if '/' in tracknumber_string:
-                trackno, trackcount = tracknumber_string.split('/')
-                if trackno:
-                    self.tracknumber = int(trackno)
-                else:
-                    self.tracknumber = tnumber
-
-            else:
-                try:
-                    self.tracknumber = int(tracknumber_string)
-                except:
-                    self.tracknumber = tnumber
-
-        else:
+        # track number and NN is the total number of tracks. Fall back to the
+        # one in the filename when the tag doesn't give one.
+        with profiling.stage('normalize'):
+            self.tracknumber = normalize.track_number(
+                metadata.get('tracknumber', [None])[0]
+            )
+        if self.tracknumber is None:
             self.tracknumber = tnumber
+        if self.tracknumber is None:
+            self.problems.append(errors.problem(
+                error='NoTrackNumber',
+                message='No track number in the tags or the filename',
+                tags=errors.tag_snapshot(metadata)
+            ))
 
     def get_release_date(self, metadata):
         if 'date' in metadata and metadata['date'][0]:
-            date_string = metadata['date'][0]
-            if date_string == '0000':
-                return None
-            
-            try:
-                release_date = dateutil.parser.parse(date_string)
-            except ValueError:
-                if '-00-00' in date_string:
-                    release_date = datetime.date(year=int(date_string[:4]))
-                elif date_string == '0':
-                    release_date = None
-                else:
-                    release_date = datetime.datetime.strptime(
-                        date_string.split(' ')[0],
-                        '%Y-%d-%m'
-                    )
-            return release_date
+            with profiling.stage('normalize'):
+                return normalize.release_date(metadata['date'][0])
 
 class SongWavFile(SongFile):
+    __slots__ = ()
+
     def __init__(self, file_path):
         super(SongWavFile, self).__init__(file_path=file_path)
 
         (self.tracknumber, self.title, 
          self.album, self.artist) = self.get_album_info_from_path()
+        if self.tracknumber is None:
+            self.problems.append(errors.problem(
+                error='NoTrackNumber',
+                message='No track number in the filename'
+            ))
 
-        self.length = self._extract_song_duration()
+        with profiling.stage('tag parse'):
+            self.length = self._extract_song_duration()
 
     def _extract_song_duration(self):
-        # Extract the song's duration from the file
-        # Based on this post: https://stackoverflow.com/a/41617943/412495
-        sound_file = soundfile.SoundFile(self.path)
-        sample_count = len(sound_file)
-        sample_rate = sound_file.samplerate
+        # Extract the song's duration from the file. Reading the RIFF headers
+        # is enough for nearly every WAV file; libsndfile is only asked about
+        # the ones the header parser can't make sense of.
+        try:
+            wav_info = riff.read_wav_info(self.path)
+            sample_count = wav_info.frames
+            sample_rate = wav_info.samplerate
+
+        except riff.RiffError as e:
+            logger.debug('Falling back to soundfile for {}: {}'.format(
+                self.path, e
+            ))
+            # Based on this post: https://stackoverflow.com/a/41617943/412495
+            with soundfile.SoundFile(self.path) as sound_file:
+                sample_count = len(sound_file)
+                sample_rate = sound_file.samplerate
+
         duration_in_seconds = int(sample_count / sample_rate)
 
         return datetime.timedelta(seconds=duration_in_seconds)
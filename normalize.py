@@ -0,0 +1,114 @@
+"""
+Turn the date and track number strings found in tags into values.
+
+Nearly every date tag in the library is a bare year or an ISO 8601 date,
+and nearly every track number a plain integer or "N/M", so those forms are
+recognised directly. dateutil, which is slow, only sees the odd strings left
+over. Albums repeat the same date string for every track, so parsed dates
+are memoised.
+
+To see what a list of tag strings, one per line, normalise to:
+
+    python normalize.py --dates dates.txt
+    python normalize.py --track-numbers track_numbers.txt
+"""
+import argparse
+import datetime
+import functools
+import re
+
+import dateutil.parser
+
+# YYYY, YYYY-MM or YYYY-MM-DD, possibly followed by a time as in ID3v2.4
+# timestamps ("2001-03-04T12:00:00"). Zero months and days, which some
+# taggers write when they only know the year, are allowed.
+_iso_date_regex = re.compile(
+    r'(?P<year>\d{4})(?:-(?P<month>\d{2})(?:-(?P<day>\d{2}))?)?'
+    r'(?:[T ][\d:.]*)?'
+)
+
+
+@functools.lru_cache(maxsize=4096)
+def release_date(date_string):
+    # Return the datetime a date tag stands for, or None if the tag says the
+    # date is unknown. Raises ValueError for strings that aren't dates.
+    date_string = date_string.strip()
+
+    # Zeros alone ("0", "0000", "0000-00-00") mean the date isn't known.
+    if not date_string.strip('0-'):
+        return None
+
+    date = _parse_iso_date(date_string)
+    if date is not None:
+        return date
+
+    try:
+        return dateutil.parser.parse(date_string)
+    except ValueError:
+        # Some taggers write YYYY-DD-MM.
+        return datetime.datetime.strptime(date_string.split(' ')[0],
+                                          '%Y-%d-%m')
+
+
+def _parse_iso_date(date_string):
+    # The fast path: return None for anything that isn't plainly an ISO
+    # date, leaving it to dateutil.
+    match = _iso_date_regex.fullmatch(date_string)
+    if match is None:
+        return None
+
+    year = int(match.group('year'))
+    month = int(match.group('month') or 0)
+    day = int(match.group('day') or 0)
+
+    # A missing or zero month or day is taken to be the first; only the year
+    # ends up in the database.
+    try:
+        return datetime.datetime(year, month or 1, day or 1)
+    except ValueError:
+        # Out of range, e.g. a YYYY-DD-MM date with a day over 12.
+        return None
+
+
+def track_number(tracknumber_string):
+    # Track numbers are either a number or N/M, where N is the track number
+    # and M the number of tracks. Return the track number, or None when
+    # there isn't a usable one.
+    if not tracknumber_string:
+        return None
+
+    number, _, _ = tracknumber_string.partition('/')
+    try:
+        return int(number)
+    except ValueError:
+        return None
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Print what each line of a file of tag strings'
+                    ' normalises to.'
+    )
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--dates', metavar='FILE',
+                       help='file of date tag strings')
+    group.add_argument('--track-numbers', metavar='FILE',
+                       help='file of track number tag strings')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    if args.dates:
+        path, normalise = args.dates, release_date
+    else:
+        path, normalise = args.track_numbers, track_number
+
+    with open(path) as f:
+        for line in f:
+            tag_string = line.rstrip('\n')
+            try:
+                value = normalise(tag_string)
+            except (ValueError, TypeError, OverflowError) as e:
+                value = '{}: {}'.format(type(e).__name__, e)
+            print('{!r}\t{}'.format(tag_string, value))
@@ -0,0 +1,100 @@
+"""
+Read the beginning and end of upcoming song files ahead of the parser.
+
+Tags live at the start of a song file (ID3v2, FLAC metadata, the WAV
+headers) or at its end (ID3v1, APE, often the MP4 'moov' atom), and parsing
+a file takes a few small reads of each. On a network or USB mount every one
+of those reads waits on the device while the CPU sits idle. A few threads
+reading the same blocks for the files next in line put them in the page
+cache, so by the time the parser opens a file its reads are served from
+memory, and the waiting overlaps with parsing the files before it.
+"""
+import collections
+import concurrent.futures
+import logging
+import os
+import threading
+
+import config
+
+logger = logging.getLogger(__name__)
+
+
+def warm(path, head_bytes=config.prefetch_head_bytes,
+         tail_bytes=config.prefetch_tail_bytes):
+    # Read the head and the tail of a file, dropping the bytes: all that
+    # matters is that the kernel now has them cached.
+    try:
+        with open(path, 'rb', buffering=0) as f:
+            file_size = os.fstat(f.fileno()).st_size
+            buffer = bytearray(min(max(head_bytes, tail_bytes), file_size))
+            view = memoryview(buffer)
+
+            f.readinto(view[:min(head_bytes, file_size)])
+            if file_size > head_bytes:
+                tail_start = max(head_bytes, file_size - tail_bytes)
+                f.seek(tail_start)
+                f.readinto(view[:file_size - tail_start])
+
+    except OSError as e:
+        # The loader will run into the same problem and report it.
+        logger.debug('Could not prefetch {}: {}'.format(path, e))
+
+
+class Prefetcher(object):
+    # Warms up to depth files ahead of whoever consumes them, on a pool of
+    # threads. Items are passed through unchanged and in order; path picks
+    # the file to warm out of each item, or returns None for items with no
+    # file to read.
+
+    def __init__(self, depth=config.prefetch_depth,
+                 threads=config.prefetch_threads):
+        self.depth = depth
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=threads, thread_name_prefix='prefetch'
+        )
+        self._slots = threading.Semaphore(depth)
+        self._closed = False
+
+    def readahead(self, items, path=lambda item: item):
+        # For a consumer that asks for the next item once it is done with
+        # the previous one, like a serial loader: each item is handed out
+        # only once the files of the depth items after it are being warmed.
+        window = collections.deque()
+        for item in items:
+            self._warm(path(item))
+            window.append(item)
+            if len(window) > self.depth:
+                yield window.popleft()
+
+        while window:
+            yield window.popleft()
+
+    def feed(self, items, path=lambda item: item):
+        # For a consumer that takes items as fast as they come and queues
+        # them up, like the task feeder of a multiprocessing.Pool: items are
+        # handed out as soon as their file is being warmed, but never more
+        # than depth of them ahead of the ones reported done().
+        for item in items:
+            while not self._slots.acquire(timeout=0.1):
+                if self._closed:
+                    return
+            if self._closed:
+                return
+
+            self._warm(path(item))
+            yield item
+
+    def done(self):
+        # The consumer of feed() has finished with an item.
+        self._slots.release()
+
+    def _warm(self, path):
+        if path is not None:
+            self.executor.submit(warm, path)
+
+    def close(self):
+        # Stop handing out items, so that a feeder blocked in feed() returns,
+        # and drop the reads not started yet.
+        self._closed = True
+        self.executor.shutdown(wait=False, cancel_futures=True)
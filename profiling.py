@@ -0,0 +1,264 @@
+"""
+Measure where the time of an ingest run goes, stage by stage.
+
+The ingest code marks its stages with profiling.stage(); while a
+StageProfiler is enabled, every pass through a stage is counted and its wall
+clock and CPU time added up, and the time spent on each song file as a whole
+is kept for the slowest files. With no profiler enabled the markers cost a
+function call.
+
+Stages don't overlap: a stage entered inside another, such as a commit while
+resolving an artist, pauses the outer one, so the times of the stages add up
+to the time spent in them altogether.
+
+Worker processes each run a profiler of their own and send what it measured
+back with every song file, to be merged into the one of the parent.
+"""
+import cProfile
+import heapq
+import threading
+import time
+
+import config
+
+# The stages of an ingest run, in the order a song file goes through them.
+STAGES = (
+    'walk',         # listing the directories and comparing with the manifest
+    'open',         # opening a song file
+    'tag parse',    # reading its tags and duration
+    'normalize',    # making sense of release dates and track numbers
+    'hash',         # hashing its audio payload, with --hash
+    'resolve',      # finding or inserting its artist and album
+    'insert',       # writing its row
+    'commit',       # committing transactions
+)
+
+# Stages that run in the worker processes when parsing with --workers.
+WORKER_STAGES = ('open', 'tag parse', 'normalize', 'hash')
+
+_profiler = None
+
+
+class _NoStage(object):
+    # Stands in for a stage while no profiler is enabled.
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def enable(profiler):
+    global _profiler
+    _profiler = profiler
+
+
+def disable():
+    global _profiler
+    _profiler = None
+
+
+def active():
+    return _profiler
+
+
+def enable_worker(slowest_count):
+    # Pool initializer: give the worker a profiler of its own, rather than
+    # the copy of the parent's it may have inherited.
+    enable(StageProfiler(slowest_count=slowest_count))
+
+
+def stage(name):
+    if _profiler is None:
+        return _NO_STAGE
+    return _profiler.stage(name)
+
+
+def song_file(path):
+    if _profiler is None:
+        return _NO_STAGE
+    return _profiler.song_file(path)
+
+
+def iterate(name, iterable):
+    # Charge the time taken to produce every item of iterable to a stage.
+    if _profiler is None:
+        return iterable
+    return _profiler.iterate(name, iterable)
+
+
+class _Stage(object):
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        self.profiler._enter(self.name)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._exit()
+        return False
+
+
+class _SongFile(object):
+    def __init__(self, profiler, path):
+        self.profiler = profiler
+        self.path = path
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.profiler._record_file(self.path,
+                                   time.perf_counter() - self.start)
+        return False
+
+
+class StageProfiler(object):
+    # Calls, wall clock and CPU time per stage, and the slowest song files.
+    # With profiled_stage, that one stage is also run under cProfile, which
+    # only sees the stages run in this process.
+
+    def __init__(self, slowest_count=config.profile_slowest_count,
+                 profiled_stage=None):
+        self.slowest_count = slowest_count
+        self.profiled_stage = profiled_stage
+        self.cprofile = cProfile.Profile() if profiled_stage else None
+        self.start_time = time.perf_counter()
+
+        # name -> [calls, wall seconds, CPU seconds]
+        self.totals = {}
+        # A min-heap of (seconds, path) of the slowest song files.
+        self.slowest = []
+
+        # Stages are entered from the main thread and from the thread
+        # feeding a process pool, each with a stack of its own.
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def song_file(self, path):
+        return _SongFile(self, path)
+
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def _stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def _enter(self, name):
+        self._profile(None)
+        stack = self._stack()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        if stack:
+            # Pause the stage we are in.
+            self._charge(stack[-1], wall, cpu, calls=0)
+        stack.append([name, wall, cpu])
+        self._profile(name)
+
+    def _exit(self):
+        self._profile(None)
+        stack = self._stack()
+        wall, cpu = time.perf_counter(), time.thread_time()
+        self._charge(stack.pop(), wall, cpu, calls=1)
+        if stack:
+            # Resume the stage we came from.
+            stack[-1][1:] = [wall, cpu]
+            self._profile(stack[-1][0])
+
+    def _charge(self, entry, wall, cpu, calls):
+        name, wall_start, cpu_start = entry
+        with self._lock:
+            totals = self.totals.setdefault(name, [0, 0.0, 0.0])
+            totals[0] += calls
+            totals[1] += wall - wall_start
+            totals[2] += cpu - cpu_start
+
+    def _profile(self, name):
+        # Run cProfile exactly while the profiled stage is the current one,
+        # leaving out the bookkeeping above.
+        if self.cprofile is None:
+            return
+        if name == self.profiled_stage:
+            self.cprofile.enable()
+        else:
+            self.cprofile.disable()
+
+    def _record_file(self, path, seconds):
+        if not self.slowest_count:
+            return
+        with self._lock:
+            if len(self.slowest) < self.slowest_count:
+                heapq.heappush(self.slowest, (seconds, path))
+            else:
+                heapq.heappushpop(self.slowest, (seconds, path))
+
+    def take(self):
+        # Return what was measured so far, as plain data that pickles
+        # cheaply, and start over.
+        with self._lock:
+            measured = {'totals': self.totals, 'slowest': self.slowest}
+            self.totals = {}
+            self.slowest = []
+        return measured
+
+    def merge(self, measured):
+        # Add what another profiler took().
+        with self._lock:
+            for name, (calls, wall, cpu) in measured['totals'].items():
+                totals = self.totals.setdefault(name, [0, 0.0, 0.0])
+                totals[0] += calls
+                totals[1] += wall
+                totals[2] += cpu
+        for seconds, path in measured['slowest']:
+            self._record_file(path, seconds)
+
+    def hottest_stage(self):
+        if not self.totals:
+            return None
+        return max(self.totals, key=lambda name: self.totals[name][1])
+
+    def dump_stats(self, file_path):
+        # Write the cProfile statistics of the profiled stage, for
+        # python -m pstats or snakeviz.
+        self.cprofile.disable()
+        self.cprofile.dump_stats(file_path)
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start_time
+        lines = ['{:<10} {:>9} {:>10} {:>10} {:>11}'.format(
+            'stage', 'calls', 'wall s', 'CPU s', 'wall/call'
+        )]
+        names = [name for name in STAGES if name in self.totals]
+        names.extend(sorted(set(self.totals) - set(STAGES)))
+        for name in names:
+            calls, wall, cpu = self.totals[name]
+            lines.append('{:<10} {:>9} {:>10.3f} {:>10.3f} {:>9.1f}us'.format(
+                name, calls, wall, cpu, wall / calls * 1e6 if calls else 0
+            ))
+        lines.append('{:<10} {:>9} {:>10.3f}'.format('elapsed', '', elapsed))
+
+        if self.slowest:
+            lines.append('slowest song files:')
+            for seconds, path in sorted(self.slowest, reverse=True):
+                lines.append('{:>10.3f} s  {}'.format(seconds, path))
+        return '\n'.join(lines)
@@ -0,0 +1,121 @@
+"""
+Read the duration of a WAV file from its RIFF headers alone.
+
+A WAV file is a RIFF container: a 12 byte header followed by chunks, each
+made of a four character ID, a little-endian 32 bit size and the chunk's
+payload, padded to an even length. The 'fmt ' chunk describes the samples
+and the 'data' chunk holds them, so the number of sample frames follows from
+the size of the 'data' chunk and the block alignment given in 'fmt '. RF64
+and BW64 files, used for recordings over 4 GiB, store the real sizes in a
+'ds64' chunk and put 0xFFFFFFFF in the 32 bit size fields.
+
+Only the headers are read, usually a few hundred bytes, instead of opening
+the file with libsndfile.
+"""
+import collections
+import os
+import struct
+
+WavInfo = collections.namedtuple('WavInfo', 'frames samplerate channels')
+
+# Formats whose sample frames all have the same size, block_align bytes.
+# Anything else (ADPCM, MP3 in WAV, ...) is left to libsndfile, whose frame
+# count for those doesn't always agree with the 'fact' chunk.
+_FIXED_SIZE_FORMATS = (
+    0x0001,     # PCM
+    0x0003,     # IEEE float
+    0x0006,     # A-law
+    0x0007,     # mu-law
+)
+_WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+_UNKNOWN_SIZE = 0xFFFFFFFF
+
+
+class RiffError(ValueError):
+    # The file is not a WAV file we know how to read the headers of.
+    pass
+
+
+def read_wav_info(path):
+    with open(path, 'rb') as f:
+        fmt, data_offset, data_size = find_wav_chunks(
+            f, file_size=os.fstat(f.fileno()).st_size
+        )
+        return _wav_info(fmt, data_size)
+
+
+def find_wav_chunks(f, file_size):
+    # Return the unpacked 'fmt ' chunk, and the offset and size of the
+    # 'data' chunk's payload.
+    header = f.read(12)
+    if len(header) < 12:
+        raise RiffError('file too short for a RIFF header')
+
+    container, riff_size, form = struct.unpack('<4sI4s', header)
+    if container not in (b'RIFF', b'RF64', b'BW64') or form != b'WAVE':
+        raise RiffError('not a RIFF/WAVE file')
+
+    is_64_bit = container != b'RIFF'
+    ds64_data_size = None
+    fmt = None
+
+    while True:
+        chunk_header = f.read(8)
+        if len(chunk_header) < 8:
+            raise RiffError('no data chunk found')
+
+        chunk_id, chunk_size = struct.unpack('<4sI', chunk_header)
+
+        if chunk_id == b'ds64' and is_64_bit:
+            payload = f.read(chunk_size)
+            if len(payload) < 24:
+                raise RiffError('truncated ds64 chunk')
+            _, ds64_data_size, _ = struct.unpack('<QQQ', payload[:24])
+
+        elif chunk_id == b'fmt ':
+            payload = f.read(chunk_size)
+            if len(payload) < 16:
+                raise RiffError('truncated fmt chunk')
+            fmt = struct.unpack('<HHIIHH', payload[:16])
+            if fmt[0] == _WAVE_FORMAT_EXTENSIBLE:
+                if len(payload) < 26:
+                    raise RiffError('truncated extensible fmt chunk')
+                # The real format tag is the first two bytes of the
+                # sub-format GUID.
+                sub_format, = struct.unpack('<H', payload[24:26])
+                fmt = (sub_format,) + fmt[1:]
+
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise RiffError('data chunk before fmt chunk')
+            if is_64_bit and chunk_size == _UNKNOWN_SIZE:
+                if ds64_data_size is None:
+                    raise RiffError('64 bit data size without a ds64 chunk')
+                chunk_size = ds64_data_size
+
+            # A truncated file holds less audio than its header claims;
+            # count only what is actually there.
+            data_offset = f.tell()
+            data_size = min(chunk_size, file_size - data_offset)
+            return fmt, data_offset, data_size
+
+        else:
+            f.seek(chunk_size, os.SEEK_CUR)
+
+        # Chunks are padded to an even number of bytes.
+        if chunk_size % 2:
+            f.seek(1, os.SEEK_CUR)
+
+
+def _wav_info(fmt, data_size):
+    format_tag, channels, samplerate, _, block_align, _ = fmt
+    if not samplerate or not channels or not block_align:
+        raise RiffError('invalid fmt chunk')
+
+    if format_tag not in _FIXED_SIZE_FORMATS:
+        raise RiffError('cannot count frames of format 0x{:04x}'.format(
+            format_tag
+        ))
+
+    frames = data_size // block_align
+    return WavInfo(frames=frames, samplerate=samplerate, channels=channels)
@@ -0,0 +1,277 @@
+"""
+Rebuild the database from scratch with several processes loading the
+library at once.
+
+With library.py --workers, song files are parsed in parallel but everything
+else, walking the tree, classifying files and handing every song to the one
+process writing the database, happens in a single process. Here the library
+is split into shards instead: the song files directly inside each root, and
+every directory at the top of a root, usually an artist. Each shard is
+loaded from start to end by a worker process of its own, which walks it,
+parses its song files and stages what it read in a temporary database of the
+shard's own.
+
+The staged shards are then merged into the database, in the order a single
+process would have walked them, while the workers carry on with the shards
+after them. Artist and album identifiers are handed out by the merge alone,
+with the same rules as any other build, including the one turning an album
+found under several artists into one by Various Artists: the database comes
+out the same as one built by library.py in a single process.
+"""
+import collections
+import datetime
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+
+import config
+import db
+import errors
+import lanes
+import library
+
+logger = logging.getLogger(__name__)
+
+# A part of the library loaded by one worker: a directory with all that is
+# below it, or, unless recursive, just the song files directly inside it.
+Shard = collections.namedtuple('Shard', 'index directory recursive')
+
+# What a shard stages of a song file, in place of the song parsed from it.
+# It has everything the loader looks at of a song.
+StagedSong = collections.namedtuple(
+    'StagedSong',
+    'path title artist album_artist album year tracknumber length'
+    ' content_hash problems'
+)
+
+
+def split_into_shards(directories, delete_skipped=False):
+    # List the shards of the given roots in walk order: for every root, the
+    # song files directly inside it, then each directory in it, in sorted
+    # order.
+    shards = []
+    for root in directories:
+        shards.append(Shard(len(shards), root, False))
+        with os.scandir(root) as entries:
+            entries = sorted(entries, key=lambda entry: entry.name)
+        for entry in entries:
+            if not entry.is_dir(follow_symlinks=False):
+                continue
+            if entry.name in config.skipped_directory_names:
+                if delete_skipped:
+                    logger.info('Deleting {}'.format(entry.path))
+                    shutil.rmtree(entry.path)
+                continue
+            shards.append(Shard(len(shards), entry.path, True))
+    return shards
+
+
+def create_staging_table(connection):
+    # Columns without a type keep the values exactly as they were parsed.
+    # Files that could not be read have an error and a message instead of a
+    # title.
+    connection.execute(
+        'CREATE TABLE StagedFile ('
+        '    directory, filesystem_path, size, mtime, inode, device,'
+        '    title, artist, album_artist, album, year, track_number,'
+        '    duration, content_hash, problems, error, message'
+        ')'
+    )
+
+
+def load_shard(shard, staging_file_path, hash_content=False,
+               delete_skipped=False, prefetch_depth=0):
+    # Run in a worker process: load the song files of a shard and stage
+    # them, in walk order, in a database of their own. Returns the number
+    # of song files staged.
+    connection = sqlite3.connect(staging_file_path)
+    # The staging database is thrown away after the merge, or if anything
+    # goes wrong before it.
+    connection.execute('PRAGMA journal_mode = OFF')
+    connection.execute('PRAGMA synchronous = OFF')
+    create_staging_table(connection)
+
+    file_count = 0
+    for loaded_files in library.load_songs_from_directory(
+            shard.directory, hash_content=hash_content,
+            delete_skipped=delete_skipped, prefetch_depth=prefetch_depth,
+            recursive=shard.recursive):
+        rows = []
+        for scanned_file, song in loaded_files:
+            row = dict(scanned_file.signature._asdict(),
+                       directory=os.path.dirname(scanned_file.path),
+                       path=scanned_file.path,
+                       title=None, artist=None, album_artist=None,
+                       album=None, year=None, track_number=None,
+                       duration=None, content_hash=None, problems=None,
+                       error=None, message=None)
+            if isinstance(song, library.UnreadableFile):
+                row.update(error=song.error, message=song.message)
+            else:
+                row.update(title=song.title, artist=song.artist,
+                           album_artist=song.album_artist, album=song.album,
+                           year=song.year, track_number=song.tracknumber,
+                           duration=song.length.total_seconds(),
+                           content_hash=song.content_hash,
+                           problems=json.dumps(song.problems,
+                                               ensure_ascii=False)
+                                    if song.problems else None)
+            rows.append(row)
+
+        connection.executemany(
+            'INSERT INTO StagedFile VALUES (:directory, :path, :size, :mtime,'
+            ' :inode, :device, :title, :artist, :album_artist, :album, :year,'
+            ' :track_number, :duration, :content_hash, :problems, :error,'
+            ' :message)',
+            rows
+        )
+        file_count += len(rows)
+
+    connection.commit()
+    connection.close()
+    return file_count
+
+
+def _load_shard(arguments):
+    shard, staging_file_path, options = arguments
+    return load_shard(shard, staging_file_path, **options)
+
+
+def staged_albums(staging_file_path):
+    # Yield the files staged by a shard, album directory by album directory,
+    # as the (scanned file, song) pairs the loader stores.
+    connection = sqlite3.connect(staging_file_path)
+    cursor = connection.execute(
+        'SELECT directory, filesystem_path, size, mtime, inode, device,'
+        '       title, artist, album_artist, album, year, track_number,'
+        '       duration, content_hash, problems, error, message'
+        ' FROM StagedFile ORDER BY rowid'
+    )
+    try:
+        loaded_files = []
+        current_directory = None
+        for (directory, path, size, mtime, inode, device, title, artist,
+             album_artist, album, year, track_number, duration, content_hash,
+             problems, error, message) in cursor:
+            if directory != current_directory and loaded_files:
+                yield loaded_files
+                loaded_files = []
+            current_directory = directory
+
+            scanned_file = library.ScannedFile(
+                path, db.FileSignature(size, mtime, inode, device), 'new', None
+            )
+            if error is not None:
+                song = library.UnreadableFile(error=error, message=message)
+            else:
+                song = StagedSong(
+                    path=path, title=title, artist=artist,
+                    album_artist=album_artist, album=album, year=year,
+                    tracknumber=track_number,
+                    length=datetime.timedelta(seconds=duration),
+                    content_hash=content_hash,
+                    problems=json.loads(problems) if problems else []
+                )
+            loaded_files.append((scanned_file, song))
+
+        if loaded_files:
+            yield loaded_files
+
+    finally:
+        cursor.close()
+        connection.close()
+
+
+def build_db(directories, shard_processes,
+             batch_size=config.ingest_batch_size, hash_content=False,
+             error_log=config.error_log_filename, delete_skipped=False,
+             prefetch_depth=0):
+    # Rebuild the database from scratch out of the given roots, with
+    # shard_processes processes loading shards.
+    if isinstance(directories, str):
+        directories = [directories]
+    # The manifest and the checkpoints are keyed on the paths of the song
+    # files, so the same library has to be found under the same root
+    # whichever way it was named.
+    directories = [os.path.abspath(directory) for directory in directories]
+    for directory in directories:
+        if not os.path.isdir(directory):
+            raise IOError('"{}" is not a directory'.format(directory))
+    lanes.check_disjoint(directories)
+
+    shards = split_into_shards(directories, delete_skipped=delete_skipped)
+    logger.info('Rebuilding the database from {} shards with {}'
+                ' processes'.format(len(shards), shard_processes))
+
+    database = db.DatabaseLoader(db_file_path=config.database_filename,
+                                 batch_size=batch_size)
+    database.initialize_empty_tables()
+
+    # The staging databases go next to the database rather than into a
+    # temporary directory that may be too small for them.
+    staging_directory = tempfile.TemporaryDirectory(
+        prefix='shards-',
+        dir=os.path.dirname(os.path.abspath(config.database_filename))
+    )
+    options = {'hash_content': hash_content,
+               'delete_skipped': delete_skipped,
+               'prefetch_depth': prefetch_depth}
+    tasks = [(shard,
+              os.path.join(staging_directory.name,
+                           'shard-{}.db'.format(shard.index)),
+              options)
+             for shard in shards]
+
+    progress = library.ProgressLine()
+    error_sink = errors.ErrorSink(error_log)
+    quarantined_count = 0
+    file_count = 0
+    pool = multiprocessing.Pool(processes=shard_processes)
+    try:
+        database.clear_library()
+
+        # The shards are merged in order as soon as they are staged, while
+        # the shards after them are being loaded. Every shard is one task,
+        # handed out as processes become free, so that a large artist
+        # doesn't hold up the rest.
+        staged_shards = pool.imap(_load_shard, tasks, chunksize=1)
+        for (shard, staging_file_path, _), staged_file_count\
+                in zip(tasks, staged_shards):
+            for loaded_files in staged_albums(staging_file_path):
+                quarantined_count += library.store_album(
+                    database, loaded_files, quarantine={},
+                    error_sink=error_sink
+                )
+                progress.update(file_count=len(loaded_files))
+            file_count += staged_file_count
+            os.remove(staging_file_path)
+
+        # Commit whatever is left in the final, partially filled batch.
+        database.flush()
+        pool.close()
+
+    except:
+        database.rollback()
+        raise
+
+    finally:
+        pool.terminate()
+        pool.join()
+        progress.finish()
+        error_sink.close()
+        staging_directory.cleanup()
+
+    logger.info('{} song files loaded from {} shards'.format(file_count,
+                                                              len(shards)))
+    if quarantined_count:
+        logger.info('{} unreadable song files quarantined'.format(
+            quarantined_count
+        ))
+    if error_sink.count:
+        logger.info('{} problems with song files recorded in {}'.format(
+            error_sink.count, error_log
+        ))
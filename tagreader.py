@@ -0,0 +1,384 @@
+"""
+Read the tags and length of MP3, FLAC and M4A files without their cover art.
+
+mutagen.File() reads every ID3 frame, FLAC metadata block and iTunes item of
+a file, embedded pictures and all, to hand back a handful of tags and the
+length. This reader walks the layout of the file instead, seeking past what
+it doesn't need, and only reads:
+
+- MP3: the ID3v2 frame headers, the frames holding the tags below, and the
+  first MPEG frames with their Xing/LAME or VBRI header, for the length.
+- FLAC: the metadata block headers, STREAMINFO and VORBIS_COMMENT, and the
+  few bytes that tell how long a PICTURE block is.
+- M4A: the atom headers, the atoms describing the tracks, and the 'ilst'
+  items holding the tags below.
+
+What it read is decoded by mutagen itself, so the tags and the length come
+out exactly as mutagen.File(path, easy=True) gives them. A file laid out in
+a way it doesn't handle, such as an unsynchronised ID3v2.3 tag, raises
+TagReaderError for the caller to fall back to mutagen.
+
+Comparing it with mutagen over a directory:
+    python tagreader.py /path/to/digilib
+"""
+import copy
+import io
+import os
+import struct
+
+import mutagen
+import mutagen.easyid3
+import mutagen.easymp4
+import mutagen.flac
+import mutagen.id3
+import mutagen.mp3
+import mutagen.mp4
+
+# The ID3v2 frames behind the easy tags the song models use: title, artist,
+# album, albumartist, date and tracknumber. ID3v2.3 tags may have the date in
+# TYER, TDAT and TIME instead, which mutagen turns into TDRC.
+ID3_FRAMES = frozenset([b'TIT2', b'TPE1', b'TALB', b'TPE2', b'TDRC', b'TRCK',
+                        b'TYER', b'TDAT', b'TIME'])
+# Frames mutagen fills in from an ID3v1 tag at the end of the file when the
+# ID3v2 tag lacks them; the year goes into TYER in an ID3v2.3 tag.
+ID3V1_FRAMES = {
+    3: frozenset(['TIT2', 'TPE1', 'TALB', 'TYER', 'TRCK']),
+    4: frozenset(['TIT2', 'TPE1', 'TALB', 'TDRC', 'TRCK']),
+}
+
+# The iTunes items behind the same easy tags.
+MP4_ITEMS = frozenset([b'\xa9nam', b'\xa9ART', b'\xa9alb', b'aART',
+                       b'\xa9day', b'trkn'])
+
+FLAC_STREAMINFO = 0
+FLAC_SEEKTABLE = 3
+FLAC_VORBIS_COMMENT = 4
+FLAC_CUESHEET = 5
+FLAC_PICTURE = 6
+
+
+class TagReaderError(ValueError):
+    pass
+
+
+class TagFile(object):
+    # Stands in for what mutagen.File() returns, as far as the song models
+    # use it: the easy tags as a mapping of lists of strings, and the
+    # stream info.
+
+    def __init__(self, tags, info):
+        self.tags = tags
+        self.info = info
+
+    def get(self, key, default=None):
+        if self.tags is None:
+            return default
+        return self.tags.get(key, default)
+
+    def __getitem__(self, key):
+        if self.tags is None:
+            raise KeyError(key)
+        return self.tags[key]
+
+    def __contains__(self, key):
+        return self.tags is not None and key in self.tags
+
+    def keys(self):
+        return [] if self.tags is None else list(self.tags.keys())
+
+    def items(self):
+        return [] if self.tags is None else list(self.tags.items())
+
+
+def read(fileobj):
+    # Read the file open in binary mode as fileobj. Formats are told apart
+    # the way mutagen.File() tells them apart for these three, by extension
+    # and magic.
+    extension = os.path.splitext(getattr(fileobj, 'name', ''))[1].lower()
+    fileobj.seek(0)
+    header = fileobj.read(8)
+
+    if extension == '.mp3' and header.startswith(b'ID3'):
+        return read_mp3(fileobj)
+    elif extension == '.flac' and header.startswith(b'fLaC'):
+        return read_flac(fileobj)
+    elif extension == '.m4a' and header[4:8] == b'ftyp':
+        return read_m4a(fileobj)
+    raise TagReaderError('Not an MP3 with an ID3v2 tag, a FLAC or an M4A'
+                         ' file')
+
+
+def _unsyncsafe(size):
+    return (((size >> 24) & 0x7F) << 21) | (((size >> 16) & 0x7F) << 14)\
+           | (((size >> 8) & 0x7F) << 7) | (size & 0x7F)
+
+
+def _syncsafe(size):
+    return bytes([(size >> 21) & 0x7F, (size >> 14) & 0x7F,
+                  (size >> 7) & 0x7F, size & 0x7F])
+
+
+def read_mp3(fileobj):
+    fileobj.seek(0)
+    _, major_version, revision, flags, size = struct.unpack(
+        '>3sBBBL', fileobj.read(10)
+    )
+    if major_version not in (3, 4):
+        raise TagReaderError('ID3v2.{} tag'.format(major_version))
+    if flags & 0xC0:
+        # The frames of an unsynchronised tag can only be found once the
+        # whole tag is decoded; an extended header is rare enough not to
+        # bother with.
+        raise TagReaderError('Unsynchronised ID3v2 tag or extended header')
+    if size & 0x80808080:
+        raise TagReaderError('ID3v2 tag size not synchsafe')
+    tag_size = _unsyncsafe(size) + 10
+
+    # Copy the frames needed, headers and all, skipping the rest.
+    frames = []
+    offset = 10
+    while offset + 10 <= tag_size:
+        fileobj.seek(offset)
+        frame_header = fileobj.read(10)
+        frame_id, frame_size, _ = struct.unpack('>4sLH', frame_header)
+        if frame_id.strip(b'\x00') == b'':
+            # Padding.
+            break
+        if frame_id.endswith(b'\x00'):
+            raise TagReaderError('ID3v2.2 frame names in an ID3v2.{}'
+                                 ' tag'.format(major_version))
+        if major_version == 4:
+            # iTunes used to write plain integers here, which mutagen
+            # guesses its way around.
+            if frame_size & 0x80808080:
+                raise TagReaderError('ID3v2.4 frame size not synchsafe')
+            frame_size = _unsyncsafe(frame_size)
+
+        offset += 10 + frame_size
+        if offset > tag_size:
+            raise TagReaderError('ID3v2 frame runs past the end of the tag')
+        if frame_id in ID3_FRAMES and frame_size:
+            frames.append(frame_header + fileobj.read(frame_size))
+
+    # Hand mutagen a tag made of those frames alone. The padding keeps it
+    # from mistaking the end of the last frame for an ID3v1 tag.
+    body = b''.join(frames) + bytes(128)
+    tag = b'ID3' + bytes([major_version, revision, 0])\
+          + _syncsafe(len(body)) + body
+
+    if _has_id3v1(fileobj):
+        # Frames missing from the ID3v2 tag would be taken from it, before
+        # TYER and the like are turned into TDRC.
+        frame_ids = mutagen.id3.ID3(io.BytesIO(tag), translate=False).keys()
+        if not ID3V1_FRAMES[major_version].issubset(
+                frame_id[:4] for frame_id in frame_ids):
+            raise TagReaderError('ID3v1 tag to fill in the missing tags'
+                                 ' from')
+
+    tags = mutagen.easyid3.EasyID3(io.BytesIO(tag))
+    info = mutagen.mp3.MPEGInfo(fileobj, offset=tag_size)
+    return TagFile(tags, info)
+
+
+def _has_id3v1(fileobj):
+    # Whether the file may end in an ID3v1 tag, looked for the way mutagen
+    # looks for it: 'TAG' in the last 128 bytes and the 3 before them, that
+    # isn't part of an APEv2 footer.
+    file_size = os.fstat(fileobj.fileno()).st_size
+    fileobj.seek(max(0, file_size - 131))
+    data = fileobj.read(131)
+    index = data.find(b'TAG')
+    ape_index = data.find(b'APETAGEX')
+    return index != -1 and (ape_index == -1 or index != ape_index + 3)
+
+
+def read_flac(fileobj):
+    file_size = os.fstat(fileobj.fileno()).st_size
+    fileobj.seek(4)
+    info = None
+    tags = None
+    block_counts = {FLAC_SEEKTABLE: 0, FLAC_CUESHEET: 0}
+
+    is_last = False
+    while not is_last:
+        block_header = fileobj.read(4)
+        if len(block_header) != 4:
+            raise TagReaderError('FLAC metadata cut short')
+        code = block_header[0] & 0x7F
+        is_last = bool(block_header[0] & 0x80)
+        size = int.from_bytes(block_header[1:], 'big')
+
+        if code == FLAC_STREAMINFO:
+            streaminfo = mutagen.flac.StreamInfo(fileobj.read(size))
+            if info is None:
+                info = streaminfo
+        elif code == FLAC_VORBIS_COMMENT:
+            # Like mutagen, parse the comments from the stream rather than
+            # trusting the block size, which some taggers get wrong.
+            vorbis_comment = mutagen.flac.VCFLACDict(fileobj)
+            if tags is None:
+                tags = vorbis_comment
+        elif code == FLAC_PICTURE:
+            _skip_flac_picture(fileobj)
+        else:
+            if code in block_counts:
+                block_counts[code] += 1
+                if block_counts[code] > 1:
+                    raise TagReaderError('More than one FLAC block of type'
+                                         ' {}'.format(code))
+            fileobj.seek(size, 1)
+
+        if fileobj.tell() > file_size:
+            raise TagReaderError('FLAC metadata runs past the end of the'
+                                 ' file')
+
+    if info is None:
+        raise TagReaderError('No FLAC STREAMINFO block')
+    return TagFile(tags, info)
+
+
+def _skip_flac_picture(fileobj):
+    # The size of a PICTURE block isn't trusted either: read the lengths of
+    # the MIME type, the description and the picture itself, and skip them.
+    _, length = struct.unpack('>2I', _read_exactly(fileobj, 8))
+    fileobj.seek(length, 1)
+    length, = struct.unpack('>I', _read_exactly(fileobj, 4))
+    fileobj.seek(length, 1)
+    length, = struct.unpack('>16xI', _read_exactly(fileobj, 20))
+    fileobj.seek(length, 1)
+
+
+def _read_exactly(fileobj, size):
+    data = fileobj.read(size)
+    if len(data) != size:
+        raise TagReaderError('File cut short')
+    return data
+
+
+class _NeededItems(object):
+    # Stands in for mutagen's tree of atoms when handed to MP4Tags, with an
+    # 'ilst' holding only the items needed. The others, 'covr' above all,
+    # are never read.
+
+    def __init__(self, atoms):
+        path = atoms.path(b'moov', b'udta', b'meta', b'ilst')
+        meta, ilst = path[-2:]
+        needed_ilst = copy.copy(ilst)
+        needed_ilst.children = [item for item in ilst.children
+                                if item.name in MP4_ITEMS]
+        needed_meta = copy.copy(meta)
+        needed_meta.children = [needed_ilst if child is ilst else child
+                                for child in meta.children]
+        self._path = path[:-2] + [needed_meta, needed_ilst]
+
+    def path(self, *names):
+        return self._path
+
+
+def read_m4a(fileobj):
+    # Reading the atom tree only reads the headers of the leaf atoms.
+    fileobj.seek(0)
+    try:
+        atoms = mutagen.mp4.Atoms(fileobj)
+    except Exception as e:
+        raise TagReaderError('Unreadable MP4 atoms: {}'.format(e))
+
+    if b'moov.udta.chpl' in atoms:
+        raise TagReaderError('MP4 chapters')
+
+    info = mutagen.mp4.MP4Info()
+    try:
+        info.load(atoms, fileobj)
+    except mutagen.mp4.MP4NoTrackError:
+        pass
+    except Exception as e:
+        raise TagReaderError('Unreadable MP4 stream info: {}'.format(e))
+
+    if b'moov.udta.meta.ilst' not in atoms:
+        return TagFile(None, info)
+    try:
+        tags = mutagen.easymp4.EasyMP4Tags(_NeededItems(atoms), fileobj)
+    except Exception as e:
+        raise TagReaderError('Unreadable MP4 tags: {}'.format(e))
+    return TagFile(tags, info)
+
+
+class _CountingFile(object):
+    # A file that keeps count of the bytes read from it.
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self._file.close()
+
+
+def _easy_tags(metadata):
+    return {key: list(metadata.get(key, [])) for key in
+            ('title', 'artist', 'album', 'albumartist', 'date',
+             'tracknumber')}
+
+
+def compare(directory):
+    # Read every MP3, FLAC and M4A file under directory both ways, reporting
+    # the files where the results differ and how much was read.
+    counts = {'files': 0, 'fallbacks': 0, 'differ': 0}
+    bytes_read = {'tagreader': 0, 'mutagen': 0}
+    for parent, _, filenames in os.walk(directory):
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(('.mp3', '.flac', '.m4a')):
+                continue
+            path = os.path.join(parent, filename)
+
+            try:
+                with _CountingFile(path) as f:
+                    expected = mutagen.File(f, easy=True)
+                    mutagen_bytes = f.bytes_read
+            except Exception as e:
+                print('{}: mutagen fails: {}'.format(path, e))
+                continue
+            if expected is None:
+                continue
+
+            counts['files'] += 1
+            try:
+                with _CountingFile(path) as f:
+                    actual = read(f)
+                    tagreader_bytes = f.bytes_read
+            except (TagReaderError, mutagen.MutagenError) as e:
+                counts['fallbacks'] += 1
+                print('{}: falls back: {}'.format(path, e))
+                continue
+
+            bytes_read['tagreader'] += tagreader_bytes
+            bytes_read['mutagen'] += mutagen_bytes
+            if _easy_tags(actual) != _easy_tags(expected)\
+                    or actual.info.length != expected.info.length:
+                counts['differ'] += 1
+                print('{}: differs:\n  {} {}\n  {} {}'.format(
+                    path, _easy_tags(actual), actual.info.length,
+                    _easy_tags(expected), expected.info.length
+                ))
+
+    print('{files} files, {fallbacks} fell back to mutagen, {differ}'
+          ' differ'.format(**counts))
+    print('Bytes read: {:,} by tagreader, {:,} by mutagen'.format(
+        bytes_read['tagreader'], bytes_read['mutagen']
+    ))
+
+
+if __name__ == '__main__':
+    import sys
+    compare(sys.argv[1])
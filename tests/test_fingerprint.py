@@ -0,0 +1,65 @@
+import hashlib
+import os
+import shutil
+import signal
+import struct
+import tempfile
+import unittest
+
+import fingerprint
+
+
+def ape_footer(size, flags=0):
+    return b'APETAGEX' + struct.pack('<IIII', 2000, size, 0, flags) + bytes(8)
+
+
+class TrailingTagTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        # A bad tag size used to send the hashing into an endless loop;
+        # fail the test instead of hanging with it.
+        def time_out(signum, frame):
+            raise AssertionError('hashing did not finish')
+        signal.signal(signal.SIGALRM, time_out)
+        self.addCleanup(signal.alarm, 0)
+        signal.alarm(5)
+
+    def write(self, data):
+        path = os.path.join(self.directory, 'song.mp3')
+        with open(path, 'wb') as f:
+            f.write(data)
+        return path
+
+    def whole_file_hash(self, data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def test_zero_size_ape_footer_is_hashed_whole(self):
+        data = b'\xff\xfb' * 500 + ape_footer(0)
+        path = self.write(data)
+        self.assertEqual(fingerprint.content_hash(path),
+                         self.whole_file_hash(data))
+
+    def test_oversized_ape_footer_is_hashed_whole(self):
+        data = b'\xff\xfb' * 500 + ape_footer(10 ** 6)
+        path = self.write(data)
+        self.assertEqual(fingerprint.content_hash(path),
+                         self.whole_file_hash(data))
+
+    def test_zero_size_lyrics3_tag_is_hashed_whole(self):
+        data = b'\xff\xfb' * 500 + b'000000LYRICS200'
+        path = self.write(data)
+        self.assertEqual(fingerprint.content_hash(path),
+                         self.whole_file_hash(data))
+
+    def test_ape_tag_is_left_out(self):
+        audio = b'\xff\xfb' * 500
+        items = b'x' * 40
+        path = self.write(audio + items + ape_footer(len(items) + 32))
+        self.assertEqual(fingerprint.content_hash(path),
+                         self.whole_file_hash(audio))
+
+
+if __name__ == '__main__':
+    unittest.main()
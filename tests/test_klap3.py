@@ -0,0 +1,74 @@
+import collections
+import unittest
+
+try:
+    import audit.klap3 as klap3
+except ImportError:
+    # KLAP3 is reached through MySQLdb, which only the audit needs.
+    klap3 = None
+
+# What find() looks at of a digilib album.
+SearchedAlbum = collections.namedtuple('SearchedAlbum',
+                                       'title artist track_count')
+
+
+class SummaryCursor(object):
+    # Hands out the rows of KLAP3AlbumSummary, as MySQLdb would.
+    def __init__(self, rows):
+        self.rows = rows
+
+    def execute(self, query, parameters=None):
+        pass
+
+    def fetchall(self):
+        return list(self.rows)
+
+    def close(self):
+        pass
+
+
+class SummaryConnection(object):
+    def __init__(self, rows):
+        self.rows = rows
+
+    def cursor(self):
+        return SummaryCursor(self.rows)
+
+
+@unittest.skipIf(klap3 is None, 'MySQLdb is not installed')
+class FindTest(unittest.TestCase):
+    def klap3_with(self, rows):
+        # Skip connecting: the summary is all find() reads.
+        summary = klap3.KLAP3.__new__(klap3.KLAP3)
+        summary.db = SummaryConnection(rows)
+        summary._ids_by_title_and_artist = None
+        return summary
+
+    def test_rows_with_null_names_are_not_matched(self):
+        summary = self.klap3_with([
+            (1, None, 'The Beatles', 17),
+            (2, 'Abbey Road', None, 17),
+            (3, 'Abbey Road ', 'The Beatles', 17),
+        ])
+        self.assertEqual(
+            summary.find(SearchedAlbum('abbey road', 'THE BEATLES', 17)),
+            [3]
+        )
+        self.assertEqual(
+            summary.find(SearchedAlbum('Let It Be', 'Beatles', 12)),
+            []
+        )
+
+    def test_artist_and_track_count_pick_the_closest_title(self):
+        summary = self.klap3_with([
+            (1, 'Other', 'Café Tacuba', 12),
+            (2, 'Re', 'Café Tacuba', 12),
+        ])
+        self.assertEqual(
+            summary.find(SearchedAlbum('Re (Remastered)', 'Cafe Tacuba', 12)),
+            [2]
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
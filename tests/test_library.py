@@ -0,0 +1,89 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import config
+import library
+from benchmarks import synthetic
+
+
+class BuildDbTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.working_directory = os.getcwd()
+        self.addCleanup(os.chdir, self.working_directory)
+        os.chdir(self.directory)
+
+        synthetic.build_library(os.path.join(self.directory, 'lib'),
+                                albums=4, tracks_per_album=3,
+                                broken_album_fraction=0,
+                                unreadable_file_fraction=0)
+        self.db_file_path = os.path.join(self.directory, 'library.db')
+        self.error_log = os.path.join(self.directory, 'errors.jsonl')
+        self.addCleanup(setattr, config, 'database_filename',
+                        config.database_filename)
+        config.database_filename = self.db_file_path
+
+    def song_count(self):
+        connection = sqlite3.connect(self.db_file_path)
+        try:
+            count, = connection.execute('SELECT COUNT(*) FROM Song').fetchone()
+        finally:
+            connection.close()
+        return count
+
+    def song_ids(self):
+        connection = sqlite3.connect(self.db_file_path)
+        try:
+            return connection.execute(
+                'SELECT id, album, filesystem_path FROM Song ORDER BY id'
+            ).fetchall()
+        finally:
+            connection.close()
+
+    def test_relative_and_absolute_roots_load_the_same_songs(self):
+        library.build_db('lib', error_log=self.error_log)
+        song_count = self.song_count()
+        self.assertEqual(song_count, 12)
+
+        library.build_db(os.path.join(self.directory, 'lib'),
+                         error_log=self.error_log)
+        self.assertEqual(self.song_count(), song_count)
+
+    def test_dangling_symlink_is_skipped(self):
+        album_directory = os.path.join(self.directory, 'lib', 'Artist 0',
+                                       'Album 0')
+        os.symlink(os.path.join(self.directory, 'missing.mp3'),
+                   os.path.join(album_directory, '06 gone.mp3'))
+
+        library.build_db('lib', error_log=self.error_log)
+        self.assertEqual(self.song_count(), 12)
+
+    def test_songs_in_unreadable_directories_are_kept(self):
+        library.build_db('lib', error_log=self.error_log)
+        song_ids = self.song_ids()
+
+        unreadable_directory = os.path.join(self.directory, 'lib',
+                                            'Artist 0', 'Album 0')
+        with mock.patch('os.scandir', failing_scandir(unreadable_directory)):
+            library.build_db('lib', error_log=self.error_log)
+        self.assertEqual(self.song_ids(), song_ids)
+
+
+def failing_scandir(unreadable_directory):
+    # os.scandir(), but failing on one directory as it would on a bad disk.
+    scandir = os.scandir
+
+    def fail_on_directory(path='.'):
+        if path == unreadable_directory:
+            raise OSError(5, 'Input/output error', path)
+        return scandir(path)
+    return fail_on_directory
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import unittest
+
+import normalize
+
+TAG_STRINGS_DIRECTORY = os.path.join(os.path.dirname(__file__), 'tag_strings')
+
+
+def read_corpus(filename):
+    # Yield the (tag string, expectation) pairs of a corpus file.
+    with open(os.path.join(TAG_STRINGS_DIRECTORY, filename)) as f:
+        for line in f:
+            line = line.rstrip('\n')
+            if line.startswith('#'):
+                continue
+            tag_string, expectation = line.rsplit('\t', 1)
+            yield tag_string, expectation
+
+
+class ReleaseDateTest(unittest.TestCase):
+    def test_corpus(self):
+        for tag_string, expectation in read_corpus('dates.tsv'):
+            with self.subTest(tag_string=tag_string):
+                if expectation == 'ValueError':
+                    with self.assertRaises(ValueError):
+                        normalize.release_date(tag_string)
+                    continue
+
+                date = normalize.release_date(tag_string)
+                if expectation == 'None':
+                    self.assertIsNone(date)
+                else:
+                    self.assertEqual(date.strftime('%Y-%m-%d')
+                                         [:len(expectation)],
+                                     expectation)
+
+    def test_repeated_dates_are_parsed_once(self):
+        normalize.release_date.cache_clear()
+        first = normalize.release_date('1994-05-06')
+        self.assertIs(normalize.release_date('1994-05-06'), first)
+        self.assertEqual(normalize.release_date.cache_info().hits, 1)
+
+    def test_errors_are_raised_every_time(self):
+        # Errors aren't memoised, so every song with a bad date gets its
+        # problem recorded.
+        for _ in range(2):
+            with self.assertRaises(ValueError):
+                normalize.release_date('1999-2000')
+
+
+class TrackNumberTest(unittest.TestCase):
+    def test_corpus(self):
+        for tag_string, expectation in read_corpus('track_numbers.tsv'):
+            with self.subTest(tag_string=tag_string):
+                number = normalize.track_number(tag_string)
+                if expectation == 'None':
+                    self.assertIsNone(number)
+                else:
+                    self.assertEqual(number, int(expectation))
+
+    def test_missing_tag(self):
+        self.assertIsNone(normalize.track_number(None))
+
+
+if __name__ == '__main__':
+    unittest.main()
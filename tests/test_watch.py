@@ -0,0 +1,101 @@
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import config
+import db
+import library
+import watch
+from benchmarks import synthetic
+from tests.test_library import failing_scandir
+
+
+class UpdateDirectoriesTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+
+        self.root = os.path.join(self.directory, 'lib')
+        synthetic.build_library(self.root, albums=2, tracks_per_album=3,
+                                broken_album_fraction=0,
+                                unreadable_file_fraction=0)
+        self.db_file_path = os.path.join(self.directory, 'library.db')
+        self.error_log = os.path.join(self.directory, 'errors.jsonl')
+        self.addCleanup(setattr, config, 'database_filename',
+                        config.database_filename)
+        config.database_filename = self.db_file_path
+
+        library.build_db(self.root, error_log=self.error_log)
+        self.database = db.DatabaseLoader(db_file_path=self.db_file_path,
+                                          batch_size=config.ingest_batch_size)
+
+    def song_count(self):
+        connection = sqlite3.connect(self.db_file_path)
+        try:
+            count, = connection.execute('SELECT COUNT(*) FROM Song').fetchone()
+        finally:
+            connection.close()
+        return count
+
+    def test_songs_in_unreadable_directories_are_kept(self):
+        album_directory = os.path.join(self.root, 'Artist 0', 'Album 0')
+        with mock.patch('os.scandir', failing_scandir(album_directory)):
+            watch.update_directories(self.database, {album_directory},
+                                     error_log=self.error_log)
+        self.assertEqual(self.song_count(), 6)
+
+    def test_songs_in_deleted_directories_are_forgotten(self):
+        album_directory = os.path.join(self.root, 'Artist 0', 'Album 0')
+        shutil.rmtree(album_directory)
+        watch.update_directories(self.database, {album_directory},
+                                 error_log=self.error_log)
+        self.assertEqual(self.song_count(), 3)
+
+
+class ChangeFeed(object):
+    # A watcher reporting the given batches of changed directories, one per
+    # call, then interrupted as by Ctrl-C.
+    def __init__(self, batches):
+        self.batches = list(batches)
+
+    def changes(self, timeout):
+        if not self.batches:
+            raise KeyboardInterrupt
+        return self.batches.pop(0)
+
+    def close(self):
+        pass
+
+
+class WatchTest(unittest.TestCase):
+    def test_failed_update_is_tried_again(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        album_directory = os.path.join(root, 'Album')
+
+        debouncer = watch.Debouncer
+        update_directories = mock.Mock(
+            side_effect=[sqlite3.OperationalError('database is locked'),
+                         None]
+        )
+        with mock.patch('watch.make_watcher',
+                        return_value=ChangeFeed([[album_directory], []])),\
+                mock.patch('watch.Debouncer',
+                           lambda: debouncer(quiet_seconds=0)),\
+                mock.patch('watch.update_directories', update_directories),\
+                mock.patch('library.build_db'),\
+                mock.patch('db.DatabaseLoader'),\
+                self.assertLogs('watch', level='ERROR'):
+            with self.assertRaises(KeyboardInterrupt):
+                watch.watch([root])
+
+        self.assertEqual(update_directories.call_count, 2)
+        for call in update_directories.call_args_list:
+            self.assertEqual(call[0][1], {album_directory})
+
+
+if __name__ == '__main__':
+    unittest.main()
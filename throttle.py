@@ -0,0 +1,337 @@
+"""
+Keep an ingest from starving whatever else reads from the same disks.
+
+The server library.py runs on also feeds the on-air playout, and a full scan
+reading song files as fast as it can makes the disk queue long enough for
+playout to drop out. A Throttle sits between the walk and the loader and
+holds back every song file until the budget allows reading it:
+
+- files per second and bytes per second are capped by token buckets. A file
+  is charged what the loader will read of it: all of it when hashing, the
+  head and tail the tags sit in otherwise.
+- the latency of the disk is watched by timing a small read at the start of
+  every file, which the parser reads right after anyway. While the latency
+  stays above the target, the budget is halved every adapt interval, down to
+  a floor; once it drops back below, the budget grows again step by step.
+- SIGUSR1 pauses the ingest and SIGUSR2 resumes it. Files already handed
+  to the loader are finished, and the database keeps being written.
+
+What the throttle is doing, the rates it sees and allows, the latency and
+whether it is paused, is written to a JSON status file every few seconds.
+"""
+import collections
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+import config
+
+logger = logging.getLogger(__name__)
+
+_SIZE_SUFFIXES = {'k': 2**10, 'm': 2**20, 'g': 2**30}
+
+
+def parse_size(text):
+    # A byte count for the command line: a plain number, or one with a K, M
+    # or G suffix for binary kilo-, mega- and gigabytes.
+    text = text.strip().lower().rstrip('b')
+    multiplier = _SIZE_SUFFIXES.get(text[-1:], 1)
+    if multiplier != 1:
+        text = text[:-1]
+    try:
+        size = float(text) * multiplier
+    except ValueError:
+        raise ValueError('not a size: {!r}'.format(text))
+    if size <= 0:
+        raise ValueError('a size has to be positive')
+    return size
+
+
+class TokenBucket(object):
+    # Allows rate units a second on average, in bursts of up to a second's
+    # worth. A charge larger than what is left is still taken, and the
+    # bucket is left owing it: the next charge waits until it is paid off.
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last_refill = time.monotonic()
+
+    def charge(self, amount):
+        # Take amount out of the bucket, returning the seconds to wait
+        # before using it.
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens
+                                     + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class Throttle(object):
+    # Caps the files and bytes read per second, scaled down while reads take
+    # longer than target_latency seconds. With no caps, a latency target
+    # caps files per second at the rate they were read when the latency
+    # first went over it. Rates of None aren't capped.
+
+    def __init__(self, files_per_second=None, bytes_per_second=None,
+                 target_latency=None,
+                 status_file=config.throttle_status_filename):
+        self.files_per_second = files_per_second
+        self.bytes_per_second = bytes_per_second
+        self.target_latency = target_latency
+        self.status_file = status_file
+
+        # The share of the caps currently allowed, between
+        # config.throttle_min_scale and 1.
+        self.scale = 1.0
+        self.latency = None
+        self._last_adapted = time.monotonic()
+
+        self._file_bucket = None
+        self._byte_bucket = None
+        self._apply_scale()
+
+        # (time, bytes) of the files let through in the last rate window,
+        # for the rates reported.
+        self._recent = collections.deque()
+        self.file_count = 0
+        self.byte_count = 0
+        self.waited = 0.0
+        self._last_status = 0
+
+        self._running = threading.Event()
+        self._running.set()
+        self._previous_handlers = {}
+
+        # With several lanes, files are let through from a thread per lane,
+        # all sharing the one budget.
+        self._lock = threading.RLock()
+
+    def _apply_scale(self):
+        # Fresh buckets keep no debt or burst from the rate before.
+        if self.files_per_second is not None:
+            self._file_bucket = TokenBucket(self.files_per_second * self.scale)
+        if self.bytes_per_second is not None:
+            self._byte_bucket = TokenBucket(self.bytes_per_second * self.scale)
+
+    def gate(self, items, path, byte_count):
+        # Hand out items no faster than the budget allows. path picks the
+        # file to be read out of each item, or returns None for items with
+        # nothing to read, which pass straight through; byte_count is how
+        # much of it will be read.
+        for item in items:
+            file_path = path(item)
+            if file_path is not None:
+                self.wait(file_path, byte_count(item))
+            yield item
+
+    def wait(self, path, byte_count):
+        # Block until path may be read: while paused, and for as long as the
+        # buckets need to refill.
+        self._wait_while_paused()
+
+        with self._lock:
+            delay = 0
+            if self._file_bucket is not None:
+                delay = max(delay, self._file_bucket.charge(1))
+            if self._byte_bucket is not None:
+                delay = max(delay, self._byte_bucket.charge(byte_count))
+            self.waited += delay
+        if delay:
+            time.sleep(delay)
+
+        latency = self._probe(path)
+
+        with self._lock:
+            self._observe(latency)
+            now = time.monotonic()
+            self.file_count += 1
+            self.byte_count += byte_count
+            self._recent.append((now, byte_count))
+            while now - self._recent[0][0] > config.throttle_rate_window:
+                self._recent.popleft()
+            if now - self._last_status >= config.throttle_status_interval:
+                self.write_status()
+
+    def _wait_while_paused(self):
+        if self._running.is_set():
+            return
+        logger.info('Ingest paused; send SIGUSR2 to resume')
+        self.write_status()
+        # Waiting in short steps lets the signal handler run in between.
+        while not self._running.wait(timeout=1):
+            pass
+        logger.info('Ingest resumed')
+        self.write_status()
+
+    def _probe(self, path):
+        # Time opening the file and reading its first block, which the
+        # parser reads straight after: for files nobody has read lately, this
+        # is the latency of the disk rather than of the page cache. None if
+        # it can't be read, which the loader will report.
+        if self.target_latency is None:
+            return None
+        start = time.perf_counter()
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            return None
+        try:
+            os.pread(fd, config.throttle_probe_bytes, 0)
+            return time.perf_counter() - start
+        except OSError:
+            return None
+        finally:
+            os.close(fd)
+
+    def _observe(self, latency):
+        if latency is None:
+            return
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += config.throttle_latency_smoothing\
+                            * (latency - self.latency)
+
+        # Slow down fast and speed up slowly, at most once an interval so
+        # that a change has time to show in the latency.
+        now = time.monotonic()
+        if now - self._last_adapted < config.throttle_adapt_interval:
+            return
+        self._last_adapted = now
+
+        if self.latency > self.target_latency:
+            if self.files_per_second is None and\
+                    self.bytes_per_second is None:
+                # Nothing to scale yet: start from the rate we got to.
+                self.files_per_second = max(self.file_rate(), 1.0)
+            scale = max(self.scale / 2, config.throttle_min_scale)
+        else:
+            scale = min(self.scale + config.throttle_scale_step, 1.0)
+
+        if scale != self.scale:
+            logger.debug('Read latency {:.1f} ms, throttling to {:.0%} of'
+                         ' the budget'.format(self.latency * 1000, scale))
+            self.scale = scale
+            self._apply_scale()
+
+    def file_rate(self):
+        # Files per second let through over the last rate window.
+        if len(self._recent) < 2:
+            return 0.0
+        elapsed = self._recent[-1][0] - self._recent[0][0]
+        return (len(self._recent) - 1) / elapsed if elapsed else 0.0
+
+    def byte_rate(self):
+        if len(self._recent) < 2:
+            return 0.0
+        elapsed = self._recent[-1][0] - self._recent[0][0]
+        byte_count = sum(count for _, count in self._recent) \
+                     - self._recent[0][1]
+        return byte_count / elapsed if elapsed else 0.0
+
+    def status(self):
+        def allowed(cap):
+            return None if cap is None else round(cap * self.scale, 1)
+
+        return {
+            'paused': not self._running.is_set(),
+            'files_per_second': round(self.file_rate(), 1),
+            'bytes_per_second': round(self.byte_rate()),
+            'allowed_files_per_second': allowed(self.files_per_second),
+            'allowed_bytes_per_second': allowed(self.bytes_per_second),
+            'scale': round(self.scale, 3),
+            'latency_ms': None if self.latency is None
+                               else round(self.latency * 1000, 2),
+            'target_latency_ms': None if self.target_latency is None
+                                      else self.target_latency * 1000,
+            'files': self.file_count,
+            'bytes': self.byte_count,
+            'seconds_waited': round(self.waited, 1),
+            'pid': os.getpid(),
+            'updated': time.time(),
+        }
+
+    def write_status(self):
+        with self._lock:
+            self._last_status = time.monotonic()
+            if self.status_file is None:
+                return
+            # Written aside and renamed into place, so that a reader never
+            # sees half a file.
+            temporary_file = '{}.tmp'.format(self.status_file)
+            try:
+                with open(temporary_file, 'w') as f:
+                    json.dump(self.status(), f, indent=2, sort_keys=True)
+                    f.write('\n')
+                os.replace(temporary_file, self.status_file)
+            except OSError as e:
+                logger.warning('Could not write {}: {}'.format(
+                    self.status_file, e
+                ))
+
+    def pause(self, *args):
+        # Also the SIGUSR1 handler. Only sets a flag: the ingest stops at the
+        # next file.
+        self._running.clear()
+
+    def resume(self, *args):
+        # Also the SIGUSR2 handler.
+        self._running.set()
+
+    def install_signal_handlers(self):
+        # Signal handlers can only be set from the main thread, on platforms
+        # that have these signals.
+        if not hasattr(signal, 'SIGUSR1'):
+            logger.warning('Pausing on a signal is not supported here')
+            return
+        for signal_number, handler in ((signal.SIGUSR1, self.pause),
+                                       (signal.SIGUSR2, self.resume)):
+            self._previous_handlers[signal_number] = signal.signal(
+                signal_number, handler
+            )
+
+    def close(self):
+        for signal_number, handler in self._previous_handlers.items():
+            signal.signal(signal_number, handler)
+        self._previous_handlers = {}
+        self._running.set()
+        self.write_status()
+
+
+def add_arguments(parser):
+    # The options of library.py and weed_out_bad_files.py for throttling.
+    group = parser.add_argument_group(
+        'throttling', 'Leave the disks some room for playout. Send SIGUSR1'
+                      ' to pause, SIGUSR2 to resume.'
+    )
+    group.add_argument('--max-files-per-second', type=float, metavar='N',
+                       help='read no more than N song files a second')
+    group.add_argument('--max-bytes-per-second', type=parse_size,
+                       metavar='SIZE',
+                       help='read no more than SIZE bytes a second, e.g. 20M')
+    group.add_argument('--max-latency', type=float, metavar='MS',
+                       help='slow down while reading from the disk takes'
+                            ' longer than MS milliseconds')
+    group.add_argument('--throttle-status', metavar='FILE',
+                       default=config.throttle_status_filename,
+                       help='JSON file the current rates are written to'
+                            ' (default: %(default)s)')
+
+
+def from_arguments(args):
+    # A Throttle for the options above, or None if none were given.
+    if args.max_files_per_second is None and\
+            args.max_bytes_per_second is None and args.max_latency is None:
+        return None
+    return Throttle(files_per_second=args.max_files_per_second,
+                    bytes_per_second=args.max_bytes_per_second,
+                    target_latency=None if args.max_latency is None
+                                        else args.max_latency / 1000,
+                    status_file=args.throttle_status)
@@ -0,0 +1,386 @@
+"""
+Decode every song file in the library from start to end, to find the ones
+that are damaged.
+
+weed_out_bad_files.py only finds the files whose headers can't be parsed.
+A FLAC file with truncated frames or an MP3 stream broken halfway through
+parses fine, and only fails once it is played. This decodes all of the
+audio, with libsndfile, in a pool of worker processes, and records a verdict
+for every file in the database along with the size and modification time it
+had. Running it again only decodes the files that are new or changed since.
+
+A file fails when decoding it raises an error, when it decodes to fewer
+frames than its header promises, or, for WAV files, which libsndfile reads
+as far as they go, when the data chunk claims more audio than the file
+holds. The failing files are listed in verify_failures.txt.
+
+Decoding a whole archive takes a lot of processor time; --cpu-budget keeps
+the workers to a number of cores' worth of it, on average, and they run at a
+lower priority than everything else.
+"""
+import argparse
+import collections
+import datetime
+import itertools
+import logging
+import math
+import multiprocessing
+import os
+import sys
+import time
+
+import soundfile
+
+import config
+import db
+import library
+import riff
+import throttle
+
+logger = logging.getLogger(__name__)
+
+# Song file extensions that can be decoded, with the libsndfile format that
+# decodes them. MP3 needs libsndfile 1.1 or later.
+DECODED_FORMATS = {
+    '.flac': 'FLAC',
+    '.mp3': 'MP3',
+    '.wav': 'WAV',
+}
+
+VerifiedFile = collections.namedtuple('VerifiedFile',
+                                      'path signature verdict message')
+
+
+class VerificationError(Exception):
+    pass
+
+
+class CpuBudget(object):
+    # Keeps the processor time this process uses to share of the time gone
+    # by since start(), by sleeping whenever it gets ahead. A share of None
+    # doesn't hold it back.
+
+    def __init__(self, share=None):
+        self.share = share
+        self.start()
+
+    def start(self):
+        self.cpu_start = time.process_time()
+        self.wall_start = time.monotonic()
+
+    def spend(self):
+        if self.share is None:
+            return
+        cpu_time = time.process_time() - self.cpu_start
+        elapsed = time.monotonic() - self.wall_start
+        ahead = cpu_time / self.share - elapsed
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+# The budget of the process decoding, set up by start_worker().
+_budget = CpuBudget()
+
+
+def start_worker(share):
+    global _budget
+    _budget = CpuBudget(share)
+    try:
+        os.nice(config.verify_niceness)
+    except (AttributeError, OSError):
+        # Not on this platform, or not allowed to.
+        pass
+
+
+def decodable_extensions():
+    available_formats = soundfile.available_formats()
+    return tuple(extension
+                 for extension, format in sorted(DECODED_FORMATS.items())
+                 if format in available_formats)
+
+
+def decode(path):
+    # Decode all of a song file, raising VerificationError if it holds less
+    # audio than it should. libsndfile raises its own errors on a stream it
+    # can't make sense of.
+    with soundfile.SoundFile(path) as sound_file:
+        expected_frame_count = sound_file.frames
+        frame_count = 0
+        while True:
+            block = sound_file.read(config.verify_block_frames,
+                                    dtype='int16')
+            if not len(block):
+                break
+            frame_count += len(block)
+            _budget.spend()
+
+    # Without a frame count in the header, the length of an MP3 stream is
+    # estimated from its bit rate, hence the tolerance.
+    if frame_count < expected_frame_count\
+                     * (1 - config.verify_frame_tolerance):
+        raise VerificationError('cut short: {} of {} frames decoded'.format(
+            frame_count, expected_frame_count
+        ))
+
+    if path.lower().endswith('.wav'):
+        check_wav_length(path)
+
+
+def check_wav_length(path):
+    # libsndfile reads what there is of a truncated WAV file without
+    # complaint, but its data chunk still says how much there should be.
+    with open(path, 'rb') as f:
+        file_size = os.fstat(f.fileno()).st_size
+        # An unlimited file size leaves the size the data chunk claims as
+        # it is.
+        fmt, data_offset, data_size = riff.find_wav_chunks(
+            f, file_size=sys.maxsize
+        )
+    missing_byte_count = data_offset + data_size - file_size
+    if missing_byte_count > 0:
+        raise VerificationError('cut short: {} bytes of audio missing'.format(
+            missing_byte_count
+        ))
+
+
+def verify_file(song_file):
+    path, signature = song_file
+    _budget.start()
+    try:
+        decode(path)
+    except VerificationError as e:
+        return VerifiedFile(path, signature, 'corrupt', str(e))
+    except OSError as e:
+        return VerifiedFile(path, signature, 'unreadable',
+                            '{}: {}'.format(type(e).__name__, e))
+    except Exception as e:
+        return VerifiedFile(path, signature, 'corrupt',
+                            '{}: {}'.format(type(e).__name__, e))
+    return VerifiedFile(path, signature, 'ok', None)
+
+
+def verify_files(song_files, workers=1, share=None):
+    # Yield the verdicts on the given (path, signature) pairs, in the order
+    # they are reached.
+    if workers <= 1:
+        start_worker(share)
+        for song_file in song_files:
+            yield verify_file(song_file)
+        return
+
+    # Files take anything from a fraction of a second to minutes to decode,
+    # so they are handed out one at a time, and the verdicts taken as they
+    # come.
+    pool = multiprocessing.Pool(processes=workers, initializer=start_worker,
+                                initargs=(share,))
+    try:
+        yield from pool.imap_unordered(verify_file, song_files)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def find_unverified_files(directory, verdicts, extensions, seen_paths,
+                          skipped_directories, counts):
+    # Yield the (path, signature) of every song file under directory with
+    # no verdict for its current size and modification time. Every song
+    # file found is added to seen_paths, and every directory that couldn't
+    # be read to skipped_directories.
+    for album_directory, song_files in library.find_song_files(
+            directory, skipped_directories=skipped_directories):
+        for path, signature in song_files:
+            seen_paths.add(path)
+            if not path.lower().endswith(extensions):
+                counts['undecodable'] += 1
+                continue
+            verdict = verdicts.get(path)
+            if verdict is not None and\
+                    verdict[:2] == (signature.size, signature.mtime):
+                counts['unchanged'] += 1
+                continue
+            yield path, signature
+
+
+class VerifyProgress(library.ProgressLine):
+    def __init__(self, **kwargs):
+        super(VerifyProgress, self).__init__(**kwargs)
+        self.byte_count = 0
+        self.failed_count = 0
+
+    def add(self, verified_file):
+        self.byte_count += verified_file.signature.size
+        if verified_file.verdict != 'ok':
+            self.failed_count += 1
+        self.update(file_count=1, album_count=0)
+
+    def _write(self):
+        elapsed = time.monotonic() - self.start_time
+        line = '{files} files decoded, {failed} failing,' \
+               ' {files_per_second:.1f} files/s,' \
+               ' {megabytes_per_second:.1f} MB/s, {elapsed} elapsed'.format(
+            files=self.file_count,
+            failed=self.failed_count,
+            files_per_second=self.file_count / elapsed if elapsed else 0,
+            megabytes_per_second=self.byte_count / 2**20 / elapsed
+                                 if elapsed else 0,
+            elapsed=datetime.timedelta(seconds=int(elapsed))
+        )
+        if self.interactive:
+            self.stream.write('\r\033[K' + line)
+        else:
+            self.stream.write(line + '\n')
+        self.stream.flush()
+
+
+def verify(directories, workers=1, cpu_budget=None,
+           failures_file=config.verify_failures_filename, throttle=None):
+    # cpu_budget is the number of cores the workers may keep busy between
+    # them, on average; None lets them use all they get.
+    for directory in directories:
+        if not os.path.isdir(directory):
+            raise IOError('"{}" is not a directory'.format(directory))
+
+    database = db.DatabaseLoader(db_file_path=config.database_filename,
+                                 batch_size=config.verify_commit_interval)
+    database.initialize_empty_tables()
+
+    extensions = decodable_extensions()
+    undecodable_formats = [format for extension, format
+                           in sorted(DECODED_FORMATS.items())
+                           if extension not in extensions]
+    if undecodable_formats:
+        logger.warning('The libsndfile installed decodes no {} files; they'
+                       ' are skipped'.format(', '.join(undecodable_formats)))
+
+    share = None
+    if cpu_budget is not None and cpu_budget < workers:
+        share = cpu_budget / workers
+
+    verdicts = {}
+    seen_paths = set()
+    skipped_directories = set()
+    counts = collections.Counter()
+    for directory in directories:
+        verdicts.update(database.load_verdicts(directory))
+    song_files = itertools.chain.from_iterable(
+        find_unverified_files(directory, verdicts, extensions, seen_paths,
+                              skipped_directories, counts)
+        for directory in directories
+    )
+    if throttle is not None:
+        song_files = throttle.gate(
+            song_files,
+            path=lambda song_file: song_file[0],
+            byte_count=lambda song_file: song_file[1].size
+        )
+        throttle.install_signal_handlers()
+
+    progress = VerifyProgress()
+    try:
+        for verified_file in verify_files(song_files, workers=workers,
+                                          share=share):
+            database.record_verdict(verified_file.path,
+                                    verified_file.signature,
+                                    verified_file.verdict,
+                                    verified_file.message)
+            if verified_file.verdict != 'ok':
+                logger.warning('{}: {}'.format(verified_file.path,
+                                               verified_file.message))
+            else:
+                logger.debug('Decoded {}'.format(verified_file.path))
+            progress.add(verified_file)
+            if progress.file_count % config.verify_commit_interval == 0:
+                database.flush()
+
+        # Files below directories that couldn't be read may well still be
+        # there.
+        skipped_prefixes = tuple(os.path.join(directory, '')
+                                 for directory in skipped_directories)
+        for path in set(verdicts) - seen_paths:
+            if not path.startswith(skipped_prefixes):
+                database.forget_verdict(path)
+        database.flush()
+
+    except KeyboardInterrupt:
+        # Keep the verdicts reached so far; the next run picks up from
+        # there.
+        database.flush()
+        raise
+
+    finally:
+        progress.finish()
+        if throttle is not None:
+            throttle.close()
+
+    elapsed = time.monotonic() - progress.start_time
+    logger.info('{decoded} song files decoded ({megabytes:.0f} MB,'
+                ' {megabytes_per_second:.1f} MB/s), {failed} of them'
+                ' failing; {unchanged} unchanged since they were last'
+                ' verified, {undecodable} that can\'t be decoded'
+                ' here'.format(
+        decoded=progress.file_count,
+        megabytes=progress.byte_count / 2**20,
+        megabytes_per_second=progress.byte_count / 2**20 / elapsed
+                             if elapsed else 0,
+        failed=progress.failed_count,
+        unchanged=counts['unchanged'],
+        undecodable=counts['undecodable']
+    ))
+
+    failures = []
+    for directory in directories:
+        for path, (size, mtime, verdict, message)\
+                in database.load_verdicts(directory).items():
+            if verdict != 'ok':
+                failures.append((path, message))
+    failures.sort()
+    with open(failures_file, 'w') as f:
+        for path, message in failures:
+            f.write('{}\t{}\n'.format(path, message))
+    logger.info('{} failing song files listed in {}'.format(len(failures),
+                                                            failures_file))
+    return failures
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Decode every song file in the digital library to find'
+                    ' the damaged ones. Run again to decode only the files'
+                    ' that changed.'
+    )
+    parser.add_argument('directories', nargs='+', metavar='directory',
+                        help='root of the digital library')
+    parser.add_argument('-w', '--workers', type=int,
+                        help='number of processes decoding song files'
+                             ' (default: enough for the CPU budget, or 1)')
+    parser.add_argument('--cpu-budget', type=float, metavar='CORES',
+                        help='keep the workers to CORES processor cores on'
+                             ' average, e.g. 1.5 (default: no limit)')
+    parser.add_argument('-o', '--output',
+                        default=config.verify_failures_filename,
+                        help='file the failing song files are listed in'
+                             ' (default: %(default)s)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False, help='log every file decoded')
+    throttle.add_arguments(parser)
+
+    args = parser.parse_args()
+    if args.cpu_budget is not None and args.cpu_budget <= 0:
+        parser.error('the CPU budget has to be positive')
+    if args.workers is None:
+        args.workers = 1 if args.cpu_budget is None\
+                         else math.ceil(args.cpu_budget)
+    return args
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    library.setup_logging(args)
+    failures = verify([os.path.abspath(directory)
+                       for directory in args.directories],
+                      workers=args.workers, cpu_budget=args.cpu_budget,
+                      failures_file=args.output,
+                      throttle=throttle.from_arguments(args))
+    for path, message in failures:
+        print(path)
@@ -0,0 +1,512 @@
+"""
+Keep the digilib database up to date while albums are added to the library.
+
+    python watch.py [--workers N] [--hash] [--poll] /path/to/digilib [...]
+
+Brings the database up to date with a build first, as library.py does, and
+then watches the library directories for song files being added, changed,
+moved or deleted. A directory is loaded again once no file in it has
+changed for a few seconds, so an album being copied in is loaded once the
+copy is done, and only that directory is read: songs show up in the
+database, for the web pages and the audit, within seconds rather than after
+the next full build.
+
+Changes are noticed with inotify on Linux. Elsewhere, or with --poll, the
+directories are polled instead: every few seconds a directory's
+modification time is looked at, which changes when files are added, removed
+or renamed in it, and the song files of a directory that changed are looked
+at until they stop changing.
+"""
+import argparse
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+import config
+import db
+import errors
+import library
+
+logger = logging.getLogger(__name__)
+
+# inotify(7) event masks.
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_ISDIR = 0x40000000
+
+# struct inotify_event, followed by len bytes of NUL padded name.
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+class InotifyError(OSError):
+    pass
+
+
+def walk_directories(directory):
+    # The directory and all those below it that find_song_files() would
+    # walk into.
+    directories = []
+    pending_directories = [directory]
+    while pending_directories:
+        directory = pending_directories.pop()
+        try:
+            with os.scandir(directory) as entries:
+                subdirectories = [
+                    entry.path for entry in entries
+                    if entry.is_dir(follow_symlinks=False)
+                    and entry.name not in config.skipped_directory_names
+                ]
+        except OSError:
+            continue
+        directories.append(directory)
+        pending_directories.extend(subdirectories)
+    return directories
+
+
+class InotifyWatcher(object):
+    # Watches every directory under the roots with inotify, adding watches
+    # for directories as they are created or moved in.
+
+    mask = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM\
+           | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF\
+           | IN_MOVE_SELF | IN_ONLYDIR | IN_DONT_FOLLOW
+
+    def __init__(self, roots):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self._inotify_init1 = libc.inotify_init1
+            self._inotify_add_watch = libc.inotify_add_watch
+            self._inotify_rm_watch = libc.inotify_rm_watch
+        except (OSError, AttributeError):
+            raise InotifyError('inotify is not available')
+
+        self.fd = self._inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise InotifyError(ctypes.get_errno(), 'inotify_init1 failed')
+
+        self.roots = roots
+        # Watch descriptor -> directory, and back.
+        self.directories = {}
+        self.watches = {}
+        try:
+            for root in roots:
+                self._watch_tree(root)
+        except InotifyError:
+            self.close()
+            raise
+
+    def _watch_tree(self, directory):
+        # Watch a directory and everything below it, returning the
+        # directories now watched.
+        directories = walk_directories(directory)
+        for directory in directories:
+            wd = self._inotify_add_watch(self.fd, os.fsencode(directory),
+                                         self.mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error in (errno.ENOENT, errno.ENOTDIR):
+                    # Gone again already.
+                    continue
+                if error == errno.ENOSPC:
+                    raise InotifyError(error, 'out of inotify watches; raise'
+                                              ' fs.inotify.max_user_watches')
+                raise InotifyError(error, os.strerror(error), directory)
+            self.directories[wd] = directory
+            self.watches[directory] = wd
+        return directories
+
+    def _unwatch_tree(self, directory):
+        prefix = os.path.join(directory, '')
+        for watched_directory in list(self.watches):
+            if watched_directory == directory or\
+                    watched_directory.startswith(prefix):
+                wd = self.watches.pop(watched_directory)
+                del self.directories[wd]
+                # Fails harmlessly if the directory, and with it the watch,
+                # is gone already.
+                self._inotify_rm_watch(self.fd, wd)
+
+    def changes(self, timeout):
+        # Wait up to timeout seconds for something to happen, and return the
+        # directories whose song files may have changed. A directory that
+        # was removed is returned itself, for everything under it to be
+        # forgotten.
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                # Events were lost: look at everything again.
+                logger.warning('Too many changes at once; looking at the'
+                               ' whole library again')
+                for root in self.roots:
+                    changed.update(self._watch_tree(root))
+                continue
+
+            directory = self.directories.get(wd)
+            if directory is None or mask & IN_IGNORED:
+                continue
+
+            if not mask & IN_ISDIR:
+                changed.add(directory)
+                continue
+
+            # A subdirectory came or went, with whatever is in it.
+            if name in config.skipped_directory_names:
+                continue
+            path = os.path.join(directory, name)
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                changed.update(self._watch_tree(path))
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._unwatch_tree(path)
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryPoller(object):
+    # Polls the modification time of every directory under the roots, which
+    # changes when entries are added to, removed from or renamed in it,
+    # without looking at each file. The song files of a directory that
+    # changed are compared from one poll to the next, and the directory is
+    # only reported once they are the same twice in a row, so that files
+    # still being copied in are waited for.
+    #
+    # Files rewritten in place leave the directory alone. To notice those
+    # too, every poll also looks at the song files of a few directories in
+    # turn, so that the whole library is gone through every so often.
+
+    def __init__(self, roots, interval=config.watch_poll_interval):
+        self.roots = roots
+        self.interval = interval
+        self.next_poll = time.monotonic() + interval
+        # directory -> modification time
+        self.mtimes = {}
+        # directory -> its song files and their signatures, for the
+        # directories that changed lately
+        self.settling = {}
+        # directory -> hash of its song files when last looked at in turn,
+        # and the directories still to be looked at this time round
+        self.listings = {}
+        self.sweep = []
+        # Directories that went away, reported with the next poll: any that
+        # were moved turn up under their new name by then, and their files
+        # are recognised as moved.
+        self.gone = set()
+        for root in roots:
+            self._add_tree(root, settle=False)
+
+    def _add_tree(self, directory, settle=True):
+        for directory in walk_directories(directory):
+            try:
+                self.mtimes[directory] = os.stat(directory).st_mtime_ns
+            except OSError:
+                continue
+            if settle:
+                self.settling[directory] = None
+
+    def _forget_tree(self, directory):
+        prefix = os.path.join(directory, '')
+        for known_directory in list(self.mtimes):
+            if known_directory == directory or\
+                    known_directory.startswith(prefix):
+                del self.mtimes[known_directory]
+                self.settling.pop(known_directory, None)
+                self.listings.pop(known_directory, None)
+
+    def changes(self, timeout):
+        wait = self.next_poll - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(wait, 0))
+        self.next_poll = time.monotonic() + self.interval
+        return self.poll()
+
+    def poll(self):
+        # Directories that are gone are reported with everything below them;
+        # those that changed are settled first.
+        changed = self.gone
+        self.gone = set()
+        for directory, mtime in list(self.mtimes.items()):
+            if directory not in self.mtimes:
+                # Forgotten along with a parent that went away.
+                continue
+            try:
+                current_mtime = os.stat(directory).st_mtime_ns
+            except OSError:
+                self._forget_tree(directory)
+                self.gone.add(directory)
+                continue
+            if current_mtime == mtime:
+                continue
+
+            self.mtimes[directory] = current_mtime
+            self.settling[directory] = None
+            # Subdirectories that were added, with everything in them.
+            # Those removed fail their own stat() above.
+            try:
+                with os.scandir(directory) as entries:
+                    subdirectories = [
+                        entry.path for entry in entries
+                        if entry.is_dir(follow_symlinks=False)
+                        and entry.name not in config.skipped_directory_names
+                    ]
+            except OSError:
+                continue
+            for subdirectory in subdirectories:
+                if subdirectory not in self.mtimes:
+                    self._add_tree(subdirectory)
+
+        self._sweep()
+
+        for directory, song_files in list(self.settling.items()):
+            current_song_files = library.list_song_files(directory)
+            if current_song_files == song_files:
+                del self.settling[directory]
+                self.listings[directory] = hash(tuple(song_files))
+                changed.add(directory)
+            else:
+                self.settling[directory] = current_song_files
+        return changed
+
+    def _sweep(self):
+        if not self.sweep:
+            self.sweep = sorted(self.mtimes, reverse=True)
+        for _ in range(min(config.watch_poll_sweep_directories,
+                           len(self.sweep))):
+            directory = self.sweep.pop()
+            if directory not in self.mtimes or directory in self.settling:
+                continue
+            listing = hash(tuple(library.list_song_files(directory)))
+            previous_listing = self.listings.get(directory)
+            self.listings[directory] = listing
+            if previous_listing is not None and listing != previous_listing:
+                self.settling[directory] = None
+
+    def close(self):
+        pass
+
+
+def make_watcher(roots, poll=False):
+    if not poll:
+        try:
+            return InotifyWatcher(roots)
+        except InotifyError as e:
+            logger.warning('Polling for changes instead of using inotify:'
+                           ' {}'.format(e))
+    return DirectoryPoller(roots)
+
+
+class Debouncer(object):
+    # Holds back directories until they have had no changes for a while.
+
+    def __init__(self, quiet_seconds=config.watch_debounce_seconds):
+        self.quiet_seconds = quiet_seconds
+        # directory -> when it last changed
+        self.pending = {}
+
+    def add(self, directories):
+        now = time.monotonic()
+        for directory in directories:
+            self.pending[directory] = now
+
+    def next_ready(self):
+        # Seconds until the next directory is ready, or None.
+        if not self.pending:
+            return None
+        return max(0, min(self.pending.values()) + self.quiet_seconds
+                      - time.monotonic())
+
+    def take_ready(self):
+        # Once a directory is ready, those that have been quiet for half as
+        # long already come along, so that a burst of changes all over the
+        # library, like a whole artist deleted, is one transaction.
+        now = time.monotonic()
+        quiet_seconds = [now - changed for changed in self.pending.values()]
+        if not quiet_seconds or max(quiet_seconds) < self.quiet_seconds:
+            return set()
+        ready = set(directory for directory, changed in self.pending.items()
+                    if now - changed >= self.quiet_seconds / 2)
+        for directory in ready:
+            del self.pending[directory]
+        return ready
+
+
+def update_directories(database, directories, hash_content=False,
+                       error_log=config.error_log_filename):
+    # Bring the songs directly inside each of the directories up to date,
+    # and forget all of those under directories that are gone, in one
+    # transaction. Files moved between the directories are recognised as
+    # moves.
+    manifest = {}
+    quarantine = {}
+    found_files = []
+    skipped_directories = set()
+    for directory in sorted(directories):
+        exists = os.path.isdir(directory)
+        for known, loaded in ((manifest, database.load_manifest(directory)),
+                              (quarantine,
+                               database.load_quarantine(directory))):
+            for path, signature in loaded.items():
+                if not exists or os.path.dirname(path) == directory:
+                    known[path] = signature
+        if exists:
+            found_files.append((directory, library.list_song_files(
+                directory, skipped_directories=skipped_directories
+            )))
+
+    diff = library.ManifestDiff(manifest=manifest, quarantine=quarantine,
+                                skipped_directories=skipped_directories)
+    with errors.ErrorSink(error_log) as error_sink:
+        try:
+            for directory, scanned_files in diff.scan(found_files):
+                if not scanned_files:
+                    continue
+                loaded_files = [
+                    library.load_scanned_file(scanned_file,
+                                              hash_content=hash_content)
+                    for scanned_file in scanned_files
+                ]
+                library.store_album(database, loaded_files,
+                                    quarantine=diff.quarantine,
+                                    error_sink=error_sink)
+
+            vanished_paths = diff.vanished_paths()
+            for path in vanished_paths:
+                database.delete_song(path)
+            for path in diff.vanished_quarantined_paths():
+                database.release_from_quarantine(path)
+            database.prune_empty_albums()
+            database.flush()
+
+        except:
+            database.rollback()
+            raise
+
+    if diff.counts['new'] or diff.counts['modified'] or\
+            diff.counts['moved'] or vanished_paths:
+        logger.info('{new} new, {modified} modified, {moved} moved and'
+                    ' {deleted} deleted song files in {directories}'.format(
+            new=diff.counts['new'],
+            modified=diff.counts['modified'],
+            moved=diff.counts['moved'],
+            deleted=len(vanished_paths),
+            directories=', '.join(sorted(directories))
+                        if len(directories) <= 3
+                        else '{} directories'.format(len(directories))
+        ))
+
+
+def root_of(directory, roots):
+    for root in roots:
+        if directory == root or\
+                directory.startswith(os.path.join(root, '')):
+            return root
+    return None
+
+
+def watch(roots, workers=1, hash_content=False, poll=False):
+    # Start watching before the first build, so that nothing that changes
+    # while it runs is missed.
+    watcher = make_watcher(roots, poll=poll)
+    try:
+        library.build_db(roots, workers=workers, hash_content=hash_content)
+        logger.info('Watching {} for changes'.format(', '.join(roots)))
+
+        # One loader serves every update, so that its identity map of
+        # artists and albums is only filled in once.
+        database = db.DatabaseLoader(db_file_path=config.database_filename,
+                                     batch_size=config.ingest_batch_size)
+
+        debouncer = Debouncer()
+        while True:
+            timeout = debouncer.next_ready()
+            debouncer.add(watcher.changes(
+                timeout=config.watch_poll_interval if timeout is None
+                        else timeout
+            ))
+
+            ready = debouncer.take_ready()
+            # A missing root is more likely an unmounted drive than a library
+            # that was deleted; leave its songs alone. Directories outside
+            # every root, such as where one was renamed to, aren't ours.
+            ready_roots = ((directory, root_of(directory, roots))
+                           for directory in ready)
+            ready = set(directory for directory, root in ready_roots
+                        if root is not None and os.path.isdir(root))
+            if ready:
+                # A directory that vanished halfway, or the database being
+                # locked by a reader, fails the whole update, which is rolled
+                # back. It is tried again once the directories are quiet.
+                try:
+                    update_directories(database, ready,
+                                       hash_content=hash_content)
+                except Exception:
+                    logger.exception('Could not update {}; trying again'
+                                     ' later'.format(', '.join(sorted(ready))))
+                    debouncer.add(ready)
+    finally:
+        watcher.close()
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='Keep the digilib database up to date as song files are'
+                    ' added, changed, moved and deleted.'
+    )
+    parser.add_argument('directories', nargs='+', metavar='directory',
+                        help='root of the digital library')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes used to parse song files'
+                             ' in the first build, per drive (default: 1)')
+    parser.add_argument('--hash', action='store_true', default=False,
+                        help='also hash the audio payload of every song, for'
+                             ' duplicates.py')
+    parser.add_argument('--poll', action='store_true', default=False,
+                        help='poll the directories every {} seconds instead'
+                             ' of using inotify, e.g. on a network'
+                             ' mount'.format(config.watch_poll_interval))
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False, help='log every file and song loaded')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    library.setup_logging(args)
+    try:
+        watch([os.path.abspath(directory) for directory in args.directories],
+              workers=args.workers, hash_content=args.hash, poll=args.poll)
+    except KeyboardInterrupt:
+        pass
@@ -1,38 +1,48 @@
-import sys
+"""
+List the song files under a directory that can't be read, and delete the
+__MACOSX directories in it.
+
+Reading every file is what building the database does anyway, so this runs
+the same ingest as library.py, deleting the skipped directories as it walks,
+and then lists the files it quarantined. Those are written to
+weed_out_files.txt.
+"""
+import argparse
 import os
-import shutil
-import mutagen
-import soundfile
-import collections
-
-
-directory = sys.argv[-1]
-audio_file_extensions = ('.wav', '.flac', '.mp3', '.mp4', '.wma', '.m4a', '.dts')
-encountered_extensions = collections.defaultdict(int)
-
-
-with open('weed_out_files.txt', 'w') as f:
-    for d, subdir, files in os.walk(directory):
-        if d.endswith('__MACOSX'):
-            shutil.rmtree(d)
-            continue
-
-        for filename in files:
-            if not filename.lower().endswith(audio_file_extensions):
-                continue
-
-            path = os.path.join(d, filename)
-            if filename.lower().endswith('.wav'):
-                try:
-                    soundfile.SoundFile(path)
-                except:
-                    f.write('{}\n'.format(path))
-                    print(path)
-
-            else:
-                try:
-                    mutagen.File(path, easy=True)
-                except:
-                    f.write('{}\n'.format(path))
-                    print(path)
 
+import config
+import db
+import library
+import throttle
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser(
+        description='List unreadable song files and delete __MACOSX'
+                    ' directories, while building the digilib database.'
+    )
+    parser.add_argument('directories', nargs='+', metavar='directory',
+                        help='root of the digital library')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='number of processes used to parse song files,'
+                             ' per drive (default: 1, i.e. no process pool)')
+    parser.add_argument('-v', '--verbose', action='store_true',
+                        default=False, help='log every file and song loaded')
+    throttle.add_arguments(parser)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_arguments()
+    library.setup_logging(args)
+    directories = [os.path.abspath(directory)
+                   for directory in args.directories]
+    library.build_db(directories, workers=args.workers, delete_skipped=True,
+                     throttle=throttle.from_arguments(args))
+
+    database = db.DatabaseLoader(db_file_path=config.database_filename)
+    with open('weed_out_files.txt', 'w') as f:
+        for directory in directories:
+            for path in sorted(database.load_quarantine(directory)):
+                f.write('{}\n'.format(path))
+                print(path)